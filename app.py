@@ -1,48 +1,551 @@
-import shutil
-import uvicorn
+from startup import READINESS, preload
 from dotenv import load_dotenv
-from pydantic import BaseModel
-from typing import Optional, Dict, List
+from typing import Optional, List
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import subprocess, time, os, requests, asyncio
-from fastapi import FastAPI, File, UploadFile, Request
-from voice import TextToSpeech, SpeechToText, LanguageModel
-from fastapi.responses import HTMLResponse, StreamingResponse
+import os, asyncio, json
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
+from contextlib import asynccontextmanager
+from voice import ( TextToSpeech, SpeechToText, LiveSpeechToText, LanguageModel, pipeline_speech, http_clients,
+                AudioTooLarge, UnsupportedAudio, checked_audio_stream, iter_file, LANGUAGE_MODEL_TIERS, TTS_VOICE_TIERS,
+                negotiate_audio_format, audio_duration )
+from sessions import SqliteSessionStore, session_store_from_env
+from cache import AudioCache
+from prompt import FILLER_PHRASES
+from metrics import REGISTRY, STAGE_SECONDS, TTS_FIRST_BYTE_SECONDS, LLM_PROMPT_TOKENS, TurnTrace
+from vad import VoiceActivityDetector, trim_wav_stream, wait_for_speech
+from scheduler import SCHEDULERS, UpstreamError
+from speculation import Speculator, ScratchConversation
+from context import ContextBudget
+from routing import Router, ROUTERS
+from recorder import TurnRecorder, AudioTap
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse, JSONResponse, Response
 
 load_dotenv()
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-
-TTS = TextToSpeech()
-STT = SpeechToText()
-LLM = LanguageModel()
-
 audio_dir = 'audio'
 if not os.path.exists(audio_dir):
     os.makedirs(audio_dir)
 
-def iterfile(stream_file):
-    with open(stream_file, mode='rb') as file_like:
-        yield from file_like
+TTS_CACHE = AudioCache.from_env(disk_dir=os.path.join(audio_dir, 'tts-cache'))
+TTS_CACHE_PREWARM = os.getenv("TTS_CACHE_PREWARM", "true").lower() in ("1", "true", "yes")
+
+# Every turn's audio, text and timings, written in the background for QA. Off by
+# default: while on, each upload and live socket holds up to RECORD_MAX_AUDIO_BYTES
+# of audio per direction in memory until its turn is recorded.
+RECORD_TURNS = os.getenv("RECORD_TURNS", "false").lower() in ("1", "true", "yes")
+RECORD_MAX_AUDIO_BYTES = int(os.getenv("RECORD_MAX_AUDIO_BYTES", 4_000_000))  # per direction, per turn
+RECORDER = TurnRecorder.from_env(os.path.join(audio_dir, 'recordings'))
+
+# The configured model/voice is tried first; the rest of its tier is the fallback.
+# Voices only change when one fails, so a conversation keeps the same voice.
+LLM_MODEL = os.getenv("LLM_MODEL", "meta-llama/Llama-3-8b-chat-hf")
+TTS_VOICE = os.getenv("TTS_VOICE", "aura-asteria-en")
+LLM_ROUTER = Router.from_env("llm", [LLM_MODEL] + LANGUAGE_MODEL_TIERS.get(os.getenv("LLM_TIER", "small"), []))
+TTS_ROUTER = Router.from_env("tts", [TTS_VOICE] + TTS_VOICE_TIERS.get(os.getenv("TTS_VOICE_TIER", ""), []),
+                             switch_ratio=float("inf"), explore=0)
+
+TTS = TextToSpeech(
+    TTS_VOICE,
+    router=TTS_ROUTER,
+    cache=TTS_CACHE,
+    deadline=float(os.getenv("TTS_DEADLINE", 10)),
+    hedge=os.getenv("TTS_HEDGE", "true").lower() in ("1", "true", "yes"),
+    hedge_max_chars=int(os.getenv("TTS_HEDGE_MAX_CHARS", 80)),
+)
+STT = SpeechToText()
+CONTEXT = ContextBudget.from_env()
+LLM = LanguageModel(LLM_MODEL, router=LLM_ROUTER, context=CONTEXT,
+                    summary_max_tokens=int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", 256)))
+# Shared between worker processes with SESSION_BACKEND=sqlite (the default when WEB_CONCURRENCY > 1)
+SESSIONS = session_store_from_env(os.path.join(audio_dir, 'sessions.db'))
+
+SESSION_COOKIE = "session_id"
+SESSION_HEADER = "X-Session-Id"
+# Sent with the next turn by a client that stopped playing a reply early: how many seconds of it were played
+PLAYED_HEADER = "X-Played-Seconds"
+
+STARTUP_CONNECTIONS = int(os.getenv("STARTUP_CONNECTIONS", 2))
+STARTUP_WARMUP_REQUESTS = os.getenv("STARTUP_WARMUP_REQUESTS", "false").lower() in ("1", "true", "yes")
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", 15))
+# Only needed once a live (WebSocket) session starts, and slow to import
+STARTUP_PRELOAD = ["deepgram"]
+
+
+async def warm_up():
+    """Get upstream connections and lazily imported modules ready, then report ready.
+
+    DNS lookups, pooled connections and the optional warm-up requests
+    (STARTUP_WARMUP_REQUESTS) run while the slow imports load in a thread.
+    The server is already listening meanwhile; /ready says when it is done.
+    """
+    upstreams = [STT.base_url, TTS.base_url, LLM.base_url]
+
+    async def connect():
+        await READINESS.run("dns", http_clients.resolve(upstreams))
+        await READINESS.run("connections", http_clients.warm(upstreams, STARTUP_CONNECTIONS))
+        if STARTUP_WARMUP_REQUESTS:
+            await asyncio.gather(READINESS.run("deepgram", STT.warm()), READINESS.run("together", LLM.warm()))
+
+    try:
+        await asyncio.wait_for(asyncio.gather(connect(), READINESS.run("imports", preload(STARTUP_PRELOAD))), STARTUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Startup warm-up did not finish within {STARTUP_TIMEOUT}s, reporting ready anyway")
+    READINESS.mark_ready()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async def start():
+        await warm_up()
+        # Fill the TTS cache with the filler phrases over the warm connections; readiness doesn't wait on it
+        if TTS_CACHE_PREWARM:
+            await TTS_CACHE.warm(FILLER_PHRASES, TTS)
+
+    starting = asyncio.create_task(start())
+    if RECORD_TURNS:
+        RECORDER.start()
+    yield
+    starting.cancel()
+    await RECORDER.aclose()
+    await CONTEXT.aclose()
+    await http_clients.aclose()
+
+REGISTRY.gauge("voice_live_sessions", "Conversations currently held in the session store.", lambda: len(SESSIONS))
+REGISTRY.gauge("voice_session_bytes", "Bytes of conversation history held in the session store.", lambda: SESSIONS.total_bytes)
+if isinstance(SESSIONS, SqliteSessionStore):
+    REGISTRY.gauge("voice_session_conflicts", "Session saves by this process that lost a race with another worker.",
+                   lambda: SESSIONS.conflicts)
+REGISTRY.gauge("voice_tts_cache_hits", "TTS cache hits since startup.", lambda: TTS_CACHE.hits + TTS_CACHE.disk_hits)
+REGISTRY.gauge("voice_tts_cache_misses", "TTS cache misses since startup.", lambda: TTS_CACHE.misses)
+REGISTRY.gauge("voice_recorder_queue_depth", "Turns waiting to be written by the recorder.", lambda: len(RECORDER))
+REGISTRY.gauge("voice_recorder_queue_bytes", "Audio bytes waiting to be written by the recorder.", lambda: RECORDER.queued_bytes)
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
+templates = Jinja2Templates(directory="templates")
+
+TTS_MAX_IN_FLIGHT = int(os.getenv("TTS_MAX_IN_FLIGHT", 3))
+BARGE_IN_REPORT_TIMEOUT = float(os.getenv("BARGE_IN_REPORT_TIMEOUT", 0.5))
+STT_MAX_UPLOAD_BYTES = int(os.getenv("STT_MAX_UPLOAD_BYTES", 25_000_000))
+STT_CHUNK_BYTES = int(os.getenv("STT_CHUNK_BYTES", 64 * 1024))
+VAD_ENABLED = os.getenv("VAD_ENABLED", "true").lower() in ("1", "true", "yes")
+SPECULATIVE_LLM = os.getenv("SPECULATIVE_LLM", "false").lower() in ("1", "true", "yes")
+
+def audio_tap(**kwargs) -> Optional[AudioTap]:
+    return AudioTap(RECORD_MAX_AUDIO_BYTES, **kwargs) if RECORD_TURNS else None
+
+
+async def record_turn(trace: TurnTrace, outcome: str, conversation, transcript: str, reply: List[str], spoken: List[str],
+                      heard: Optional[AudioTap], said: Optional[AudioTap]):
+    """Hand a finished turn to the recorder; with the default policy this never waits."""
+    if heard is None or said is None:
+        return
+    turn = {
+        "session": conversation.session_id,
+        "path": trace.path,
+        "outcome": outcome,
+        "transcript": transcript,
+        "reply": " ".join(reply),
+        "spoken": " ".join(spoken),
+        "timings": trace.summary(),
+        "input": {"media_type": heard.media_type, "truncated": heard.truncated},
+        "output": {"media_type": said.media_type, "truncated": said.truncated},
+    }
+    await RECORDER.record(turn, heard.take(), said.take())
+
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
+async def upload_stream(request: Request):
+    """Return the uploaded audio as an async byte iterator, plus its content type.
+
+    Raw audio bodies are streamed straight from the socket. Multipart forms
+    (the older client) are still accepted, but are spooled by Starlette first.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length is not None and not content_length.strip().isdigit():
+        raise HTTPException(status_code=400, detail=f"Invalid Content-Length {content_length}")
+    if content_length and int(content_length) > STT_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Audio is larger than {STT_MAX_UPLOAD_BYTES} bytes")
+
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("audio_file")
+        if not hasattr(upload, "file"):
+            raise HTTPException(status_code=422, detail="Missing audio_file")
+        return iter_file(upload.file, STT_CHUNK_BYTES), upload.content_type or "audio/*"
+
+    if content_type.startswith("audio/"):
+        return request.stream(), content_type
+    if content_type in ("", "application/octet-stream"):
+        return request.stream(), "audio/*"
+    raise HTTPException(status_code=415, detail=f"Unsupported content type {content_type}")
+
+
 @app.post("/process_audio", response_class=StreamingResponse)
-async def process_audio(audio_file: UploadFile = File(...)):
-        
-    transcript = await STT.listen(audio_file.file)
-    async for response in LLM.respond(transcript):
-        print(response, end="", flush=True)
-    output_audio_path = await TTS.speak(response)
+async def process_audio(request: Request):
+    """One voice turn over HTTP: audio in, the spoken reply streamed back.
+
+    The reply encoding is chosen from the `encoding`, `sample_rate` and
+    `container` query parameters (e.g. `?encoding=linear16&sample_rate=24000`),
+    else from the Accept header (audio/mpeg, audio/ogg, audio/wav), else mp3.
+    """
+    trace = TurnTrace("http")
+    try:
+        audio_format = negotiate_audio_format(
+            request.query_params.get("encoding"), request.query_params.get("sample_rate"),
+            request.query_params.get("container"), request.headers.get("accept"),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    played = request.headers.get(PLAYED_HEADER)
+    try:
+        seconds = float(played) if played is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {PLAYED_HEADER} header: {played}")
+
+    # Reject a bad upload before the session is loaded (or created)
+    chunks, content_type = await upload_stream(request)
+    try:
+        audio = await checked_audio_stream(chunks, STT_MAX_UPLOAD_BYTES)
+    except UnsupportedAudio as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+    session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    conversation = SESSIONS.get(session_id)
+    # The reply is usually sent well before it has been played, so trim it to what was heard
+    if seconds is not None and conversation.record_played(seconds):
+        SESSIONS.touch(conversation)
+
+    heard = audio_tap(media_type=content_type)
+    try:
+        if heard is not None:
+            audio = heard.tee(audio)
+        params, vad = None, None
+        if VAD_ENABLED:
+            # Linear16 WAV uploads are trimmed to speech; compressed audio passes through
+            audio, params, vad = await trim_wav_stream(audio)
+            if vad is not None:
+                # Only silence: Deepgram rejects an empty body, so don't call it at all
+                audio = await wait_for_speech(audio)
+        transcript = await STT.listen(audio, "audio/l16" if params else content_type, params) if audio is not None else ""
+    except AudioTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedAudio as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except UpstreamError as e:
+        headers = {"Retry-After": str(max(1, round(e.retry_after)))} if e.retry_after else None
+        raise HTTPException(status_code=503, detail=f"Transcription unavailable: {e}", headers=headers)
+    trace.mark("stt_done")
+    if not transcript.strip():
+        # Nothing was said: no reply, and nothing added to the history
+        trace.finish("no_speech")
+        response = Response(status_code=204)
+        response.headers[SESSION_HEADER] = conversation.session_id
+        response.set_cookie(SESSION_COOKIE, conversation.session_id, httponly=True, samesite="lax")
+        return response
+
+    reply = []
+
+    async def sentences():
+        async for response in LLM.respond(transcript, conversation, trace=trace):
+            trace.mark("first_sentence")
+            reply.append(response)
+            yield response
+        SESSIONS.touch(conversation)
+
+    async def audio_stream():
+        # If the client hangs up mid-reply (barge-in), stop generating and
+        # keep only the sentences whose audio was already sent
+        spoken = []
+        said = audio_tap(media_type=audio_format.media_type)
+        speech = pipeline_speech(sentences(), TTS, max_in_flight=TTS_MAX_IN_FLIGHT, spoken=spoken, trace=trace,
+                                 format=audio_format)
+        # Sent with the first audio, so the first byte out is Deepgram's first byte
+        header = audio_format.header()
+        outcome = "interrupted"
+        # Playback time at which each sentence starts, for a later PLAYED_HEADER report
+        starts, elapsed, sentence_audio = [], 0.0, []
+        try:
+            async for audio in speech:
+                trace.mark("first_audio_sent")
+                if len(spoken) > len(starts):
+                    if sentence_audio:
+                        elapsed += audio_duration(b"".join(sentence_audio), audio_format) or 0.0
+                    sentence_audio = []
+                    starts += [elapsed] * (len(spoken) - len(starts))
+                sentence_audio.append(audio)
+                yield header + audio
+                if said is not None:
+                    said.add(header + audio)
+                header = b""
+            outcome = "completed"
+        except UpstreamError as e:
+            # Headers are already sent, so end the reply early rather than fail silently
+            print(f"Upstream error while replying: {e}")
+            outcome = "failed"
+        finally:
+            await speech.aclose()
+            if outcome != "completed":
+                conversation.record_interrupted_reply(" ".join(spoken))
+            if spoken:
+                conversation.set_reply_timeline(spoken, starts)
+            SESSIONS.touch(conversation)
+            trace.finish(outcome)
+            CONTEXT.schedule(conversation, LLM.summarize, SESSIONS.touch)
+            await record_turn(trace, outcome, conversation, transcript, reply, spoken, heard, said)
+
+    streaming_response = StreamingResponse(audio_stream(), media_type=audio_format.media_type)
+    streaming_response.headers[SESSION_HEADER] = conversation.session_id
+    if vad is not None:
+        streaming_response.headers["X-Speech-Segments"] = ",".join(f"{start:.2f}-{end:.2f}" for start, end in vad.segments)
+    streaming_response.set_cookie(SESSION_COOKIE, conversation.session_id, httponly=True, samesite="lax")
+    return streaming_response
+
+
+class TurnState:
+    """The reply currently being generated or played on a voice socket."""
+    def __init__(self) -> None:
+        self.task: Optional[asyncio.Task] = None
+        self.spoken: List[str] = []
+        self.playing = False
+        self.played: Optional[asyncio.Future] = None
+        self.settling: Optional[asyncio.Task] = None
+        self.heard: Optional[AudioTap] = None     # mic audio since the last utterance, for the recorder
+
+
+async def speak_turn(websocket: WebSocket, conversation, transcript: str, spoken: List[str], speculation=None,
+                     audio_format=None, heard: Optional[AudioTap] = None):
+    trace = TurnTrace("ws", start_stage="stt_done")
+    await websocket.send_json({"type": "transcript", "text": transcript})
+    reply = []
+
+    async def sentences():
+        if speculation is not None:
+            # Started on the interim transcript; keep its history, timings and output
+            speculation.commit(trace)
+            replies = speculation.replay()
+        else:
+            replies = LLM.respond(transcript, conversation, trace=trace)
+        async for response in replies:
+            trace.mark("first_sentence")
+            reply.append(response)
+            await websocket.send_json({"type": "response", "text": response})
+            yield response
+        SESSIONS.touch(conversation)
+
+    completed = False
+    try:
+        audio_format = audio_format or TTS.format
+        said = audio_tap(media_type=audio_format.media_type)
+        index = -1
+        async for audio in pipeline_speech(sentences(), TTS, max_in_flight=TTS_MAX_IN_FLIGHT, spoken=spoken, trace=trace,
+                                           format=audio_format):
+            if index != len(spoken) - 1:
+                # A new sentence: announce it, then stream its audio as binary messages
+                index = len(spoken) - 1
+                await websocket.send_json({"type": "audio", "index": index, "encoding": audio_format.encoding,
+                                           "sample_rate": audio_format.sample_rate})
+            await websocket.send_bytes(audio)
+            trace.mark("first_audio_sent")
+            if said is not None:
+                said.add(audio)
+        await websocket.send_json({"type": "turn_end"})
+        completed = True
+    finally:
+        if speculation is not None:
+            speculation.task.cancel()
+        outcome = "completed" if completed else "interrupted"
+        trace.finish(outcome)
+        CONTEXT.schedule(conversation, LLM.summarize, SESSIONS.touch)
+        await record_turn(trace, outcome, conversation, transcript, reply, spoken, heard, said)
+
+
+@app.websocket("/ws")
+async def voice_socket(websocket: WebSocket):
+    """Full-duplex voice: linear16 mic frames in, the spoken reply streamed out.
+
+    Each sentence of the reply starts with an "audio" message naming its
+    index and encoding, followed by its audio as binary messages as it
+    arrives from TTS. The encoding is chosen with the `output_encoding` and
+    `output_sample_rate` query parameters (default mp3); linear16 is sent as
+    raw PCM, so each binary message can be played as soon as it arrives.
+
+    When the user starts speaking while a reply is being generated or played,
+    the reply is cancelled, the client is told to stop playback, and only the
+    sentences the client reports as played are kept in the history.
+    """
+    await websocket.accept()
+    try:
+        audio_format = negotiate_audio_format(
+            websocket.query_params.get("output_encoding"), websocket.query_params.get("output_sample_rate"), "none",
+        )
+    except ValueError as e:
+        await websocket.close(code=1003, reason=str(e))
+        return
+    sample_rate = websocket.query_params.get("sample_rate", "16000")
+    if not sample_rate.isdigit() or not 8000 <= int(sample_rate) <= 48000:
+        await websocket.close(code=1003, reason=f"Unsupported sample_rate {sample_rate}, expected 8000 to 48000")
+        return
+    sample_rate = int(sample_rate)
+    session_id = websocket.query_params.get("session_id") or websocket.cookies.get(SESSION_COOKIE)
+    conversation = SESSIONS.get(session_id)
+    state = TurnState()
+    state.heard = audio_tap(keep_last=True, media_type=f"audio/L16;rate={sample_rate};channels=1")
+
+    async def settle(task, spoken, played):
+        if task is not None:
+            await asyncio.wait([task])
+        try:
+            count = await asyncio.wait_for(played, BARGE_IN_REPORT_TIMEOUT)
+        except asyncio.TimeoutError:
+            count = len(spoken)
+        conversation.record_interrupted_reply(" ".join(spoken[:count]))
+        SESSIONS.touch(conversation)
+
+    async def barge_in(_):
+        if not state.playing:
+            return
+        state.playing = False
+        state.played = asyncio.get_running_loop().create_future()
+        if state.task is not None:
+            state.task.cancel()
+        state.settling = asyncio.create_task(settle(state.task, state.spoken, state.played))
+        await websocket.send_json({"type": "interrupt"})
+
+    utterances = asyncio.Queue()
+    async def report_vad(event):
+        await websocket.send_json({"type": "vad", "event": event.kind, "time": round(event.time, 3)})
+
+    def speculate(text, trace):
+        scratch = ScratchConversation(conversation)
+        return LLM.respond(text, scratch, trace=trace), scratch
+
+    speculator = Speculator(speculate) if SPECULATIVE_LLM else None
+
+    async def on_partial(text, segment_final):
+        # Only while idle, so the history the speculation sees is the one the turn will use
+        if speculator is not None and not state.playing and (state.settling is None or state.settling.done()):
+            speculator.observe(text, segment_final)
+
+    vad = VoiceActivityDetector.from_env(sample_rate) if VAD_ENABLED else None
+    live = LiveSpeechToText(sample_rate=sample_rate, vad=vad)
+    if not await live.start(utterances.put, on_speech=barge_in, on_vad=report_vad, on_partial=on_partial):
+        await websocket.close(code=1011, reason="Could not open transcription stream")
+        return
+    await websocket.send_json({"type": "session", "session_id": conversation.session_id})
+
+    async def run_turns():
+        while True:
+            transcript = await utterances.get()
+            if state.settling is not None:
+                await state.settling
+            state.spoken, state.played, state.settling, state.playing = [], None, None, True
+            speculation = speculator.take(transcript) if speculator is not None else None
+            heard = state.heard
+            if heard is not None:
+                state.heard = audio_tap(keep_last=True, media_type=heard.media_type)
+            state.task = asyncio.create_task(speak_turn(websocket, conversation, transcript, state.spoken, speculation,
+                                                        audio_format, heard))
+            await asyncio.wait([state.task])
+            if state.task.cancelled():
+                continue
+            if not state.spoken:
+                state.playing = False
+            error = state.task.exception()
+            if isinstance(error, (WebSocketDisconnect, RuntimeError)):
+                return
+            if error is not None:
+                print(f"Exception in voice_socket turn: {error}")
+                await websocket.send_json({"type": "error", "message": "Could not generate a response"})
+
+    turns = asyncio.create_task(run_turns())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes"):
+                await live.send(message["bytes"])
+                if state.heard is not None:
+                    state.heard.add(message["bytes"])
+            elif message.get("text"):
+                try:
+                    event = json.loads(message["text"])
+                    kind = event.get("type")
+                    count = int(event.get("count", 0)) if kind == "played" else 0
+                except (ValueError, TypeError, AttributeError):
+                    # A bad control message is dropped rather than ending the session
+                    print(f"Ignoring malformed control message: {message['text'][:200]!r}")
+                    continue
+                if kind == "played" and state.played is not None and not state.played.done():
+                    state.played.set_result(count)
+                elif kind == "playback_end" and state.task is not None and state.task.done():
+                    state.playing = False
+    except WebSocketDisconnect:
+        pass
+    finally:
+        turns.cancel()
+        if state.task is not None:
+            state.task.cancel()
+        if speculator is not None:
+            speculator.cancel()
+        await live.finish()
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 503 until startup warm-up has finished, with per-step timings."""
+    return JSONResponse(READINESS.status(), status_code=200 if READINESS.ready else 503)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/latency")
+async def latency_summary():
+    return {
+        "stages": STAGE_SECONDS.summary(),
+        "tts_first_byte": TTS_FIRST_BYTE_SECONDS.summary(),
+        "prompt_tokens": LLM_PROMPT_TOKENS.summary(),
+    }
+
+
+@app.get("/sessions/stats")
+async def session_stats():
+    return SESSIONS.stats()
+
+
+@app.get("/tts/cache/stats")
+async def tts_cache_stats():
+    return TTS_CACHE.stats()
+
+
+@app.get("/upstream/stats")
+async def upstream_stats():
+    return {name: scheduler.stats() for name, scheduler in SCHEDULERS.items()}
+
 
-    return StreamingResponse(iterfile(output_audio_path), media_type='audio/*')
+@app.get("/routing/scoreboard")
+async def routing_scoreboard():
+    return {name: router.scoreboard() for name, router in ROUTERS.items()}
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import uvicorn
+    # Each worker process has its own upstream connections, caches and metrics;
+    # only conversations are shared between them (see sessions.SqliteSessionStore)
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    if workers > 1:
+        if not isinstance(SESSIONS, SqliteSessionStore):
+            print("Running several workers with in-memory sessions: each worker only sees its own turns")
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
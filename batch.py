@@ -0,0 +1,286 @@
+"""Batch speech-to-text and text-to-speech with a bounded concurrency window.
+
+    python batch.py stt recordings/ --out transcripts.jsonl --concurrency 32
+    python batch.py stt calls.jsonl --out transcripts.jsonl --param diarize=true
+    python batch.py tts prompts.txt --out-dir prompt-audio/ --encoding linear16 --sample-rate 16000
+
+Input is a directory (every audio file under it), a text file (one audio
+path, or one line of text to speak, per line) or a JSONL manifest of
+{"id": ..., "path": ...} / {"id": ..., "text": ...} objects. Each result is
+appended to a JSONL file as soon as it is ready (for TTS, an index next to
+the audio files), and a rerun skips every item already recorded there
+without an error, so an interrupted job picks up where it stopped.
+"""
+import os, re, json, time, struct, hashlib, asyncio, argparse, mimetypes
+from typing import Optional, Dict, List, Set, NamedTuple
+
+from scheduler import ProviderScheduler, UpstreamError
+from voice import HTTPClients, SpeechToText, TextToSpeech, AudioFormat, negotiate_audio_format, audio_duration
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".ogg", ".opus", ".webm", ".flac", ".m4a", ".mp4", ".aac")
+
+FILE_EXTENSIONS = {"mp3": "mp3", "opus": "ogg", "linear16": "wav"}
+
+
+class BatchItem(NamedTuple):
+    id: str
+    source: str     # an audio file for STT, the text to speak for TTS
+
+
+def read_items(source: str, kind: str) -> List[BatchItem]:
+    """Items from a directory, a text file or a JSONL manifest; `kind` is "stt" or "tts".
+
+    Without an explicit id, an audio file is identified by its path and a
+    line of text by a hash of it, so reruns line up with earlier results.
+    """
+    items: Dict[str, BatchItem] = {}
+    if os.path.isdir(source):
+        if kind != "stt":
+            raise ValueError("A directory can only be used as input for stt")
+        for root, _, files in sorted(os.walk(source)):
+            for name in sorted(files):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    items.setdefault(os.path.relpath(path, source), BatchItem(os.path.relpath(path, source), path))
+        return list(items.values())
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line) if line.startswith("{") else {}
+            value = entry.get("path" if kind == "stt" else "text", line if not entry else None)
+            if not value:
+                raise ValueError(f"{source}:{number}: expected a {'path' if kind == 'stt' else 'text'} field")
+            if kind == "stt":
+                default_id = value
+                value = value if os.path.isabs(value) else os.path.join(base, value)
+            else:
+                default_id = hashlib.sha1(value.encode("utf-8")).hexdigest()[:16]
+            item_id = str(entry.get("id") or default_id)
+            items.setdefault(item_id, BatchItem(item_id, value))
+    return list(items.values())
+
+
+def finished_ids(path: str, exists=None) -> Set[str]:
+    """Ids recorded in the JSONL file at `path` without an error (and, with `exists`, whose output is still there)."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short when the last run was killed
+            if "error" not in entry and (exists is None or exists(entry)):
+                done.add(entry["id"])
+    return done
+
+
+class BatchReport:
+    """Progress and throughput of a batch run."""
+
+    def __init__(self, total: int, skipped: int) -> None:
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+        self.started = time.perf_counter()
+
+    def add(self, result: Dict[str, object]):
+        if "error" in result:
+            self.failed += 1
+            return
+        self.done += 1
+        self.audio_seconds += result.get("audio_seconds") or 0.0
+
+    def stats(self) -> Dict[str, float]:
+        elapsed = max(1e-9, time.perf_counter() - self.started)
+        return {
+            "items": self.total,
+            "skipped": self.skipped,
+            "done": self.done,
+            "failed": self.failed,
+            "seconds": round(elapsed, 1),
+            "items_per_sec": round((self.done + self.failed) / elapsed, 2),
+            "audio_seconds": round(self.audio_seconds, 1),
+            "audio_seconds_per_sec": round(self.audio_seconds / elapsed, 1),
+        }
+
+    def line(self) -> str:
+        stats = self.stats()
+        return (f"{self.skipped + self.done + self.failed}/{self.total} items ({self.failed} failed), "
+                f"{stats['items_per_sec']} items/s, {stats['audio_seconds_per_sec']} audio-s/s")
+
+
+async def run_batch(items: List[BatchItem], work, out_path: str, concurrency: int = 8, attempts: int = 3,
+                    progress_every: Optional[float] = 10.0, exists=None) -> BatchReport:
+    """Run `work(item)` over `items`, at most `concurrency` at a time, appending each result to `out_path`.
+
+    `work` returns a dict for the JSONL line (the id is added). Items already
+    recorded without an error are skipped. A call rejected with a
+    `Retry-After` (queue full, circuit open, rate limited) waits that long
+    and is tried up to `attempts` times; any other failure is recorded as an
+    `error` line and retried by the next run.
+    """
+    done = finished_ids(out_path, exists)
+    todo = iter([item for item in items if item.id not in done])
+    report = BatchReport(len(items), sum(1 for item in items if item.id in done))
+
+    async def attempt(item: BatchItem) -> Dict[str, object]:
+        start = time.perf_counter()
+        for tries in range(1, attempts + 1):
+            try:
+                result = await work(item)
+                break
+            except UpstreamError as e:
+                if tries == attempts or not e.retry_after:
+                    return {"id": item.id, "error": str(e)}
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                return {"id": item.id, "error": str(e) or type(e).__name__}
+        return {"id": item.id, **result, "seconds": round(time.perf_counter() - start, 3)}
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "a", encoding="utf-8") as out:
+        async def worker():
+            # Workers share one iterator, so exactly `concurrency` items are in flight
+            for item in todo:
+                result = await attempt(item)
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                report.add(result)
+
+        async def progress():
+            while True:
+                await asyncio.sleep(progress_every)
+                print(report.line(), flush=True)
+
+        reporter = asyncio.create_task(progress()) if progress_every else None
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+    return report
+
+
+def batch_clients(concurrency: int, deadline: float) -> HTTPClients:
+    # Enough pooled connections for the whole window, and read timeouts as long as a call may take
+    return HTTPClients(max_connections=concurrency, max_keepalive_connections=concurrency, timeout=deadline)
+
+
+def batch_scheduler(provider: str, concurrency: int, deadline: float) -> ProviderScheduler:
+    # Sized to the window instead of sharing the live service's admission queue
+    return ProviderScheduler(f"batch-{provider}", max_concurrency=concurrency, max_queue=concurrency, deadline=deadline)
+
+
+async def transcribe_batch(items: List[BatchItem], out_path: str, concurrency: int = 8, params: Optional[dict] = None,
+                           stt: Optional[SpeechToText] = None, deadline: float = 600.0, **kwargs) -> BatchReport:
+    """Transcribe audio files, writing {"id", "path", "transcript", "confidence", "audio_seconds"} lines."""
+    stt = stt or SpeechToText(clients=batch_clients(concurrency, deadline),
+                              scheduler=batch_scheduler("deepgram", concurrency, deadline))
+
+    async def work(item: BatchItem):
+        content_type = mimetypes.guess_type(item.source)[0] or "audio/*"
+        with open(item.source, "rb") as f:
+            response = await stt.transcribe(f, content_type, params, deadline=deadline)
+        alternative = response['results']['channels'][0]['alternatives'][0]
+        return {
+            "path": item.source,
+            "transcript": alternative['transcript'],
+            "confidence": alternative.get('confidence'),
+            "audio_seconds": (response.get('metadata') or {}).get('duration'),
+        }
+
+    try:
+        return await run_batch(items, work, out_path, concurrency, **kwargs)
+    finally:
+        await stt.clients.aclose()
+
+
+def _finish_wav(path: str, data_bytes: int):
+    """Replace the open-ended sizes of a streamed WAV header with the real ones."""
+    with open(path, "r+b") as f:
+        f.seek(4)
+        f.write(struct.pack("<I", 36 + data_bytes))
+        f.seek(40)
+        f.write(struct.pack("<I", data_bytes))
+
+
+async def synthesize_batch(items: List[BatchItem], out_dir: str, format: Optional[AudioFormat] = None,
+                           concurrency: int = 8, tts: Optional[TextToSpeech] = None, voice: str = "aura-asteria-en",
+                           index_path: Optional[str] = None, deadline: float = 120.0, **kwargs) -> BatchReport:
+    """Render each line of text to `<out_dir>/<id>.<ext>`, indexed in `index_path` (default `<out_dir>/index.jsonl`)."""
+    format = format or negotiate_audio_format()
+    tts = tts or TextToSpeech(voice, clients=batch_clients(concurrency, deadline), hedge=False,
+                              scheduler=batch_scheduler("deepgram", concurrency, deadline), deadline=deadline)
+    extension = FILE_EXTENSIONS[format.encoding] if format.container != "none" else "pcm"
+    os.makedirs(out_dir, exist_ok=True)
+
+    async def work(item: BatchItem):
+        name = re.sub(r"[^\w.-]", "_", item.id) + f".{extension}"
+        path = os.path.join(out_dir, name)
+        partial = f"{path}.part"
+        size = 0
+        try:
+            with open(partial, "wb") as f:
+                f.write(format.header())
+                async for chunk in tts.stream(item.source, format):
+                    f.write(chunk)
+                    size += len(chunk)
+            if not size:
+                raise RuntimeError("No audio was synthesized")
+            if format.container == "wav":
+                _finish_wav(partial, size)
+            with open(partial, "rb") as f:
+                seconds = audio_duration(f.read(), format)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        return {"text": item.source, "file": name, "bytes": size, "audio_seconds": round(seconds, 3) if seconds else None}
+
+    try:
+        return await run_batch(items, work, index_path or os.path.join(out_dir, "index.jsonl"), concurrency,
+                               exists=lambda entry: os.path.exists(os.path.join(out_dir, entry["file"])), **kwargs)
+    finally:
+        await tts.clients.aclose()
+
+
+async def main(args):
+    items = read_items(args.input, args.kind)
+    print(f"{len(items)} items from {args.input}")
+    options = dict(concurrency=args.concurrency, attempts=args.attempts, progress_every=args.progress_every)
+    if args.deadline:
+        options["deadline"] = args.deadline
+    if args.kind == "stt":
+        params = dict(param.split("=", 1) for param in args.param)
+        report = await transcribe_batch(items, args.out or "transcripts.jsonl", params=params, **options)
+    else:
+        format = negotiate_audio_format(args.encoding, args.sample_rate, args.container)
+        report = await synthesize_batch(items, args.out_dir, format, voice=args.voice, index_path=args.out, **options)
+    print(report.line())
+    print(json.dumps(report.stats()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=["stt", "tts"])
+    parser.add_argument("input", help="directory of audio files, text file or JSONL manifest")
+    parser.add_argument("--out", help="JSONL results (stt: transcripts.jsonl, tts: <out-dir>/index.jsonl)")
+    parser.add_argument("--out-dir", default="tts-batch", help="where synthesized audio is written")
+    parser.add_argument("--concurrency", type=int, default=8, help="items in flight at once")
+    parser.add_argument("--attempts", type=int, default=3, help="tries per item when the provider asks to back off")
+    parser.add_argument("--deadline", type=float, help="seconds allowed per request (stt: 600, tts: 120)")
+    parser.add_argument("--progress-every", type=float, default=10.0, help="seconds between progress lines")
+    parser.add_argument("--param", action="append", default=[], help="extra Deepgram listen parameter, key=value")
+    parser.add_argument("--voice", default="aura-asteria-en")
+    parser.add_argument("--encoding", default="mp3", choices=["mp3", "opus", "linear16"])
+    parser.add_argument("--sample-rate", type=int)
+    parser.add_argument("--container", choices=["wav", "none"], help="linear16 only: WAV files or raw PCM")
+    asyncio.run(main(parser.parse_args()))
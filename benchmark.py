@@ -0,0 +1,315 @@
+"""Offline latency benchmark against local Deepgram and Together stand-ins.
+
+    python benchmark.py --concurrency 8 --requests 64
+    python benchmark.py --mode app --concurrency 32 --turns 4 --llm-ttft-ms 400
+    python benchmark.py --mode startup --runs 5 --warmup-requests
+    python benchmark.py --mode workers --workers 1,2,4 --concurrency 64 --turns 4
+
+Nothing leaves the machine: the upstream URLs are pointed at `mocks.py`
+before `voice`/`app` are imported, so results only reflect this code and
+the configured mock latencies.
+"""
+import io, os, sys, json, time, socket, sqlite3, asyncio, argparse, resource, tempfile
+from typing import Dict, List
+
+import httpx
+from mocks import MockConfig, MockServer, create_mock_app, make_wav
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 1),
+        "p50_ms": round(1000 * pick(0.50), 1),
+        "p90_ms": round(1000 * pick(0.90), 1),
+        "p99_ms": round(1000 * pick(0.99), 1),
+        "max_ms": round(1000 * ordered[-1], 1),
+    }
+
+
+async def run_concurrently(job, total: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(i):
+        async with semaphore:
+            await job(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(total)))
+    return time.perf_counter() - start
+
+
+async def bench_components(args, wav: bytes) -> Dict[str, dict]:
+    from voice import SpeechToText, TextToSpeech, LanguageModel, http_clients
+    from sessions import Conversation
+
+    stt, tts, llm = SpeechToText(), TextToSpeech(), LanguageModel()
+    results = {}
+
+    latencies = []
+    async def listen(_):
+        start = time.perf_counter()
+        await stt.listen(io.BytesIO(wav))
+        latencies.append(time.perf_counter() - start)
+    elapsed = await run_concurrently(listen, args.requests, args.concurrency)
+    results["stt"] = {**percentiles(latencies), "per_sec": round(args.requests / elapsed, 1)}
+
+    first_chunk, totals = [], []
+    async def respond(i):
+        start = time.perf_counter()
+        first = None
+        async for _ in llm.respond("Tell me about the ocean.", Conversation(f"bench-{i}")):
+            first = first or time.perf_counter() - start
+        first_chunk.append(first or 0.0)
+        totals.append(time.perf_counter() - start)
+    elapsed = await run_concurrently(respond, args.requests, args.concurrency)
+    results["llm_first_sentence"] = percentiles(first_chunk)
+    results["llm_total"] = {**percentiles(totals), "per_sec": round(args.requests / elapsed, 1)}
+
+    first_byte, latencies = [], []
+    async def speak(i):
+        start = time.perf_counter()
+        first = None
+        async for _ in tts.stream(f"This is benchmark sentence number {i}."):
+            first = first or time.perf_counter() - start
+        first_byte.append(first or 0.0)
+        latencies.append(time.perf_counter() - start)
+    elapsed = await run_concurrently(speak, args.requests, args.concurrency)
+    results["tts_first_byte"] = percentiles(first_byte)
+    results["tts"] = {**percentiles(latencies), "per_sec": round(args.requests / elapsed, 1)}
+
+    await http_clients.aclose()
+    return results
+
+
+async def run_sessions(args, wav: bytes, url: str):
+    """`args.concurrency` sessions of `args.turns` turns each against the app at `url`."""
+    first_audio, totals, audio_bytes = [], [], []
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def session(_):
+            cookies = {}
+            for _ in range(args.turns):
+                start = time.perf_counter()
+                first = None
+                received = 0
+                headers = {"Content-Type": "audio/wav"}
+                params = {"encoding": args.encoding}
+                async with client.stream("POST", "/process_audio", content=wav, headers=headers, cookies=cookies,
+                                         params=params) as response:
+                    response.raise_for_status()
+                    cookies = {"session_id": response.headers["x-session-id"]}
+                    async for chunk in response.aiter_bytes():
+                        first = first or time.perf_counter() - start
+                        received += len(chunk)
+                first_audio.append(first or 0.0)
+                totals.append(time.perf_counter() - start)
+                audio_bytes.append(received)
+
+        elapsed = await run_concurrently(session, args.concurrency, args.concurrency)
+    return first_audio, totals, audio_bytes, elapsed
+
+
+async def bench_app(args, wav: bytes) -> Dict[str, dict]:
+    import app as app_module
+
+    async with MockServer(app_module.app) as server:
+        first_audio, totals, audio_bytes, elapsed = await run_sessions(args, wav, server.url)
+        sessions = app_module.SESSIONS.stats()
+
+    turns = len(totals)
+    return {
+        "voice_to_first_audio": percentiles(first_audio),
+        "turn_total": percentiles(totals),
+        "throughput": {
+            "turns": turns,
+            "turns_per_sec": round(turns / elapsed, 2),
+            "audio_bytes_per_turn": int(sum(audio_bytes) / max(1, turns)),
+        },
+        "memory": {
+            "live_sessions": sessions["live_sessions"],
+            "history_bytes_per_session": int(sessions["total_bytes"] / max(1, sessions["live_sessions"])),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+    }
+
+
+async def bench_startup(args) -> Dict[str, dict]:
+    """Cold-start the app in fresh processes: import time, time until it listens and until /ready is 200."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, STARTUP_WARMUP_REQUESTS="true" if args.warmup_requests else "false")
+    imports, listening, ready = [], [], []
+    steps: Dict[str, List[float]] = {}
+
+    for _ in range(args.runs):
+        probe = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)",
+            cwd=here, env=env, stdout=asyncio.subprocess.PIPE,
+        )
+        out, _ = await probe.communicate()
+        imports.append(float(out.decode().strip().splitlines()[-1]))
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        start = time.perf_counter()
+        server = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning", cwd=here, env=env,
+        )
+        try:
+            first = None
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=5) as client:
+                while time.perf_counter() - start < 60:
+                    try:
+                        response = await client.get("/ready")
+                    except httpx.TransportError:
+                        await asyncio.sleep(0.005)
+                        continue
+                    first = first or time.perf_counter() - start
+                    if response.status_code == 200:
+                        ready.append(time.perf_counter() - start)
+                        for name, step in response.json()["steps"].items():
+                            steps.setdefault(name, []).append(step["seconds"])
+                        break
+                    await asyncio.sleep(0.005)
+            listening.append(first or 0.0)
+        finally:
+            server.terminate()
+            await server.wait()
+
+    return {
+        "import_app": percentiles(imports),
+        "process_to_listening": percentiles(listening),
+        "process_to_ready": percentiles(ready),
+        **{f"step_{name}": percentiles(values) for name, values in steps.items()},
+    }
+
+
+async def bench_workers(args, wav: bytes) -> Dict[str, dict]:
+    """Turns/sec of `uvicorn --workers N` for each N in `args.workers`, with sessions shared through SQLite.
+
+    The mock upstreams and the load generator share this one process, so
+    on a small machine they, not the app, may be what caps throughput.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for workers in [int(n) for n in args.workers.split(",")]:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        with tempfile.TemporaryDirectory() as scratch:
+            database = os.path.join(scratch, "sessions.db")
+            env = dict(os.environ, WEB_CONCURRENCY=str(workers), SESSION_BACKEND="sqlite", SESSION_DB=database,
+                       RECORD_DIR=os.path.join(scratch, "recordings"))
+            server = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--workers", str(workers),
+                "--log-level", "warning", cwd=here, env=env,
+            )
+            try:
+                url = f"http://127.0.0.1:{port}"
+                # A fresh connection per probe, so the probes reach every worker
+                ready = set()
+                async with httpx.AsyncClient(base_url=url, timeout=5, limits=httpx.Limits(max_keepalive_connections=0)) as client:
+                    deadline = time.perf_counter() + 60
+                    while len(ready) < workers and time.perf_counter() < deadline:
+                        try:
+                            response = await client.get("/ready")
+                            if response.status_code == 200:
+                                ready.add(response.json()["pid"])
+                        except httpx.TransportError:
+                            pass
+                        await asyncio.sleep(0.01)
+                first_audio, totals, _, elapsed = await run_sessions(args, wav, url)
+            finally:
+                server.terminate()
+                await server.wait()
+            with sqlite3.connect(database) as db:
+                sessions, stored, history = db.execute(
+                    "SELECT COUNT(*), AVG(LENGTH(data)), AVG(nbytes) FROM sessions"
+                ).fetchone()
+
+        first = percentiles(first_audio)
+        results[f"workers_{workers}"] = {
+            "ready": len(ready),
+            "turns_per_sec": round(len(totals) / elapsed, 2),
+            "first_audio_p50_ms": first["p50_ms"],
+            "first_audio_p90_ms": first["p90_ms"],
+            "sessions": sessions,
+            "stored_bytes_per_session": int(stored or 0),
+            "history_bytes_per_session": int(history or 0),
+        }
+    return results
+
+
+def report(results: Dict[str, Dict[str, dict]]):
+    for section, groups in results.items():
+        print(f"\n== {section} ==")
+        for name, values in groups.items():
+            fields = "  ".join(f"{key}={value}" for key, value in values.items())
+            print(f"{name:<24} {fields}")
+
+
+async def main(args):
+    config = MockConfig(
+        stt_ms=args.stt_ms,
+        tts_ttfb_ms=args.tts_ttfb_ms,
+        llm_ttft_ms=args.llm_ttft_ms,
+        llm_tokens_per_second=args.tokens_per_second,
+        reply_sentences=args.reply_sentences,
+        jitter=args.jitter,
+    )
+    wav = make_wav(args.audio_seconds)
+
+    async with MockServer(create_mock_app(config)) as upstream:
+        os.environ["DEEPGRAM_URL"] = upstream.url
+        os.environ["TOGETHER_URL"] = upstream.url
+        os.environ.setdefault("DEEPGRAM_API_KEY", "benchmark")
+        os.environ.setdefault("TOGETHER_API_KEY", "benchmark")
+        os.environ.setdefault("TTS_CACHE_PREWARM", "false")
+        os.environ.setdefault("TTS_CACHE_DISK", "false")
+        if not args.cache:
+            os.environ["TTS_CACHE_MAX_BYTES"] = "0"
+
+        results = {}
+        if args.mode in ("components", "all"):
+            results["components"] = await bench_components(args, wav)
+        if args.mode in ("app", "all"):
+            results["app"] = await bench_app(args, wav)
+        if args.mode == "startup":
+            results["startup"] = await bench_startup(args)
+        if args.mode == "workers":
+            results["workers"] = await bench_workers(args, wav)
+
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["components", "app", "startup", "workers", "all"], default="all")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel requests / sessions")
+    parser.add_argument("--requests", type=int, default=32, help="requests per component benchmark")
+    parser.add_argument("--turns", type=int, default=3, help="turns per session in the app benchmark")
+    parser.add_argument("--audio-seconds", type=float, default=2.0)
+    parser.add_argument("--stt-ms", type=float, default=150.0)
+    parser.add_argument("--tts-ttfb-ms", type=float, default=120.0)
+    parser.add_argument("--llm-ttft-ms", type=float, default=250.0)
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--reply-sentences", type=int, default=3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--encoding", choices=["mp3", "opus", "linear16"], default="mp3", help="reply audio encoding in the app benchmark")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts in the startup benchmark")
+    parser.add_argument("--workers", default="1,2,4", help="worker counts to compare in the workers benchmark")
+    parser.add_argument("--warmup-requests", action="store_true", help="send a warm-up request to each provider at startup")
+    parser.add_argument("--cache", action="store_true", help="leave the TTS cache enabled")
+    parser.add_argument("--json", help="also write results to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,189 @@
+import os, re, time, hashlib, asyncio
+from collections import OrderedDict
+from typing import Optional, Dict, List
+
+
+class AudioCache:
+    """Content-addressed cache for synthesized speech.
+
+    Entries are keyed on the normalized text, the TTS model and the output
+    encoding. Only phrases up to `max_text_length` characters are cached
+    (fillers, greetings, short acknowledgements), so ordinary reply
+    sentences are never kept. The in-memory tier is an LRU bounded by
+    `max_bytes`. When `disk_dir` is set, entries are also written there and
+    survive restarts; the directory is bounded by `max_disk_bytes`, and once
+    over it the least recently used files (by modification time, which a
+    disk hit refreshes) are deleted until it is back under 90% of the budget.
+    """
+
+    def __init__(self, max_bytes: int = 64_000_000, disk_dir: Optional[str] = None,
+                 max_text_length: int = 40, max_disk_bytes: int = 256_000_000) -> None:
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_text_length = max_text_length
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes: Optional[int] = None  # counted on the first write
+        self.disk_evictions = 0
+
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, disk_dir: Optional[str] = None) -> "AudioCache":
+        use_disk = os.getenv("TTS_CACHE_DISK", "true").lower() in ("1", "true", "yes")
+        return cls(
+            max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", 64_000_000)),
+            disk_dir=os.getenv("TTS_CACHE_DIR", disk_dir) if use_disk else None,
+            max_text_length=int(os.getenv("TTS_CACHE_MAX_TEXT_LENGTH", 40)),
+            max_disk_bytes=int(os.getenv("TTS_CACHE_MAX_DISK_BYTES", 256_000_000)),
+        )
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r"\s+", " ", text).strip().lower()
+
+    def key(self, text: str, model_name: str, encoding: str) -> str:
+        raw = "\0".join((self.normalize(text), model_name, encoding))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def cacheable(self, text: str) -> bool:
+        # Long sentences are rarely repeated, keep the budget for short phrases
+        return 0 < len(text.strip()) <= self.max_text_length
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _remember(self, key: str, audio: bytes):
+        if len(audio) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= len(previous)
+        self._entries[key] = audio
+        self.nbytes += len(audio)
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= len(evicted)
+            self.evictions += 1
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)  # keeps it off the front of the eviction order
+            return audio
+        except FileNotFoundError:
+            return None
+
+    def _disk_files(self) -> List[tuple]:
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another worker process meanwhile
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _write_disk(self, key: str, audio: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+        if self.disk_bytes is None:
+            self.disk_bytes = sum(size for _, size, _ in self._disk_files())
+        else:
+            self.disk_bytes += len(audio)
+        if self.disk_bytes > self.max_disk_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        # Rescanned rather than tracked, so it stays right with several processes sharing the directory
+        files = sorted(self._disk_files())
+        self.disk_bytes = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 0.9
+        cutoff = time.time() - 60  # leave another process's in-progress .tmp files alone
+        for mtime, size, path in files:
+            if self.disk_bytes <= target:
+                break
+            if path.endswith(".tmp") and mtime > cutoff:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.disk_bytes -= size
+            self.disk_evictions += 1
+
+    async def get(self, text: str, model_name: str, encoding: str) -> Optional[bytes]:
+        if not self.cacheable(text):
+            return None
+        key = self.key(text, model_name, encoding)
+
+        audio = self._entries.get(key)
+        if audio is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return audio
+
+        if self.disk_dir:
+            audio = await asyncio.to_thread(self._read_disk, key)
+            if audio:
+                self._remember(key, audio)
+                self.disk_hits += 1
+                return audio
+
+        self.misses += 1
+        return None
+
+    async def put(self, text: str, model_name: str, encoding: str, audio: bytes):
+        if not audio or not self.cacheable(text):
+            return
+        key = self.key(text, model_name, encoding)
+        self._remember(key, audio)
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._write_disk, key, audio)
+            except OSError as e:
+                print(f"Could not write TTS cache entry: {e}")
+
+    async def warm(self, phrases: List[str], tts, concurrency: int = 4):
+        """Synthesize any of `phrases` that are not cached yet."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _warm(phrase):
+            async with semaphore:
+                try:
+                    await tts.speak(phrase)
+                except Exception as e:
+                    print(f"Could not pre-warm TTS cache for {phrase!r}: {e}")
+
+        await asyncio.gather(*(_warm(phrase) for phrase in phrases))
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_bytes": self.disk_bytes,
+            "max_disk_bytes": self.max_disk_bytes if self.disk_dir else 0,
+            "disk_evictions": self.disk_evictions,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
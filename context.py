@@ -0,0 +1,132 @@
+import os, asyncio
+from typing import Optional, Dict, List, Tuple
+
+from metrics import REGISTRY
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and chat-template markers around each message
+
+COMPACTIONS = REGISTRY.counter(
+    "voice_context_compactions_total", "Background summaries of older turns, by outcome.", labelnames=("outcome",),
+)
+
+
+def count_tokens(text: str) -> int:
+    """Cheap token estimate (about four characters per token for English)."""
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextBudget:
+    """Keeps what is sent to the LLM within a token budget.
+
+    `prompt` returns the system prompt, the rolling summary of older turns
+    and as many of the most recent messages as fit in `max_prompt_tokens`.
+    Nothing is summarized on the request path: once a turn has finished,
+    `schedule` folds the turns that no longer fit in `keep_recent_tokens`
+    into the conversation's `summary` in a background task. Until it is
+    done, the next request simply uses the summary it already has.
+    """
+
+    def __init__(self, max_prompt_tokens: int = 2048, keep_recent_tokens: int = 1024, min_fold_tokens: int = 256,
+                 context_window: int = 8192) -> None:
+        self.max_prompt_tokens = max_prompt_tokens
+        self.keep_recent_tokens = keep_recent_tokens
+        self.min_fold_tokens = min_fold_tokens
+        self.context_window = context_window
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    @classmethod
+    def from_env(cls) -> "ContextBudget":
+        return cls(
+            max_prompt_tokens=int(os.getenv("CONTEXT_MAX_PROMPT_TOKENS", 2048)),
+            keep_recent_tokens=int(os.getenv("CONTEXT_KEEP_RECENT_TOKENS", 1024)),
+            min_fold_tokens=int(os.getenv("CONTEXT_MIN_FOLD_TOKENS", 256)),
+            context_window=int(os.getenv("CONTEXT_WINDOW", 8192)),
+        )
+
+    @staticmethod
+    def system_message(conversation) -> Dict[str, str]:
+        system = conversation.messages[0]
+        summary = getattr(conversation, "summary", "")
+        if not summary:
+            return system
+        return dict(role='system', content=f"{system['content']}\n\nSummary of the conversation so far:\n{summary}")
+
+    def prompt(self, conversation) -> Tuple[List[Dict[str, str]], int]:
+        """Messages to send for the next request and their estimated token count."""
+        system = self.system_message(conversation)
+        tokens = message_tokens(system)
+        recent = []
+        for message in reversed(conversation.messages[1:]):
+            cost = message_tokens(message)
+            if recent and tokens + cost > self.max_prompt_tokens:
+                break
+            recent.append(message)
+            tokens += cost
+        recent.reverse()
+        # Start on a user turn, as the untrimmed history does
+        while len(recent) > 1 and recent[0]['role'] == 'assistant':
+            tokens -= message_tokens(recent.pop(0))
+        return [system] + recent, tokens
+
+    def completion_tokens(self, prompt_tokens: int, max_tokens: int) -> int:
+        return max(1, min(max_tokens, self.context_window - prompt_tokens))
+
+    def foldable(self, conversation) -> List[Dict[str, str]]:
+        """Oldest messages that no longer fit in `keep_recent_tokens`, ending before a user turn."""
+        messages = conversation.messages[1:]
+        kept = 0
+        split = len(messages)
+        while split > 0 and kept + message_tokens(messages[split - 1]) <= self.keep_recent_tokens:
+            split -= 1
+            kept += message_tokens(messages[split])
+        split = min(split, len(messages) - 2)
+        while split > 0 and messages[split]['role'] != 'user':
+            split -= 1
+        older = messages[:max(0, split)]
+        if sum(message_tokens(message) for message in older) < self.min_fold_tokens:
+            return []
+        return older
+
+    async def compact(self, conversation, summarize) -> bool:
+        """Fold old turns into the rolling summary with `summarize(summary, messages)`."""
+        older = self.foldable(conversation)
+        if not older:
+            return False
+        try:
+            summary = await summarize(getattr(conversation, "summary", ""), older)
+        except Exception as e:
+            COMPACTIONS.inc("failed")
+            print(f"Could not summarize conversation history: {e}")
+            return False
+        if not summary:
+            COMPACTIONS.inc("failed")
+            return False
+        conversation.fold(older, summary.strip())
+        COMPACTIONS.inc("ok")
+        return True
+
+    def schedule(self, conversation, summarize, on_done=None) -> Optional[asyncio.Task]:
+        """Compact `conversation` in the background once a turn has finished."""
+        key = id(conversation)
+        if key in self._tasks or not self.foldable(conversation):
+            return None
+
+        async def run():
+            try:
+                if await self.compact(conversation, summarize) and on_done is not None:
+                    on_done(conversation)
+            finally:
+                self._tasks.pop(key, None)
+
+        task = self._tasks[key] = asyncio.create_task(run())
+        return task
+
+    async def aclose(self):
+        tasks, self._tasks = list(self._tasks.values()), {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
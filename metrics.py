@@ -0,0 +1,234 @@
+import os, json, time, bisect
+from typing import Optional, Dict, List, Tuple, Callable
+
+# Seconds; dense below one second where most voice stages land
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5,
+                   0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0)
+
+TRACE_LOG = os.getenv("TRACE_LOG", "false").lower() in ("1", "true", "yes")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Histogram:
+    """Fixed-bucket histogram; `observe` is a bisect and two additions."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside the matching bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metric:
+    def __init__(self, name: str, help: str, kind: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = labelnames
+        self._children: Dict[Tuple[Tuple[str, str], ...], object] = {}
+
+    def _key(self, labels: Tuple[str, ...]) -> Tuple[Tuple[str, str], ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(zip(self.labelnames, labels))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, child in sorted(self._children.items()):
+            lines.extend(self._render_child(labels, child))
+        return lines
+
+
+class HistogramMetric(Metric):
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, "histogram", labelnames)
+        self.buckets = buckets
+
+    def labels(self, *labels: str) -> Histogram:
+        key = self._key(labels)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = Histogram(self.buckets)
+        return child
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def summary(self, quantiles=(0.5, 0.95, 0.99)) -> Dict[str, Dict[str, float]]:
+        """Estimated quantiles per label set, e.g. {"http/stt_done": {"p50": ...}}."""
+        result = {}
+        for labels, histogram in sorted(self._children.items()):
+            name = "/".join(value for _, value in labels) or self.name
+            result[name] = {f"p{int(q * 100)}": histogram.quantile(q) for q in quantiles}
+            result[name]["count"] = histogram.count
+        return result
+
+    def _render_child(self, labels, histogram: Histogram) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', repr(float(bound))))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {histogram.sum}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {histogram.count}")
+        return lines
+
+
+class CounterMetric(Metric):
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, "counter", labelnames)
+
+    def inc(self, *labels: str, amount: float = 1):
+        key = self._key(labels)
+        self._children[key] = self._children.get(key, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._children.get(self._key(labels), 0)
+
+    def _render_child(self, labels, value) -> List[str]:
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+
+class GaugeMetric(Metric):
+    """Gauge whose value is read from a callback at scrape time.
+
+    With `labelnames`, the callback returns a dict of label tuples to values.
+    """
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float], labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, "gauge", labelnames)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if not self.labelnames:
+            return lines + [f"{self.name} {self.callback()}"]
+        for labels, value in sorted(self.callback().items()):
+            lines.append(f"{self.name}{_format_labels(self._key(labels))} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> HistogramMetric:
+        return self._register(HistogramMetric(name, help, labelnames, buckets))
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> CounterMetric:
+        return self._register(CounterMetric(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float], labelnames: Tuple[str, ...] = ()) -> GaugeMetric:
+        return self._register(GaugeMetric(name, help, callback, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "voice_turn_stage_seconds",
+    "Time from the start of a turn until each pipeline stage was reached.",
+    labelnames=("path", "stage"),
+)
+TTS_FIRST_BYTE_SECONDS = REGISTRY.histogram(
+    "voice_tts_first_byte_seconds",
+    "Time from sending a sentence to TTS until its audio was available.",
+    labelnames=("path",),
+)
+LLM_PROMPT_TOKENS = REGISTRY.histogram(
+    "voice_llm_prompt_tokens",
+    "Estimated tokens sent to the LLM per request.",
+    labelnames=("path",),
+    buckets=(64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096, 6144, 8192, 16384),
+)
+TURNS_TOTAL = REGISTRY.counter(
+    "voice_turns_total", "Completed and interrupted turns.", labelnames=("path", "outcome"),
+)
+
+
+class TurnTrace:
+    """Timing spans for one conversational turn.
+
+    `mark` records the first time a stage is reached, relative to the start of
+    the turn, into `voice_turn_stage_seconds`. With TRACE_LOG enabled, each
+    finished turn is also printed as a single JSON line.
+    """
+
+    def __init__(self, path: str, start_stage: str = "upload_received", log: bool = TRACE_LOG) -> None:
+        self.path = path
+        self.log = log
+        self.start = time.perf_counter()
+        self.marks: Dict[str, float] = {start_stage: 0.0}
+        self.tts: List[float] = []
+        self.prompt_tokens: Optional[int] = None
+        self.finished = False
+
+    def mark(self, stage: str, at: Optional[float] = None):
+        """Record `stage`, reached now or at `at` (a perf_counter time, clamped to the start of the turn)."""
+        if stage in self.marks:
+            return
+        elapsed = max(0.0, (at if at is not None else time.perf_counter()) - self.start)
+        self.marks[stage] = elapsed
+        STAGE_SECONDS.labels(self.path, stage).observe(elapsed)
+
+    def observe_tts(self, seconds: float):
+        self.tts.append(seconds)
+        TTS_FIRST_BYTE_SECONDS.labels(self.path).observe(seconds)
+
+    def observe_prompt(self, tokens: int):
+        self.prompt_tokens = tokens
+        LLM_PROMPT_TOKENS.labels(self.path).observe(tokens)
+
+    def finish(self, outcome: str = "completed"):
+        if self.finished:
+            return
+        self.finished = True
+        self.mark("turn_complete")
+        TURNS_TOTAL.inc(self.path, outcome)
+        if self.log:
+            print(json.dumps({"path": self.path, "outcome": outcome, **self.summary()}), flush=True)
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            "stages_ms": {stage: round(t * 1000, 1) for stage, t in self.marks.items()},
+            "tts_first_byte_ms": [round(t * 1000, 1) for t in self.tts],
+            "prompt_tokens": self.prompt_tokens,
+        }
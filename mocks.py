@@ -0,0 +1,150 @@
+import io, json, math, wave, struct, asyncio, random
+from dataclasses import dataclass
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.requests import ClientDisconnect
+
+
+@dataclass
+class MockConfig:
+    """Latency profile of the local Deepgram and Together stand-ins."""
+    stt_ms: float = 150.0                 # /v1/listen response time
+    stt_ms_per_audio_second: float = 20.0
+    tts_ttfb_ms: float = 120.0            # /v1/speak time to first byte
+    tts_bytes_per_char: int = 400         # roughly 24 kbps mp3 at a normal speaking rate
+    tts_chunk_bytes: int = 4096
+    tts_chunk_interval_ms: float = 5.0
+    llm_ttft_ms: float = 250.0            # /v1/chat/completions time to first token
+    llm_tokens_per_second: float = 80.0
+    reply_sentences: int = 3
+    jitter: float = 0.1                   # +/- fraction applied to every delay
+    transcript: str = "Hey there, can you tell me something interesting about the ocean?"
+
+
+# Bit rate of each /v1/speak encoding relative to `tts_bytes_per_char` (mp3), and what it is served as
+TTS_ENCODINGS = {
+    "mp3": (lambda rate: 24.0, b"\xff\xf3", "audio/mpeg"),
+    "opus": (lambda rate: 16.0, b"OggS", "audio/ogg"),
+    "linear16": (lambda rate: rate * 16 / 1000, b"", "audio/l16"),
+}
+
+REPLY_SENTENCES = [
+    "Oh wow!",
+    "The ocean covers about seventy one percent of the planet, which is wild when you think about it.",
+    "Most of it is still unexplored, so there are creatures down there nobody has ever seen.",
+    "Some deep sea fish make their own light to hunt in total darkness.",
+    "Honestly, it's the closest thing we have to an alien world right here at home.",
+]
+
+
+def make_wav(seconds: float = 2.0, sample_rate: int = 16000, frequency: float = 220.0) -> bytes:
+    """A mono linear16 WAV file with a quiet tone, for upload benchmarks."""
+    frames = int(seconds * sample_rate)
+    samples = (int(3000 * math.sin(2 * math.pi * frequency * i / sample_rate)) for i in range(frames))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(struct.pack(f"<{frames}h", *samples))
+    return buffer.getvalue()
+
+
+def create_mock_app(config: MockConfig) -> FastAPI:
+    app = FastAPI()
+
+    def delay(ms: float) -> float:
+        return max(0.0, ms * (1 + random.uniform(-config.jitter, config.jitter))) / 1000
+
+    @app.head("/")
+    @app.get("/")
+    async def root():
+        return Response(status_code=200)
+
+    @app.get("/v1/projects")
+    async def projects():
+        return JSONResponse({"projects": []})
+
+    @app.post("/v1/listen")
+    async def listen(request: Request):
+        size = 0
+        try:
+            async for chunk in request.stream():
+                size += len(chunk)
+        except ClientDisconnect:
+            return Response(status_code=499)  # the caller aborted the upload
+        audio_seconds = max(0, size - 44) / 32000
+        await asyncio.sleep(delay(config.stt_ms + config.stt_ms_per_audio_second * audio_seconds))
+        return JSONResponse({
+            "metadata": {"duration": audio_seconds},
+            "results": {"channels": [{"alternatives": [{"transcript": config.transcript, "confidence": 0.99}]}]},
+        })
+
+    @app.post("/v1/speak")
+    async def speak(request: Request):
+        text = (await request.json()).get("text", "")
+        kbps, magic, media_type = TTS_ENCODINGS.get(request.query_params.get("encoding", "mp3"), TTS_ENCODINGS["mp3"])
+        bytes_per_char = config.tts_bytes_per_char * kbps(int(request.query_params.get("sample_rate", 24000))) / 24.0
+        total = max(config.tts_chunk_bytes, int(len(text) * bytes_per_char))
+
+        async def audio():
+            await asyncio.sleep(delay(config.tts_ttfb_ms))
+            sent = 0
+            while sent < total:
+                size = min(config.tts_chunk_bytes, total - sent)
+                yield magic + bytes(size - len(magic)) if sent == 0 else bytes(size)
+                sent += size
+                await asyncio.sleep(delay(config.tts_chunk_interval_ms))
+
+        return StreamingResponse(audio(), media_type=media_type)
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        payload = await request.json()
+        reply = " ".join(REPLY_SENTENCES[:max(1, config.reply_sentences)])
+        tokens = [word if i == 0 else f" {word}" for i, word in enumerate(reply.split(" "))]
+        tokens = tokens[:payload.get("max_tokens") or len(tokens)]
+
+        if not payload.get("stream"):
+            await asyncio.sleep(delay(config.llm_ttft_ms + 1000 * len(tokens) / config.llm_tokens_per_second))
+            message = {"role": "assistant", "content": "".join(tokens)}
+            return JSONResponse({"choices": [{"message": message, "finish_reason": "stop"}]})
+
+        async def events():
+            await asyncio.sleep(delay(config.llm_ttft_ms))
+            for token in tokens:
+                yield f"data: {json.dumps({'choices': [{'text': token}]})}\n\n"
+                await asyncio.sleep(delay(1000 / config.llm_tokens_per_second))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+class MockServer:
+    """Serve an ASGI app on a free local port from inside the running event loop."""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="on"))
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def __aenter__(self) -> "MockServer":
+        self._task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            if self._task.done():
+                self._task.result()
+            await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.should_exit = True
+        await self._task
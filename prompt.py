@@ -70,4 +70,21 @@ If you see ",", never go back on your words or say sorry.
 Always give new info that moves the conversation forward.
 NEVER repeat yourself or talk to yourself.
 Use natural, informal language infused with warmth and energy.
-Make our team proud!"""
\ No newline at end of file
+Make our team proud!"""
+
+# Used off the hot path to fold old turns of long conversations into a rolling summary
+SUMMARY_PROMPT = """You maintain the memory of a voice conversation between a user and an assistant.
+Merge the summary so far with the new turns into one updated summary.
+Keep names, facts, numbers, decisions, open questions and anything the user asked to remember.
+Drop small talk and filler. Write plain sentences, at most 120 words, no lists or headings."""
+
+# Short phrases the prompt above asks the model to use, worth keeping pre-synthesized.
+# Only ones the sentence segmenter sends to TTS whole can be cache hits, so a
+# bare "Well," or "So," (which it joins to the next sentence) is left out.
+FILLER_PHRASES = [
+    "Oh wow!", "I see.", "Gotcha!", "Right!", "Oh dear.", "Oh no!", "True!",
+    "Oh yeah!", "Oops!", "I get it.", "Yep.", "Nope.", "You know?", "For real.", "I hear ya.",
+    "No way!", "Fantastic!", "I hear you.", "I feel you.", "Woah there!", "You crack me up!",
+    "I'm speechless!", "Hmm, let me ponder.", "Well, this is awkward.",
+    "I didn't catch that.", "Pardon?", "Sorry, could you repeat that?",
+]
\ No newline at end of file
@@ -0,0 +1,297 @@
+import os, re, json, time, uuid, struct, asyncio
+from collections import deque
+from typing import Optional, Dict, List, Tuple
+
+from metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError:  # Windows: segments of other processes are never pruned
+    fcntl = None
+
+RECORDED_TURNS = REGISTRY.counter(
+    "voice_recorder_turns_total",
+    "Turns handed to the recorder: written, dropped (queue full), audio_dropped (byte budget) or failed (write error).",
+    labelnames=("outcome",),
+)
+RECORDED_BYTES = REGISTRY.counter("voice_recorder_bytes_total", "Bytes appended to recording segments.")
+RECORDER_WRITE_SECONDS = REGISTRY.histogram(
+    "voice_recorder_write_seconds", "Time to append one batch of turns to disk.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+
+SEGMENT_NAME = re.compile(r"^turns-(\d{6})\.seg$")
+
+
+class AudioTap:
+    """A copy of the audio passing through a stream, up to `max_bytes`.
+
+    Keeps the first `max_bytes` by default, or the most recent ones with
+    `keep_last` (for a live stream where only the audio before an utterance
+    matters). `truncated` says whether anything was left out.
+    """
+
+    def __init__(self, max_bytes: int, keep_last: bool = False, media_type: str = "audio/*") -> None:
+        self.max_bytes = max_bytes
+        self.keep_last = keep_last
+        self.media_type = media_type
+        self.truncated = False
+        self._chunks = deque()
+        self._size = 0
+
+    def add(self, chunk: bytes):
+        if not chunk:
+            return
+        if not self.keep_last:
+            room = self.max_bytes - self._size
+            if room < len(chunk):
+                self.truncated = True
+                chunk = chunk[:max(0, room)]
+            if chunk:
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+            return
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size > self.max_bytes and self._chunks:
+            self._size -= len(self._chunks.popleft())
+            self.truncated = True
+
+    async def tee(self, chunks):
+        async for chunk in chunks:
+            self.add(chunk)
+            yield chunk
+
+    def take(self) -> bytes:
+        """The audio kept so far, emptying the tap."""
+        audio = b"".join(self._chunks)
+        self._chunks.clear()
+        self._size = 0
+        self.truncated = False
+        return audio
+
+
+class TurnRecorder:
+    """Records finished turns (metadata, transcript, reply and audio) without slowing requests down.
+
+    `record` only puts the turn on a bounded queue; a background task drains
+    it in batches and appends them, in a worker thread, to segment files in
+    `directory`. Each segment `turns-NNNNNN.seg` is a run of records: a
+    4-byte little-endian header length, a JSON header, then the input and
+    output audio (sizes in the header). A matching `.idx` file holds one
+    compact JSON line per turn with its offset. Segments rotate at
+    `segment_bytes` and only the newest `max_segments` are kept (see `_prune`).
+
+    When the queue holds `max_queue` turns, `policy` "drop" discards the new
+    turn at once and "block" waits up to `block_timeout` seconds for room
+    first. Once queued audio exceeds `max_queue_bytes`, turns are recorded
+    without their audio.
+    """
+
+    def __init__(self, directory: str, max_queue: int = 256, max_queue_bytes: int = 64_000_000, policy: str = "drop",
+                 block_timeout: float = 0.05, segment_bytes: int = 64_000_000, max_segments: int = 16,
+                 batch_size: int = 64) -> None:
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown recorder policy {policy}, expected drop or block")
+        self.directory = directory
+        self.max_queue = max_queue
+        self.max_queue_bytes = max_queue_bytes
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.batch_size = batch_size
+        self.queued_bytes = 0
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self._segment = None
+        self._index = None
+        self._segment_number = 0
+        self._segment_size = 0
+        self._created = set()
+        self._preexisting = 0
+
+    @classmethod
+    def from_env(cls, directory: str) -> "TurnRecorder":
+        return cls(
+            os.getenv("RECORD_DIR", directory),
+            max_queue=int(os.getenv("RECORD_MAX_QUEUE", 256)),
+            max_queue_bytes=int(os.getenv("RECORD_MAX_QUEUE_BYTES", 64_000_000)),
+            policy=os.getenv("RECORD_POLICY", "drop"),
+            block_timeout=float(os.getenv("RECORD_BLOCK_MS", 50)) / 1000,
+            segment_bytes=int(os.getenv("RECORD_SEGMENT_BYTES", 64_000_000)),
+            max_segments=int(os.getenv("RECORD_MAX_SEGMENTS", 16)),
+        )
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def record(self, turn: Dict[str, object], input_audio: bytes = b"", output_audio: bytes = b"") -> bool:
+        """Queue a turn for writing; returns False if it was dropped."""
+        turn = {"turn": uuid.uuid4().hex, "time": round(time.time(), 3), **turn}
+        size = len(input_audio) + len(output_audio)
+        if size and self.queued_bytes + size > self.max_queue_bytes:
+            # The writer is behind: keep the text and timings, not the audio
+            turn["audio_dropped"] = True
+            input_audio, output_audio, size = b"", b"", 0
+            RECORDED_TURNS.inc("audio_dropped")
+        item = (turn, input_audio, output_audio)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if self.policy != "block":
+                RECORDED_TURNS.inc("dropped")
+                return False
+            try:
+                await asyncio.wait_for(self._queue.put(item), self.block_timeout)
+            except asyncio.TimeoutError:
+                RECORDED_TURNS.inc("dropped")
+                return False
+        self.queued_bytes += size
+        return True
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, batch)
+                RECORDED_TURNS.inc("written", amount=len(batch))
+            except OSError as e:
+                RECORDED_TURNS.inc("failed", amount=len(batch))
+                print(f"Could not write turn recordings: {e}")
+            finally:
+                RECORDER_WRITE_SECONDS.observe(time.perf_counter() - start)
+                self.queued_bytes -= sum(len(item[1]) + len(item[2]) for item in batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: List[Tuple[Dict[str, object], bytes, bytes]]):
+        index_lines = []
+        for turn, input_audio, output_audio in batch:
+            if self._segment is None or self._segment_size >= self.segment_bytes:
+                self._rotate(index_lines)
+                index_lines = []
+            header = json.dumps({**turn, "input_bytes": len(input_audio), "output_bytes": len(output_audio)}).encode()
+            record = struct.pack("<I", len(header)) + header + input_audio + output_audio
+            self._segment.write(record)
+            index_lines.append(json.dumps({
+                "turn": turn["turn"], "time": turn["time"], "session": turn.get("session"),
+                "outcome": turn.get("outcome"), "offset": self._segment_size, "bytes": len(record),
+            }) + "\n")
+            self._segment_size += len(record)
+            RECORDED_BYTES.inc(amount=len(record))
+        self._index.write("".join(index_lines))
+        self._segment.flush()
+        self._index.flush()
+
+    def _rotate(self, pending_index: List[str]):
+        if self._segment is not None:
+            self._index.write("".join(pending_index))
+            self._segment.close()
+            self._index.close()
+        else:
+            # Never append to a segment a previous process may have left half-written
+            os.makedirs(self.directory, exist_ok=True)
+            self._preexisting = max(segment_numbers(self.directory), default=0)
+        # Numbers keep increasing across all worker processes, even past segments since pruned
+        self._segment_number = max([self._segment_number] + segment_numbers(self.directory))
+        while True:
+            self._segment_number += 1
+            base = os.path.join(self.directory, f"turns-{self._segment_number:06d}")
+            try:
+                self._segment = open(f"{base}.seg", "xb")
+                break
+            except FileExistsError:
+                continue  # taken by another worker process
+        if fcntl is not None:
+            # Held while the segment is open, so other processes leave it alone
+            fcntl.flock(self._segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._created.add(self._segment_number)
+        self._index = open(f"{base}.idx", "a", encoding="utf-8")
+        self._segment_size = 0
+        self._prune()
+
+    def _prune(self):
+        """Remove segments older than the newest `max_segments`.
+
+        Worker processes share the directory, so this only removes segments
+        this process wrote, and ones left from before it started that no
+        process still has open.
+        """
+        for number in segment_numbers(self.directory)[:-self.max_segments]:
+            if number == self._segment_number:
+                continue
+            if number in self._created:
+                self._created.discard(number)
+            elif number > self._preexisting or segment_in_use(self.directory, number):
+                continue  # another worker's
+            for extension in (".seg", ".idx"):
+                try:
+                    os.remove(os.path.join(self.directory, f"turns-{number:06d}{extension}"))
+                except FileNotFoundError:
+                    pass
+
+    async def aclose(self, timeout: float = 5.0):
+        """Write what is still queued (for up to `timeout` seconds), then close the segment."""
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Gave up writing {len(self)} queued turn recordings")
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+
+def segment_numbers(directory: str) -> List[int]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(m.group(1)) for m in map(SEGMENT_NAME.match, os.listdir(directory)) if m)
+
+
+def segment_in_use(directory: str, number: int) -> bool:
+    """Whether a process holds the segment open for writing."""
+    if fcntl is None:
+        return True
+    try:
+        with open(os.path.join(directory, f"turns-{number:06d}.seg"), "rb") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False  # released on close
+    except BlockingIOError:
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def read_turn(directory: str, segment: int, offset: int) -> Tuple[Dict[str, object], bytes, bytes]:
+    """The header, input audio and output audio of the turn at `offset` in a segment."""
+    with open(os.path.join(directory, f"turns-{segment:06d}.seg"), "rb") as f:
+        f.seek(offset)
+        header_size = struct.unpack("<I", f.read(4))[0]
+        turn = json.loads(f.read(header_size))
+        return turn, f.read(turn["input_bytes"]), f.read(turn["output_bytes"])
+
+
+def iter_index(directory: str):
+    """Yield `(segment, entry)` for every recorded turn, oldest first."""
+    for number in segment_numbers(directory):
+        try:
+            with open(os.path.join(directory, f"turns-{number:06d}.idx"), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield number, json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # cut short by a crash
+        except FileNotFoundError:
+            continue
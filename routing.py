@@ -0,0 +1,148 @@
+import os, time, random
+from typing import Optional, Dict, List, Iterable
+
+from metrics import REGISTRY
+
+ROUTE_REQUESTS = REGISTRY.counter(
+    "voice_route_requests_total", "Requests per routed model or voice, by outcome.", labelnames=("router", "model", "outcome"),
+)
+ROUTE_SWITCHES = REGISTRY.counter(
+    "voice_route_switches_total", "Times a router moved its traffic to another candidate.", labelnames=("router", "reason"),
+)
+
+
+class RouteStats:
+    def __init__(self) -> None:
+        self.ttft: Optional[float] = None   # EWMA seconds to first token / byte
+        self.error_rate = 0.0               # EWMA of failures, 0..1
+        self.requests = 0
+        self.errors = 0
+        self.down_until = 0.0
+        self.last_used = 0.0
+
+
+class Router:
+    """Send each request to the fastest healthy candidate in a tier.
+
+    Every candidate (an LLM model, or a TTS voice) keeps an EWMA of its time
+    to first token/byte and of its error rate. A candidate whose error rate
+    reaches `error_threshold` is taken out of rotation for `cooldown`
+    seconds. Traffic stays on the current candidate until it is unhealthy or
+    another one is more than `switch_ratio` times faster, so routing does not
+    flap; `explore` is the share of requests sent to another healthy
+    candidate to keep its numbers fresh.
+    """
+
+    def __init__(self, name: str, candidates: List[str], alpha: float = 0.2, error_threshold: float = 0.5,
+                 cooldown: float = 30.0, switch_ratio: float = 1.3, explore: float = 0.02) -> None:
+        if not candidates:
+            raise ValueError(f"Router {name} needs at least one candidate")
+        self.name = name
+        self.candidates = list(dict.fromkeys(candidates))
+        self.alpha = alpha
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.switch_ratio = switch_ratio
+        self.explore = explore
+        self.current = self.candidates[0]
+        self.stats: Dict[str, RouteStats] = {model: RouteStats() for model in self.candidates}
+
+    @classmethod
+    def from_env(cls, name: str, candidates: List[str], **defaults) -> "Router":
+        """A router configured from {NAME}_ROUTE_* variables, listed in `ROUTERS` for the scoreboard.
+
+        Routers built directly (e.g. the single-model defaults of
+        `TextToSpeech` and `LanguageModel`) are not listed, so they never
+        replace the app's.
+        """
+        prefix = f"{name.upper()}_ROUTE"
+        models = os.getenv(f"{prefix}_MODELS")
+        router = ROUTERS[name] = cls(
+            name,
+            [model.strip() for model in models.split(",") if model.strip()] if models else candidates,
+            alpha=float(os.getenv(f"{prefix}_ALPHA", defaults.get("alpha", 0.2))),
+            error_threshold=float(os.getenv(f"{prefix}_ERROR_THRESHOLD", defaults.get("error_threshold", 0.5))),
+            cooldown=float(os.getenv(f"{prefix}_COOLDOWN", defaults.get("cooldown", 30.0))),
+            switch_ratio=float(os.getenv(f"{prefix}_SWITCH_RATIO", defaults.get("switch_ratio", 1.3))),
+            explore=float(os.getenv(f"{prefix}_EXPLORE", defaults.get("explore", 0.02))),
+        )
+        return router
+
+    def healthy(self, model: str) -> bool:
+        return time.monotonic() >= self.stats[model].down_until
+
+    def score(self, model: str) -> float:
+        stats = self.stats[model]
+        if stats.ttft is None:
+            return float("inf")
+        return stats.ttft * (1 + 2 * stats.error_rate)
+
+    def choose(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        """Pick the candidate for the next request, skipping any in `exclude`."""
+        exclude = set(exclude)
+        candidates = [model for model in self.candidates if model not in exclude]
+        if not candidates:
+            return None
+        healthy = [model for model in candidates if self.healthy(model)]
+        if not healthy:
+            # Everything is cooling down: use whichever comes back first
+            return min(candidates, key=lambda model: self.stats[model].down_until)
+
+        if self.explore and len(healthy) > 1 and random.random() < self.explore:
+            others = [model for model in healthy if model != self.current]
+            return random.choice(others)
+
+        best = min(healthy, key=self.score)
+        current = self.current if self.current in healthy else None
+        if current is not None and self.score(current) <= self.switch_ratio * self.score(best):
+            return current
+        if current is None and self.current not in exclude:
+            self._switch(best, "unhealthy")
+        elif current is not None:
+            self._switch(best, "slower")
+        return best
+
+    def _switch(self, model: str, reason: str):
+        if model != self.current:
+            self.current = model
+            ROUTE_SWITCHES.inc(self.name, reason)
+
+    def observe(self, model: str, ttft: Optional[float] = None, error: bool = False):
+        stats = self.stats.get(model)
+        if stats is None:
+            return
+        stats.requests += 1
+        stats.last_used = time.monotonic()
+        stats.error_rate += self.alpha * ((1.0 if error else 0.0) - stats.error_rate)
+        if error:
+            stats.errors += 1
+            ROUTE_REQUESTS.inc(self.name, model, "error")
+            if stats.error_rate >= self.error_threshold:
+                stats.down_until = time.monotonic() + self.cooldown
+                # Let it back in on probation rather than with a stale record
+                stats.error_rate = self.error_threshold / 2
+            return
+        ROUTE_REQUESTS.inc(self.name, model, "ok")
+        if ttft is not None:
+            stats.ttft = ttft if stats.ttft is None else stats.ttft + self.alpha * (ttft - stats.ttft)
+
+    def scoreboard(self) -> Dict[str, object]:
+        now = time.monotonic()
+        return {
+            "current": self.current,
+            "candidates": [
+                {
+                    "model": model,
+                    "healthy": self.healthy(model),
+                    "ewma_ttft_ms": round(stats.ttft * 1000, 1) if stats.ttft is not None else None,
+                    "error_rate": round(stats.error_rate, 3),
+                    "requests": stats.requests,
+                    "errors": stats.errors,
+                    "cooldown_remaining": round(max(0.0, stats.down_until - now), 1),
+                }
+                for model, stats in sorted(self.stats.items(), key=lambda item: self.score(item[0]))
+            ],
+        }
+
+
+ROUTERS: Dict[str, Router] = {}
@@ -0,0 +1,371 @@
+import os, time, random, asyncio, email.utils
+from contextlib import asynccontextmanager
+from typing import Optional, Dict
+
+import httpx
+from metrics import REGISTRY
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "voice_upstream_requests_total", "Upstream calls by final outcome.", labelnames=("provider", "outcome"),
+)
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "voice_upstream_retries_total", "Upstream attempts that were retried.", labelnames=("provider", "reason"),
+)
+UPSTREAM_REJECTIONS = REGISTRY.counter(
+    "voice_upstream_rejections_total", "Calls refused before reaching the upstream.", labelnames=("provider", "reason"),
+)
+UPSTREAM_HEDGES = REGISTRY.counter(
+    "voice_upstream_hedges_total", "Hedged requests fired, and how many of them won.", labelnames=("provider", "outcome"),
+)
+
+
+class UpstreamError(Exception):
+    """An upstream call failed; `retry_after` hints when it may be worth trying again."""
+    def __init__(self, message: str, retry_after: Optional[float] = None, status_code: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class Overloaded(UpstreamError):
+    pass
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """Parse a `Retry-After` header given either in seconds or as an HTTP date."""
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and rejects calls
+    for `reset_timeout` seconds, then lets a single trial call through."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 15.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self._trial:
+            return False
+        self._trial = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+    def release(self):
+        """Give back a trial slot whose call ended without a verdict (e.g. cancelled)."""
+        self._trial = False
+
+
+class ProviderScheduler:
+    """Admission control and retries for every call to one upstream provider.
+
+    At most `max_concurrency` calls run at once; up to `max_queue` more wait
+    for a slot (for at most `queue_timeout` seconds) and anything beyond that
+    is rejected with `Overloaded`. 429 and 5xx responses and transport errors
+    are retried with full-jitter exponential backoff, honouring `Retry-After`,
+    as long as the call's deadline allows it. Repeated failures open a circuit
+    breaker so callers fail fast with `CircuitOpen` instead of piling on.
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 16, max_queue: int = 64, queue_timeout: float = 5.0,
+                 max_retries: int = 2, backoff_base: float = 0.25, backoff_max: float = 4.0, deadline: float = 30.0,
+                 failure_threshold: int = 5, reset_timeout: float = 15.0) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.waiting = 0
+        self.in_flight = 0
+        self._slots = asyncio.Semaphore(max_concurrency)
+        SCHEDULERS[name] = self
+
+    @classmethod
+    def from_env(cls, name: str) -> "ProviderScheduler":
+        prefix = name.upper()
+        return cls(
+            name,
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", 16)),
+            max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", 64)),
+            queue_timeout=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", 5)),
+            max_retries=int(os.getenv(f"{prefix}_MAX_RETRIES", 2)),
+            backoff_base=float(os.getenv(f"{prefix}_BACKOFF_BASE", 0.25)),
+            backoff_max=float(os.getenv(f"{prefix}_BACKOFF_MAX", 4)),
+            deadline=float(os.getenv(f"{prefix}_DEADLINE", 30)),
+            failure_threshold=int(os.getenv(f"{prefix}_CIRCUIT_FAILURES", 5)),
+            reset_timeout=float(os.getenv(f"{prefix}_CIRCUIT_RESET", 15)),
+        )
+
+    def has_capacity(self) -> bool:
+        return not self._slots.locked()
+
+    def _reject(self, error_type, reason: str, retry_after: Optional[float] = None):
+        UPSTREAM_REJECTIONS.inc(self.name, reason)
+        UPSTREAM_REQUESTS.inc(self.name, "rejected")
+        raise error_type(f"{self.name}: {reason.replace('_', ' ')}", retry_after=retry_after)
+
+    @asynccontextmanager
+    async def slot(self, deadline_at: float):
+        """Hold one of the provider's concurrency slots, waiting in the queue if needed."""
+        if not self.breaker.allow():
+            self._reject(CircuitOpen, "circuit_open", self.breaker.retry_after())
+        trial = self.breaker.state != "closed"
+        try:
+            if self.waiting + self.in_flight >= self.max_concurrency + self.max_queue:
+                self._reject(Overloaded, "queue_full", self.queue_timeout)
+            remaining = deadline_at - time.monotonic()
+            self.waiting += 1
+            try:
+                if self._slots.locked():
+                    await asyncio.wait_for(self._slots.acquire(), max(0.0, min(self.queue_timeout, remaining)))
+                else:
+                    await self._slots.acquire()
+            except asyncio.TimeoutError:
+                if remaining <= self.queue_timeout:
+                    self._reject(DeadlineExceeded, "deadline")
+                self._reject(Overloaded, "queue_timeout", self.queue_timeout)
+            finally:
+                self.waiting -= 1
+        except BaseException:
+            if trial:
+                self.breaker.release()
+            raise
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            if trial:
+                self.breaker.release()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _verdict(self, response: Optional[httpx.Response], error: Optional[Exception]):
+        """Record the outcome of one attempt and return `(retry_reason, retry_after)`."""
+        if error is not None:
+            self.breaker.record_failure()
+            return "transport", None
+        if response.status_code in RETRY_STATUSES:
+            if response.status_code != 429:  # rate limited is not broken
+                self.breaker.record_failure()
+            return str(response.status_code), retry_after_seconds(response)
+        self.breaker.record_success()
+        return None, None
+
+    async def _backoff_or_raise(self, attempt: int, retries: int, reason: str, retry_after: Optional[float],
+                                deadline_at: float, detail: str, status_code: Optional[int] = None):
+        delay = retry_after if retry_after is not None else self.backoff(attempt)
+        if attempt >= retries or time.monotonic() + delay >= deadline_at:
+            UPSTREAM_REQUESTS.inc(self.name, "failed")
+            raise UpstreamError(f"{self.name}: {detail}", retry_after=retry_after, status_code=status_code)
+        UPSTREAM_RETRIES.inc(self.name, reason)
+        await asyncio.sleep(delay)
+
+    def _timed_out(self, deadline: float):
+        self.breaker.record_failure()
+        UPSTREAM_REQUESTS.inc(self.name, "deadline")
+        raise DeadlineExceeded(f"{self.name}: no response within {deadline:.1f}s")
+
+    def _check_status(self, response: httpx.Response) -> httpx.Response:
+        if response.is_error:
+            UPSTREAM_REQUESTS.inc(self.name, "failed")
+            raise UpstreamError(f"{self.name}: HTTP {response.status_code}", status_code=response.status_code)
+        UPSTREAM_REQUESTS.inc(self.name, "ok")
+        return response
+
+    async def call(self, send, deadline: Optional[float] = None, retries: Optional[int] = None) -> httpx.Response:
+        """Run `send()`, a coroutine factory returning a fully read `httpx.Response`.
+
+        Raises `UpstreamError` (or one of its subclasses) once the call is
+        rejected, times out or keeps failing; 4xx responses are not retried.
+        """
+        deadline = deadline or self.deadline
+        deadline_at = time.monotonic() + deadline
+        retries = self.max_retries if retries is None else retries
+        attempt = 0
+        while True:
+            response, error = None, None
+            async with self.slot(deadline_at):
+                try:
+                    response = await asyncio.wait_for(send(), max(0.0, deadline_at - time.monotonic()))
+                except asyncio.TimeoutError:
+                    self._timed_out(deadline)
+                except httpx.TransportError as e:
+                    error = e
+                reason, retry_after = self._verdict(response, error)
+            if reason is None:
+                return self._check_status(response)
+            detail = str(error) if error is not None else f"HTTP {response.status_code}"
+            await self._backoff_or_raise(attempt, retries, reason, retry_after, deadline_at, detail,
+                                         response.status_code if response is not None else None)
+            attempt += 1
+
+    @asynccontextmanager
+    async def stream(self, open_stream, deadline: Optional[float] = None, retries: Optional[int] = None):
+        """Like `call`, for `open_stream()` returning an `httpx` streaming context.
+
+        The deadline covers the time until the response headers arrive; the
+        concurrency slot is held until the caller has finished reading.
+        """
+        deadline = deadline or self.deadline
+        deadline_at = time.monotonic() + deadline
+        retries = self.max_retries if retries is None else retries
+        attempt = 0
+        while True:
+            response, error = None, None
+            async with self.slot(deadline_at):
+                context = open_stream()
+                try:
+                    response = await asyncio.wait_for(context.__aenter__(), max(0.0, deadline_at - time.monotonic()))
+                except asyncio.TimeoutError:
+                    self._timed_out(deadline)
+                except httpx.TransportError as e:
+                    error = e
+                reason, retry_after = self._verdict(response, error)
+                if reason is None:
+                    try:
+                        if response.is_error:
+                            await response.aread()
+                        yield self._check_status(response)
+                    except BaseException as e:
+                        if not await context.__aexit__(type(e), e, e.__traceback__):
+                            raise
+                    else:
+                        await context.__aexit__(None, None, None)
+                    return
+                if response is not None:
+                    await context.__aexit__(None, None, None)
+            detail = str(error) if error is not None else f"HTTP {response.status_code}"
+            await self._backoff_or_raise(attempt, retries, reason, retry_after, deadline_at, detail,
+                                         response.status_code if response is not None else None)
+            attempt += 1
+
+    async def hedged(self, attempt, hedge_after: Optional[float]):
+        """Run `attempt(first_byte)` and, if `first_byte` (an `asyncio.Event`)
+        is not set within `hedge_after` seconds, race a second copy of it.
+
+        Whichever copy produces a byte first is kept and the other one is
+        cancelled. The backup only fires when a concurrency slot is free, so
+        hedging never queues behind real work.
+        """
+        primary_byte = asyncio.Event()
+        primary = asyncio.create_task(attempt(primary_byte))
+        if hedge_after is None:
+            return await primary
+
+        racers = {primary: primary_byte}
+        started = asyncio.create_task(primary_byte.wait())
+        try:
+            await asyncio.wait([primary, started], timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            started.cancel()
+            if primary.done() or primary_byte.is_set() or not self.has_capacity():
+                return await primary
+
+            UPSTREAM_HEDGES.inc(self.name, "fired")
+            backup_byte = asyncio.Event()
+            backup = asyncio.create_task(attempt(backup_byte))
+            racers[backup] = backup_byte
+
+            while True:
+                waiters = {asyncio.create_task(event.wait()): task for task, event in racers.items()}
+                done, _ = await asyncio.wait(list(waiters) + list(racers), return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+                winner = next((waiters.get(t, t) for t in done if waiters.get(t, t) in racers), None)
+                if winner.done() and winner.exception() is not None and len(racers) > 1:
+                    del racers[winner]  # that copy failed, keep waiting for the other one
+                    continue
+                for task in racers:
+                    if task is not winner:
+                        task.cancel()
+                if winner is backup:
+                    UPSTREAM_HEDGES.inc(self.name, "won")
+                return await winner
+        finally:
+            started.cancel()
+            for task in racers:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+        }
+
+
+SCHEDULERS: Dict[str, ProviderScheduler] = {}
+
+REGISTRY.gauge(
+    "voice_upstream_queue_depth", "Calls waiting for a concurrency slot.",
+    lambda: {(name,): s.waiting for name, s in SCHEDULERS.items()}, labelnames=("provider",),
+)
+REGISTRY.gauge(
+    "voice_upstream_in_flight", "Calls currently running against the upstream.",
+    lambda: {(name,): s.in_flight for name, s in SCHEDULERS.items()}, labelnames=("provider",),
+)
+REGISTRY.gauge(
+    "voice_upstream_circuit_open", "1 while the provider's circuit breaker is rejecting calls.",
+    lambda: {(name,): int(s.breaker.state == "open") for name, s in SCHEDULERS.items()}, labelnames=("provider",),
+)
@@ -0,0 +1,478 @@
+import os, json, time, uuid, zlib, sqlite3
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple
+from prompt import SYSTEM_PROMPT
+
+ROLES = {"s": "system", "u": "user", "a": "assistant"}
+COMPRESS_MIN_BYTES = 512  # smaller serialized histories are stored as plain JSON
+
+
+class Conversation:
+    """Message history for a single session, capped by turns and bytes.
+
+    `summary` holds a rolling summary of turns that were folded out of
+    `messages` (see `context.ContextBudget`); it counts towards `nbytes`.
+
+    `reply_timeline` holds the sentences of the last reply and when each
+    starts in its audio, until the next user message, so a client that
+    stopped playback early can say how far it got (see `record_played`).
+
+    In a store shared between processes, `version` is the stored version
+    this copy was loaded at and `journal` lists the changes made since, so
+    they can be re-applied on top of a newer version (see `rebase`).
+    """
+
+    def __init__(self, session_id: str, system_prompt: str = SYSTEM_PROMPT,
+                 max_turns: int = 20, max_bytes: int = 32_000) -> None:
+        self.session_id = session_id
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.messages: List[Dict[str, str]] = [dict(role='system', content=system_prompt)]
+        self.summary = ""
+        self.nbytes = 0
+        self.reply_timeline: Optional[Tuple[List[str], List[float]]] = None
+        self.created_at = self.last_seen = time.monotonic()
+        self.version = 0
+        self.journal: Optional[List[tuple]] = None
+
+    @staticmethod
+    def _size(message: Dict[str, str]) -> int:
+        return len(message['content'].encode('utf-8'))
+
+    def add_user_message(self, text: str):
+        self._log("append", 'user', text)
+        self._append(dict(role='user', content=text))
+
+    def add_assistant_message(self, text: str):
+        self._log("append", 'assistant', text)
+        self._append(dict(role='assistant', content=text))
+
+    def _log(self, *change):
+        if self.journal is not None:
+            self.journal.append(change)
+
+    def _append(self, message: Dict[str, str]):
+        if message['role'] == 'user':
+            self.reply_timeline = None
+        self.messages.append(message)
+        self.nbytes += self._size(message)
+        self.trim()
+
+    def record_interrupted_reply(self, text: str):
+        """Keep only the part of the last reply the user actually heard."""
+        replaced = None
+        if self.messages[-1]['role'] == 'assistant':
+            message = self.messages.pop()
+            self.nbytes -= self._size(message)
+            replaced = message['content']
+        self._log("interrupted", replaced, text)
+        if text:
+            self._append(dict(role='assistant', content=text))
+
+    def set_reply_timeline(self, sentences: List[str], starts: List[float]):
+        """Remember the sentences of the reply just sent and the second at which each starts playing."""
+        starts = [round(start, 3) for start in starts]
+        self._log("timeline", list(sentences), starts)
+        self.reply_timeline = (list(sentences), starts)
+
+    def record_played(self, seconds: float) -> bool:
+        """Trim the last reply to the sentences that had started playing after `seconds` of playback."""
+        if self.reply_timeline is None or self.messages[-1]['role'] != 'assistant':
+            return False
+        sentences, starts = self.reply_timeline
+        self.reply_timeline = None
+        heard = [sentence for sentence, start in zip(sentences, starts) if start < seconds]
+        if len(heard) == len(sentences):
+            return False
+        self.record_interrupted_reply(" ".join(heard))
+        return True
+
+    def fold(self, messages: List[Dict[str, str]], summary: str):
+        """Replace `messages`, the oldest turns, with an updated rolling `summary`."""
+        folded = {id(message) for message in messages}
+        removed = [message for message in self.messages[1:] if id(message) in folded]
+        if not removed:
+            return  # already trimmed or replaced by a rebase while the summary was written
+        self.messages[1:] = [message for message in self.messages[1:] if id(message) not in folded]
+        self.nbytes += len(summary.encode('utf-8')) - len(self.summary.encode('utf-8'))
+        self.nbytes -= sum(self._size(message) for message in removed)
+        self.summary = summary
+        self._log("fold", [(message['role'], message['content']) for message in removed], summary)
+
+    def rebase(self, latest: "Conversation"):
+        """Take on the state of `latest`, a newer stored version, and re-apply this copy's unsaved changes.
+
+        A change that no longer fits (the reply it cut short or the turns it
+        folded were already replaced by another process) is dropped; the
+        other process's history wins.
+        """
+        journal, self.journal = self.journal or [], []
+        self.messages, self.summary, self.nbytes = latest.messages, latest.summary, latest.nbytes
+        self.reply_timeline, self.version = latest.reply_timeline, latest.version
+        for kind, *args in journal:
+            if kind == "append":
+                self._log(kind, *args)
+                self._append(dict(role=args[0], content=args[1]))
+            elif kind == "interrupted":
+                last = self.messages[-1]
+                if args[0] == (last['content'] if last['role'] == 'assistant' else None):
+                    self.record_interrupted_reply(args[1])
+            elif kind == "fold":
+                head = self.messages[1:1 + len(args[0])]
+                if [(message['role'], message['content']) for message in head] == args[0]:
+                    self.fold(head, args[1])
+            elif kind == "timeline":
+                self.set_reply_timeline(*args)
+
+    def dumps(self, system_prompt: str = SYSTEM_PROMPT) -> bytes:
+        """Compact serialized form: roles as one letter each, the system prompt only if it isn't the default."""
+        system = self.messages[0]['content']
+        data = json.dumps([
+            self.summary,
+            None if system == system_prompt else system,
+            "".join(message['role'][0] for message in self.messages[1:]),
+            [message['content'] for message in self.messages[1:]],
+        ] + ([list(self.reply_timeline)] if self.reply_timeline else []), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        # A zlib stream never starts with "[", so `loads` can tell the two apart
+        return zlib.compress(data, 1) if len(data) >= COMPRESS_MIN_BYTES else data
+
+    @classmethod
+    def loads(cls, session_id: str, data: bytes, system_prompt: str = SYSTEM_PROMPT,
+              max_turns: int = 20, max_bytes: int = 32_000) -> "Conversation":
+        if data[:1] != b"[":
+            data = zlib.decompress(data)
+        summary, system, roles, contents, *timeline = json.loads(data)
+        conversation = cls(session_id, system if system is not None else system_prompt, max_turns, max_bytes)
+        conversation.messages += [dict(role=ROLES[role], content=content) for role, content in zip(roles, contents)]
+        conversation.summary = summary
+        conversation.reply_timeline = tuple(timeline[0]) if timeline else None
+        conversation.nbytes = len(summary.encode('utf-8')) + sum(map(cls._size, conversation.messages[1:]))
+        return conversation
+
+    @property
+    def turns(self) -> int:
+        return sum(1 for message in self.messages if message['role'] == 'user')
+
+    def trim(self):
+        # Drop the oldest messages after the system prompt, always keeping the latest one
+        while len(self.messages) > 2 and (self.turns > self.max_turns or self.nbytes > self.max_bytes):
+            self.nbytes -= self._size(self.messages.pop(1))
+        # Never start the history with an orphaned assistant reply
+        while len(self.messages) > 2 and self.messages[1]['role'] == 'assistant':
+            self.nbytes -= self._size(self.messages.pop(1))
+
+
+class SessionStore:
+    """LRU/TTL store of conversations keyed by session id.
+
+    Memory is bounded three ways: each conversation trims itself to
+    `max_turns`/`max_bytes_per_session`, idle sessions expire after `ttl`
+    seconds, and the least recently used sessions are evicted when there are
+    more than `max_sessions` or their history exceeds `max_total_bytes`.
+    """
+
+    def __init__(self, max_sessions: int = 10_000, ttl: float = 1800.0, max_turns: int = 20,
+                 max_bytes_per_session: int = 32_000, max_total_bytes: int = 256_000_000,
+                 system_prompt: str = SYSTEM_PROMPT) -> None:
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_bytes_per_session = max_bytes_per_session
+        self.max_total_bytes = max_total_bytes
+        self.system_prompt = system_prompt
+
+        self._sessions: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._accounted: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_env(cls) -> "SessionStore":
+        return cls(**session_limits_from_env())
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def get(self, session_id: Optional[str]) -> Conversation:
+        """Return the conversation for `session_id`, creating it if needed."""
+        self.expire()
+        if session_id is None:
+            session_id = self.new_session_id()
+
+        conversation = self._sessions.get(session_id)
+        if conversation is None:
+            conversation = Conversation(session_id, self.system_prompt,
+                                        self.max_turns, self.max_bytes_per_session)
+            self._sessions[session_id] = conversation
+            self._accounted[session_id] = 0
+            self.created += 1
+        else:
+            self._sessions.move_to_end(session_id)
+
+        conversation.last_seen = time.monotonic()
+        self._enforce_limits(keep=session_id)
+        return conversation
+
+    def touch(self, conversation: Conversation):
+        """Update memory accounting after a conversation has changed."""
+        session_id = conversation.session_id
+        if session_id not in self._sessions:
+            return
+        self._sessions.move_to_end(session_id)
+        conversation.last_seen = time.monotonic()
+        self.total_bytes += conversation.nbytes - self._accounted[session_id]
+        self._accounted[session_id] = conversation.nbytes
+        self._enforce_limits(keep=session_id)
+
+    def drop(self, session_id: str):
+        if session_id in self._sessions:
+            del self._sessions[session_id]
+            self.total_bytes -= self._accounted.pop(session_id)
+
+    def expire(self):
+        cutoff = time.monotonic() - self.ttl
+        # Sessions are kept in last-used order, so expired ones are at the front
+        while self._sessions:
+            session_id, conversation = next(iter(self._sessions.items()))
+            if conversation.last_seen >= cutoff:
+                break
+            self.drop(session_id)
+            self.expired += 1
+
+    def _enforce_limits(self, keep: Optional[str] = None):
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or self.total_bytes > self.max_total_bytes
+        ):
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                break
+            self.drop(session_id)
+            self.evicted += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "backend": "memory",
+            "live_sessions": len(self._sessions),
+            "total_bytes": self.total_bytes,
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "max_sessions": self.max_sessions,
+            "max_total_bytes": self.max_total_bytes,
+        }
+
+
+class SqliteSessionStore:
+    """Conversations shared by all worker processes on a host, kept in a SQLite database in WAL mode.
+
+    Has the same interface and limits as `SessionStore`. Each process keeps
+    up to `max_cached` conversations it has loaded and only deserializes one
+    again when another process has saved a newer version. Saving is
+    optimistic: `touch` writes only if the stored version is still the one
+    the conversation was loaded at. Otherwise another process got there
+    first, so the latest version is loaded, this copy's unsaved changes are
+    re-applied on top (`Conversation.rebase`) and the save is retried.
+    Expiry and the session and byte limits are enforced in SQL at most
+    every `expire_interval` seconds.
+
+    Like the in-memory store its calls are synchronous; a WAL-mode read or
+    write of one session takes tens of microseconds.
+    """
+
+    def __init__(self, path: str, max_sessions: int = 10_000, ttl: float = 1800.0, max_turns: int = 20,
+                 max_bytes_per_session: int = 32_000, max_total_bytes: int = 256_000_000,
+                 system_prompt: str = SYSTEM_PROMPT, max_cached: int = 1024, busy_timeout: float = 5.0,
+                 expire_interval: float = 10.0, max_attempts: int = 5) -> None:
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_bytes_per_session = max_bytes_per_session
+        self.max_total_bytes = max_total_bytes
+        self.system_prompt = system_prompt
+        self.max_cached = max_cached
+        self.expire_interval = expire_interval
+        self.max_attempts = max_attempts
+
+        self._cache: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._next_expiry = 0.0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.conflicts = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Autocommit: every statement is its own short transaction
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, version INTEGER NOT NULL,"
+            " last_seen REAL NOT NULL, nbytes INTEGER NOT NULL, data BLOB NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)")
+
+    @classmethod
+    def from_env(cls, path: str) -> "SqliteSessionStore":
+        return cls(os.getenv("SESSION_DB", path), **session_limits_from_env())
+
+    new_session_id = staticmethod(SessionStore.new_session_id)
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def __contains__(self, session_id: str) -> bool:
+        return self._db.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+
+    @property
+    def total_bytes(self) -> int:
+        return self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM sessions").fetchone()[0]
+
+    def _new(self, session_id: str) -> Conversation:
+        conversation = Conversation(session_id, self.system_prompt, self.max_turns, self.max_bytes_per_session)
+        conversation.journal = []
+        return conversation
+
+    def _load(self, session_id: str) -> Optional[Conversation]:
+        row = self._db.execute("SELECT version, data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        conversation = Conversation.loads(session_id, row[1], self.system_prompt,
+                                          self.max_turns, self.max_bytes_per_session)
+        conversation.version = row[0]
+        conversation.journal = []
+        return conversation
+
+    def get(self, session_id: Optional[str]) -> Conversation:
+        """Return the conversation for `session_id`, creating it if needed."""
+        if time.monotonic() >= self._next_expiry:
+            self.expire()
+        if session_id is None:
+            session_id = self.new_session_id()
+
+        conversation = self._cache.get(session_id)
+        row = self._db.execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            # Unsaved sessions live only in this process until their first `touch`
+            if conversation is None or conversation.version:
+                conversation = self._new(session_id)
+                self.created += 1
+        elif conversation is None or conversation.version != row[0]:
+            conversation = self._load(session_id) or self._new(session_id)
+
+        self._remember(conversation)
+        conversation.last_seen = time.monotonic()
+        return conversation
+
+    def _remember(self, conversation: Conversation):
+        self._cache[conversation.session_id] = conversation
+        self._cache.move_to_end(conversation.session_id)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def touch(self, conversation: Conversation):
+        """Save a conversation after it has changed."""
+        for _ in range(self.max_attempts):
+            if self._save(conversation):
+                conversation.journal = []
+                conversation.last_seen = time.monotonic()
+                self._remember(conversation)
+                return
+            self.conflicts += 1
+            latest = self._load(conversation.session_id)
+            if latest is None:
+                # Expired or evicted since it was loaded: save what this process has as a new session
+                conversation.version = 0
+            else:
+                conversation.rebase(latest)
+        print(f"Could not save session {conversation.session_id}: {self.max_attempts} conflicting writes in a row")
+
+    def _save(self, conversation: Conversation) -> bool:
+        row = (time.time(), conversation.nbytes, conversation.dumps(self.system_prompt))
+        if conversation.version == 0:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO sessions (id, version, last_seen, nbytes, data) VALUES (?, 1, ?, ?, ?)",
+                (conversation.session_id,) + row,
+            )
+        else:
+            cursor = self._db.execute(
+                "UPDATE sessions SET version = version + 1, last_seen = ?, nbytes = ?, data = ?"
+                " WHERE id = ? AND version = ?",
+                row + (conversation.session_id, conversation.version),
+            )
+        if cursor.rowcount != 1:
+            return False
+        conversation.version += 1
+        return True
+
+    def drop(self, session_id: str):
+        self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        self._cache.pop(session_id, None)
+
+    def expire(self):
+        """Delete idle sessions, then the least recently used ones while over the session or byte limit."""
+        self._next_expiry = time.monotonic() + self.expire_interval
+        self.expired += self._db.execute("DELETE FROM sessions WHERE last_seen < ?", (time.time() - self.ttl,)).rowcount
+        count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM sessions").fetchone()
+        if count > self.max_sessions:
+            self.evicted += self._db.execute(
+                "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY last_seen DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions,),
+            ).rowcount
+        if total > self.max_total_bytes:
+            self.evicted += self._db.execute(
+                "DELETE FROM sessions WHERE id IN (SELECT id FROM (SELECT id, SUM(nbytes) OVER"
+                " (ORDER BY last_seen DESC) AS running FROM sessions) WHERE running > ?)",
+                (self.max_total_bytes,),
+            ).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM sessions").fetchone()
+        return {
+            "backend": "sqlite",
+            "live_sessions": count,
+            "total_bytes": total,
+            "cached_in_process": len(self._cache),
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "conflicts": self.conflicts,
+            "max_sessions": self.max_sessions,
+            "max_total_bytes": self.max_total_bytes,
+        }
+
+
+def session_limits_from_env() -> Dict[str, float]:
+    return dict(
+        max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", 10_000)),
+        ttl=float(os.getenv("SESSION_TTL", 1800)),
+        max_turns=int(os.getenv("SESSION_MAX_TURNS", 20)),
+        max_bytes_per_session=int(os.getenv("SESSION_MAX_BYTES", 32_000)),
+        max_total_bytes=int(os.getenv("SESSION_MAX_TOTAL_BYTES", 256_000_000)),
+    )
+
+
+def session_store_from_env(path: str):
+    """The in-memory store, or with SESSION_BACKEND=sqlite one shared by all worker processes.
+
+    The shared store is the default when WEB_CONCURRENCY (uvicorn's worker
+    count) is above 1, since each worker would otherwise only see the turns
+    it served itself.
+    """
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    backend = os.getenv("SESSION_BACKEND") or ("sqlite" if workers > 1 else "memory")
+    if backend == "memory":
+        return SessionStore.from_env()
+    if backend == "sqlite":
+        return SqliteSessionStore.from_env(path)
+    raise ValueError(f"Unknown session backend {backend}, expected memory or sqlite")
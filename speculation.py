@@ -0,0 +1,216 @@
+import re, time, asyncio
+from typing import Optional, Dict, List, Tuple
+
+from metrics import REGISTRY
+from context import count_tokens
+
+SPECULATIONS = REGISTRY.counter(
+    "voice_speculations_total",
+    "Replies started on interim transcripts: hit (reused), miss (final differed), restarted or cancelled.",
+    labelnames=("outcome",),
+)
+WASTED_TOKENS = REGISTRY.counter(
+    "voice_speculation_wasted_tokens_total",
+    "Estimated completion tokens generated for speculative replies that were thrown away.",
+)
+
+
+def normalize_transcript(text: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace, so "Hi, there." matches "hi there"."""
+    return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+
+class ScratchConversation:
+    """A copy-on-write view of a conversation for a reply that may be discarded.
+
+    Messages added before `commit` only exist here. `commit` applies them to
+    the real conversation, and any messages added after that go straight
+    through.
+    """
+
+    def __init__(self, conversation) -> None:
+        self.conversation = conversation
+        self.messages = list(conversation.messages)
+        self.committed = False
+        self._base_last = conversation.messages[-1] if conversation.messages else None
+        self._pending: List[Tuple[str, str]] = []
+
+    @property
+    def summary(self) -> str:
+        return getattr(self.conversation, "summary", "")
+
+    def is_current(self) -> bool:
+        """False if the real conversation moved on since this copy was taken."""
+        messages = self.conversation.messages
+        return (messages[-1] if messages else None) is self._base_last
+
+    def add_user_message(self, text: str):
+        self._add("add_user_message", "user", text)
+
+    def add_assistant_message(self, text: str):
+        self._add("add_assistant_message", "assistant", text)
+
+    def _add(self, method: str, role: str, text: str):
+        if self.committed:
+            getattr(self.conversation, method)(text)
+            return
+        self.messages.append(dict(role=role, content=text))
+        self._pending.append((method, text))
+
+    def commit(self):
+        self.committed = True
+        for method, text in self._pending:
+            getattr(self.conversation, method)(text)
+        self._pending = []
+
+
+class SpeculativeTrace:
+    """Stands in for a `metrics.TurnTrace` while a speculative reply is generated.
+
+    Stages and the prompt size are held back (a discarded speculation is not
+    a turn) until `adopt` hands them to the trace of the turn that used the
+    reply; from then on everything goes straight to that trace.
+    """
+
+    def __init__(self) -> None:
+        self.marks: Dict[str, float] = {}
+        self.prompt_tokens: Optional[int] = None
+        self.turn = None
+
+    def mark(self, stage: str):
+        if self.turn is not None:
+            self.turn.mark(stage)
+        else:
+            self.marks.setdefault(stage, time.perf_counter())
+
+    def observe_prompt(self, tokens: int):
+        if self.turn is not None:
+            self.turn.observe_prompt(tokens)
+        else:
+            self.prompt_tokens = tokens
+
+    def adopt(self, turn):
+        self.turn = turn
+        for stage, at in self.marks.items():
+            turn.mark(stage, at=at)
+        if self.prompt_tokens is not None:
+            turn.observe_prompt(self.prompt_tokens)
+
+
+class Speculation:
+    """A reply being generated in the background for a transcript that is not final yet."""
+
+    def __init__(self, text: str, chunks, scratch: Optional[ScratchConversation] = None,
+                 trace: Optional[SpeculativeTrace] = None) -> None:
+        self.text = text
+        self.key = normalize_transcript(text)
+        self.scratch = scratch
+        self.trace = trace
+        self.chunks: List[str] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self._updated = asyncio.Event()
+        self.task = asyncio.create_task(self._collect(chunks))
+
+    async def _collect(self, chunks):
+        try:
+            async for chunk in chunks:
+                self.chunks.append(chunk)
+                self._updated.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._updated.set()
+
+    def commit(self, trace=None):
+        """Use this reply for the turn: apply its history and report its timings to `trace`."""
+        if self.scratch is not None:
+            self.scratch.commit()
+        if self.trace is not None and trace is not None:
+            self.trace.adopt(trace)
+
+    def cancel(self) -> int:
+        """Stop generating and return the estimated number of tokens produced."""
+        self.task.cancel()
+        return sum(count_tokens(chunk) for chunk in self.chunks)
+
+    async def replay(self):
+        """Yield the chunks generated so far, then follow the live generation."""
+        i = 0
+        try:
+            while True:
+                while i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self._updated.clear()
+                await self._updated.wait()
+        finally:
+            if not self.finished:
+                self.task.cancel()
+
+
+class Speculator:
+    """Start replies on stable interim transcripts and reuse them on a matching final.
+
+    `start(text, trace)` returns `(chunks, scratch)`: an async iterator of
+    reply chunks generated against `scratch`, a `ScratchConversation`,
+    reporting to `trace`, a `SpeculativeTrace`. Feed
+    `observe` the transcript heard so far after every interim result; once the
+    same text has been seen `stable_repeats` times (or Deepgram finalized a
+    segment), a speculation is started. When the utterance is complete,
+    `take(final_text)` returns the speculation if its normalized text matches
+    and the conversation has not changed since, and cancels it otherwise.
+    """
+
+    def __init__(self, start, min_chars: int = 12, stable_repeats: int = 2) -> None:
+        self.start = start
+        self.min_chars = min_chars
+        self.stable_repeats = stable_repeats
+        self.current: Optional[Speculation] = None
+        self._last_key = ""
+        self._repeats = 0
+
+    def observe(self, text: str, segment_final: bool = False):
+        key = normalize_transcript(text)
+        if len(key) < self.min_chars:
+            return
+        if key == self._last_key:
+            self._repeats += 1
+        else:
+            self._last_key, self._repeats = key, 1
+        if not segment_final and self._repeats < self.stable_repeats:
+            return
+        if self.current is not None:
+            if self.current.key == key:
+                return
+            self._discard("restarted")
+        trace = SpeculativeTrace()
+        chunks, scratch = self.start(text, trace)
+        self.current = Speculation(text, chunks, scratch, trace)
+
+    def take(self, final_text: str) -> Optional[Speculation]:
+        speculation = self.current
+        self.current, self._last_key, self._repeats = None, "", 0
+        if speculation is None:
+            return None
+        stale = speculation.scratch is not None and not speculation.scratch.is_current()
+        if speculation.key != normalize_transcript(final_text) or stale or speculation.error is not None:
+            self.current = speculation
+            self._discard("miss")
+            return None
+        SPECULATIONS.inc("hit")
+        return speculation
+
+    def cancel(self):
+        if self.current is not None:
+            self._discard("cancelled")
+
+    def _discard(self, outcome: str):
+        speculation, self.current = self.current, None
+        SPECULATIONS.inc(outcome)
+        WASTED_TOKENS.inc(amount=speculation.cancel())
@@ -0,0 +1,65 @@
+import os, time, asyncio, importlib
+from typing import Optional, Dict, List
+
+from metrics import REGISTRY
+
+
+class Readiness:
+    """Startup warm-up steps, and whether this process should take traffic yet.
+
+    `run` times each step and records whether it failed. A failed step is
+    reported but does not hold back readiness: an upstream that is down at
+    startup is the circuit breakers' job, and a pod that never turns ready
+    does not help during a scale-out. `mark_ready` is called once warm-up has
+    finished or timed out.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.ready_after: Optional[float] = None
+        self.steps: Dict[str, Dict[str, object]] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_after is not None
+
+    async def run(self, name: str, awaitable) -> bool:
+        start = time.monotonic()
+        error = None
+        try:
+            await awaitable
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            print(f"Startup step {name} failed: {error}")
+        self.steps[name] = {"seconds": round(time.monotonic() - start, 3), "ok": error is None}
+        if error is not None:
+            self.steps[name]["error"] = error
+        return error is None
+
+    def mark_ready(self):
+        if self.ready_after is None:
+            self.ready_after = time.monotonic() - self.started
+
+    def status(self) -> Dict[str, object]:
+        return {
+            "ready": self.ready,
+            "pid": os.getpid(),
+            "seconds_to_ready": round(self.ready_after, 3) if self.ready else None,
+            "uptime_seconds": round(time.monotonic() - self.started, 3),
+            "steps": self.steps,
+        }
+
+
+async def preload(modules: List[str]):
+    """Import modules that are only needed later (and slow to import) in a worker thread."""
+    def load():
+        for name in modules:
+            importlib.import_module(name)
+
+    await asyncio.to_thread(load)
+
+
+READINESS = Readiness()
+
+REGISTRY.gauge("voice_ready", "1 once startup warm-up has finished.", lambda: float(READINESS.ready))
+REGISTRY.gauge("voice_startup_seconds", "Seconds from import to ready.", lambda: READINESS.ready_after or 0.0)
@@ -0,0 +1,173 @@
+from typing import Optional, List, NamedTuple
+
+
+class StreamError(Exception):
+    """Raised when an upstream event stream reports an error or is malformed."""
+
+
+class SSEEvent(NamedTuple):
+    event: Optional[str]
+    data: str
+
+    @property
+    def done(self) -> bool:
+        return self.data.strip() == "[DONE]"
+
+
+class SSEParser:
+    """Incremental server-sent events parser.
+
+    Feed it one line at a time (as produced by `aiter_lines`); it returns an
+    `SSEEvent` whenever a blank line completes an event. Multi-line `data:`
+    fields are joined with newlines, comments and unknown fields are ignored.
+    """
+
+    def __init__(self) -> None:
+        self._event: Optional[str] = None
+        self._data: List[str] = []
+
+    def feed_line(self, line: str) -> Optional[SSEEvent]:
+        line = line.rstrip("\r\n")
+        if not line:
+            return self._dispatch()
+        if line.startswith(":"):
+            return None
+
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        return None
+
+    def finish(self) -> Optional[SSEEvent]:
+        """Return the last event if the stream ended without a blank line."""
+        return self._dispatch()
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data:
+            self._event = None
+            return None
+        event = SSEEvent(self._event, "\n".join(self._data))
+        self._event, self._data = None, []
+        return event
+
+
+async def aiter_sse(lines):
+    """Turn an async iterator of text lines into `SSEEvent`s."""
+    parser = SSEParser()
+    async for line in lines:
+        event = parser.feed_line(line)
+        if event is not None:
+            yield event
+    event = parser.finish()
+    if event is not None:
+        yield event
+
+
+class SentenceSegmenter:
+    """Split a token stream into chunks that are worth sending to TTS.
+
+    Chunks end on sentence punctuation followed by whitespace, skipping common
+    abbreviations ("Dr.", "e.g.") and decimals ("3.5"). The first chunk is
+    kept short so speech can start early; later chunks merge short sentences
+    up to `min_chars` and are force-split at a clause or word boundary once
+    they reach `max_chars`.
+    """
+
+    TERMINATORS = ".?!"
+    CLOSERS = "\"')]"
+    CLAUSE_BREAKS = ",;:"
+    ABBREVIATIONS = {
+        "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "vs", "etc", "approx",
+        "dept", "fig", "est", "e.g", "i.e", "a.m", "p.m", "u.s", "u.k",
+    }
+
+    def __init__(self, min_chars: int = 40, max_chars: int = 250,
+                 first_min_chars: int = 1, first_max_chars: int = 60) -> None:
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.first_min_chars = first_min_chars
+        self.first_max_chars = first_max_chars
+        self.chunks_emitted = 0
+        self._reset("")
+
+    def _reset(self, buffer: str):
+        self._buffer = buffer
+        self._scan = 0
+        self._last_clause = -1
+        self._last_space = -1
+
+    @property
+    def _limits(self):
+        if self.chunks_emitted == 0:
+            return self.first_min_chars, self.first_max_chars
+        return self.min_chars, self.max_chars
+
+    def feed(self, text: str) -> List[str]:
+        """Add streamed text and return any chunks that are now complete."""
+        self._buffer += text
+        chunks = []
+        while True:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return chunks
+            if chunk:
+                chunks.append(chunk)
+
+    def flush(self) -> Optional[str]:
+        """Return whatever text is left once the stream has ended."""
+        chunk = self._buffer.strip()
+        self._reset("")
+        if chunk:
+            self.chunks_emitted += 1
+            return chunk
+        return None
+
+    def _is_abbreviation(self, end: int) -> bool:
+        start = end
+        while start > 0 and not self._buffer[start - 1].isspace():
+            start -= 1
+        word = self._buffer[start:end].lstrip("\"'([").lower()
+        return word in self.ABBREVIATIONS or (len(word) == 1 and word.isalpha() and word != "i")
+
+    def _next_chunk(self) -> Optional[str]:
+        buffer = self._buffer
+        min_chars, max_chars = self._limits
+        i = self._scan
+        while i < len(buffer):
+            char = buffer[i]
+            if char in self.TERMINATORS:
+                end = i + 1
+                while end < len(buffer) and buffer[end] in self.TERMINATORS + self.CLOSERS:
+                    end += 1
+                if end >= len(buffer):
+                    break  # wait for the next token to see what follows
+                if buffer[end].isspace() and end >= min_chars and not (char == "." and self._is_abbreviation(i)):
+                    return self._cut(end)
+                i = end
+                continue
+            if char == "\n" and len(buffer[:i].strip()) >= min_chars:
+                return self._cut(i)
+            if char in self.CLAUSE_BREAKS:
+                if i + 1 >= len(buffer):
+                    break  # a token ending in a comma: see whether a space follows
+                if buffer[i + 1].isspace():
+                    self._last_clause = i + 1
+            elif char.isspace():
+                self._last_space = i
+            if i + 1 >= max_chars:
+                cut = self._last_clause if self._last_clause > 0 else self._last_space
+                return self._cut(cut if cut > 0 else i + 1)
+            i += 1
+        self._scan = i
+        return None
+
+    def _cut(self, end: int) -> str:
+        chunk = self._buffer[:end].strip()
+        self._reset(self._buffer[end:].lstrip())
+        if chunk:
+            self.chunks_emitted += 1
+        return chunk
@@ -1,7 +1,13 @@
-import shutil, wave
+import shutil, wave, json
 from dotenv import load_dotenv
+from voice import http_clients
+from streaming import SentenceSegmenter, aiter_sse
+from vad import VoiceActivityDetector
+from speculation import Speculator, ScratchConversation
+from context import ContextBudget
+from prompt import SUMMARY_PROMPT
 from typing import Optional, Dict, List
-import asyncio, requests, os, time, subprocess
+import asyncio, os, time
 from deepgram import ( DeepgramClient, DeepgramClientOptions, 
                 LiveTranscriptionEvents, LiveOptions, Microphone )
 
@@ -36,6 +42,10 @@ class LanguageModelProcessor:
         self.API_KEY = os.getenv("TOGETHER_API_KEY")
         self.base_url = "https://api.together.xyz/v1/chat/completions"
         self.headers = {"Authorization": f"Bearer {self.API_KEY}"}
+        self.max_tokens = 3129
+        # Only the system prompt, a rolling summary and the latest turns are sent
+        self.context = ContextBudget.from_env()
+        self.summary = ""
         if model_name in VALID_LANGUAGE_MODELS:
             self.model_name = model_name 
         else:
@@ -80,38 +90,88 @@ If you can, guess what the user is saying and respond to it naturally.""")]
         
     def add_assistant_message(self, text:str):
         self.messages.append(dict(role='assistant', content=text))
+
+    def record_interrupted_reply(self, text:str):
+        if self.messages[-1]['role'] == 'assistant':
+            self.messages.pop()
+        if text:
+            self.add_assistant_message(text)
+
+    def fold(self, messages, summary:str):
+        folded = {id(message) for message in messages}
+        kept = [message for message in self.messages[1:] if id(message) not in folded]
+        if len(kept) == len(self.messages) - 1:
+            return  # none of them are left to fold
+        self.messages[1:] = kept
+        self.summary = summary
     
-    def generate(self):
+    async def generate(self, messages=None, max_tokens=None):
+        """Stream completion tokens as they arrive."""
         payload = {
             "top_k": 75,
             "top_p": 0.90,
-            "max_tokens": 3129,
+            "max_tokens": max_tokens or self.max_tokens,
             "temperature": 0.4,
             "repetition_penalty": 1,
             "model": self.model_name,
-            "messages": self.messages,
+            "messages": messages or self.messages,
             "stop": ["<|eot_id|>", "[/INST]", "</s>", "<|im_end|>"],
+            "stream": True,
         }
-        response = requests.post(self.base_url, json=payload, headers=self.headers)
-        if response.status_code == 200:
-            resp = response.json()['choices'][0]['message']['content']
-            return resp
-
-    def process(self, text):
-        self.add_user_message(text)
+        client = http_clients.get(self.base_url)
+        async with client.stream("POST", self.base_url, json=payload, headers=self.headers) as response:
+            response.raise_for_status()
+            async for event in aiter_sse(response.aiter_lines()):
+                if event.done:
+                    break
+                choice = json.loads(event.data)['choices'][0]
+                yield choice.get('text') or (choice.get('delta') or {}).get('content') or ""
+
+    async def process(self, text, conversation=None):
+        """Yield the reply sentence by sentence while the model is still generating.
+
+        `conversation` defaults to this processor; pass a `ScratchConversation`
+        to generate without touching the history until it is committed.
+        """
+        conversation = conversation or self
+        conversation.add_user_message(text)
+        messages, prompt_tokens = self.context.prompt(conversation)
+        print(f"LLM prompt: {prompt_tokens} tokens")
         start_time = time.time()
-
-        response = self.generate()
-        end_time = time.time()
-
-        self.add_assistant_message(response)
+        first_token_time = None
+
+        segmenter = SentenceSegmenter()
+        response = []
+        async for token in self.generate(messages, self.context.completion_tokens(prompt_tokens, self.max_tokens)):
+            if first_token_time is None:
+                first_token_time = time.time()
+                print(f"LLM Time to First Token: {int((first_token_time - start_time) * 1000)}ms")
+            response.append(token)
+            for sentence in segmenter.feed(token):
+                yield sentence
+        sentence = segmenter.flush()
+        if sentence:
+            yield sentence
+
+        response = "".join(response)
+        conversation.add_assistant_message(response)
         
-        elapsed_time = int((end_time - start_time) * 1000)
+        elapsed_time = int((time.time() - start_time) * 1000)
         print(f"LLM ({elapsed_time}ms): {response}")
-        return response
+
+    async def summarize(self, summary:str, messages) -> str:
+        """Fold `messages` into the running `summary`; called after a turn, never before one."""
+        turns = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        prompt = [
+            dict(role='system', content=SUMMARY_PROMPT),
+            dict(role='user', content=f"Summary so far:\n{summary or '(empty)'}\n\nNew turns:\n{turns}"),
+        ]
+        return "".join([token async for token in self.generate(prompt, max_tokens=256)])
 
 
 class TextToSpeech:
+    SAMPLE_RATE = 24000
+
     def __init__(self, model_name: Optional[str]=None) -> None:
         self.API_KEY = os.getenv("DEEPGRAM_API_KEY")
         if model_name in VALID_VOICE_MODELS:
@@ -120,41 +180,80 @@ class TextToSpeech:
             self.model_name = "aura-asteria-en"
         
         self.headers = {"Authorization": f"Token {self.API_KEY}", "Content-Type": "application/json"}
-        self.base_url = f"https://api.deepgram.com/v1/speak?model={self.model_name}&performance=some&encoding=linear16&sample_rate=24000"
-        
-        if not self.is_installed("ffplay"):
-            raise ValueError("ffplay not found, necessary to stream audio.")
-
-    def is_installed(self, lib_name: str) -> bool:
-        lib = shutil.which(lib_name)
-        return lib is not None
+        # Headerless PCM so the audio of consecutive sentences can go to one player
+        self.base_url = f"https://api.deepgram.com/v1/speak?model={self.model_name}&performance=some&encoding=linear16&sample_rate={self.SAMPLE_RATE}&container=none"
 
-    def speak(self, text: str):
-        payload = {"text": text}
-        player_command = ["ffplay", "-autoexit", "-", "-nodisp"]
-        player_process = subprocess.Popen(
-            player_command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        
+    async def stream(self, text: str):
+        """Yield raw linear16 audio for `text` as it is synthesized."""
         first_byte_time = None        # Initialize a variable to store the time when the first byte is received
         start_time = time.time()      # Record the time before sending the request
-        
-        with requests.post(self.base_url, stream=True, headers=self.headers, json=payload) as r:
-            for chunk in r.iter_content(chunk_size=1024):
+
+        client = http_clients.get(self.base_url)
+        async with client.stream("POST", self.base_url, headers=self.headers, json={"text": text}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size=4096):
                 if chunk:
                     if first_byte_time is None:                             # Check if this is the first chunk received
                         first_byte_time = time.time()                       # Record the time when the first byte is received
                         ttfb = int((first_byte_time - start_time)*1000)     # Calculate the time to first byte
-                        print(f"TTS Time to First Byte (TTFB): {ttfb}ms\n")
-                    player_process.stdin.write(chunk)
-                    player_process.stdin.flush()
-        
-        if player_process.stdin:
-            player_process.stdin.close()
-        player_process.wait()
+                        print(f"TTS Time to First Byte (TTFB): {ttfb}ms")
+                    yield chunk
+
+
+class Player:
+    """One ffplay process fed raw PCM, kept alive across sentences and turns.
+
+    It also keeps track of when the audio written so far will have finished
+    playing, so a barge-in can tell which sentences were actually heard.
+    """
+    def __init__(self, sample_rate: int = TextToSpeech.SAMPLE_RATE) -> None:
+        if not self.is_installed("ffplay"):
+            raise ValueError("ffplay not found, necessary to stream audio.")
+        self.sample_rate = sample_rate
+        self.bytes_per_second = sample_rate * 2
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.play_until = 0.0
+
+    @staticmethod
+    def is_installed(lib_name: str) -> bool:
+        lib = shutil.which(lib_name)
+        return lib is not None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            "ffplay", "-nodisp", "-loglevel", "quiet",
+            "-f", "s16le", "-sample_rate", str(self.sample_rate), "-",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self.play_until = 0.0
+
+    def is_playing(self) -> bool:
+        return time.monotonic() < self.play_until
+
+    async def write(self, chunk: bytes) -> float:
+        """Queue `chunk` for playback and return when it will start playing."""
+        if self.process is None or self.process.returncode is not None:
+            await self.start()
+        starts_at = max(time.monotonic(), self.play_until)
+        self.play_until = starts_at + len(chunk) / self.bytes_per_second
+        self.process.stdin.write(chunk)
+        await self.process.stdin.drain()
+        return starts_at
+
+    def stop(self):
+        """Silence playback immediately; the next write starts a fresh player."""
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+        self.process = None
+        self.play_until = 0.0
+
+    async def close(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.stdin.close()
+            await self.process.wait()
+        self.process = None
 
 
 class SpeechToText:
@@ -180,39 +279,77 @@ class TranscriptCollector:
         return ' '.join(self.transcript_parts)
 
 
-
-transcript_collector = TranscriptCollector()
-
-
-async def get_transcript(callback):
-    transcription_complete = asyncio.Event()  # Event to signal transcription completion
-
-    try:
+class Listener:
+    """Microphone and Deepgram live connection, kept open for the whole conversation.
+
+    Microphone frames go through a local VAD first, so silence is not
+    streamed to Deepgram; with VAD_ENDPOINT_MS set, the VAD also decides
+    when an utterance has ended.
+    """
+    def __init__(self, use_vad: bool = True) -> None:
+        self.utterances = asyncio.Queue()
+        self.transcript_collector = TranscriptCollector()
+        self.connection = None
+        self.microphone = None
+        self.vad = VoiceActivityDetector.from_env(16000) if use_vad else None
+        self.loop = None
+        self.interim = ""
+        self.endpoint_pending = False
+
+    def emit_utterance(self):
+        self.endpoint_pending = False
+        full_sentence = self.transcript_collector.get_full_transcript().strip()
+        self.transcript_collector.reset()
+        if len(full_sentence) > 0:
+            self.utterances.put_nowait(full_sentence)
+
+    def on_endpoint(self):
+        # Runs on the main loop; Deepgram may still owe us the final for the last words
+        if self.transcript_collector.transcript_parts and not self.interim:
+            self.emit_utterance()
+        else:
+            self.endpoint_pending = True
+
+    async def send(self, pcm: bytes):
+        # Called from the microphone's own thread and event loop
+        if self.vad is not None:
+            pcm, events = self.vad.process(pcm)
+            for event in events:
+                if event.kind == "endpoint":
+                    self.loop.call_soon_threadsafe(self.on_endpoint)
+            if not pcm:
+                return
+        await self.connection.send(pcm)
+
+    async def start(self, on_speech=None, on_partial=None):
+        self.loop = asyncio.get_running_loop()
         # example of setting up a client config. logging values: WARNING, VERBOSE, DEBUG, SPAM
         config = DeepgramClientOptions(options={"keepalive": "true"})
         deepgram: DeepgramClient = DeepgramClient("", config)
 
-        dg_connection = deepgram.listen.asynclive.v("1")
+        self.connection = deepgram.listen.asynclive.v("1")
         print ("Listening...")
 
-        async def on_message(self, result, **kwargs):
+        async def on_message(_, result, **kwargs):
             sentence = result.channel.alternatives[0].transcript
-            
-            if not result.speech_final:
-                transcript_collector.add_part(sentence)
+            if on_speech is not None and sentence.strip():
+                await on_speech(sentence)
+
+            if result.is_final:
+                self.interim = ""
+                if sentence:
+                    self.transcript_collector.add_part(sentence)
             else:
+                self.interim = sentence.strip()
+            if result.speech_final or (result.is_final and self.endpoint_pending):
                 # This is the final part of the current sentence
-                transcript_collector.add_part(sentence)
-                full_sentence = transcript_collector.get_full_transcript()
-                # Check if the full_sentence is not empty before printing
-                if len(full_sentence.strip()) > 0:
-                    full_sentence = full_sentence.strip()
-                    print(f"Human: {full_sentence}")
-                    callback(full_sentence)  # Call the callback with the full_sentence
-                    transcript_collector.reset()
-                    transcription_complete.set()  # Signal to stop transcription and exit
-
-        dg_connection.on(LiveTranscriptionEvents.Transcript, on_message)
+                self.emit_utterance()
+            elif on_partial is not None:
+                heard = " ".join(self.transcript_collector.transcript_parts + [self.interim]).strip()
+                if heard:
+                    on_partial(heard, result.is_final)
+
+        self.connection.on(LiveTranscriptionEvents.Transcript, on_message)
 
         options = LiveOptions(
             model="nova-2",
@@ -222,53 +359,145 @@ async def get_transcript(callback):
             channels=1,
             sample_rate=16000,
             endpointing=300,
+            interim_results=True,
             smart_format=True,
         )
 
-        await dg_connection.start(options)
+        if not await self.connection.start(options):
+            raise RuntimeError("Could not open socket")
 
         # Open a microphone stream on the default input device
-        microphone = Microphone(dg_connection.send)
-        microphone.start()
-
-        await transcription_complete.wait()  # Wait for the transcription to complete instead of looping indefinitely
+        self.microphone = Microphone(self.send)
+        self.microphone.start()
 
-        # Wait for the microphone to close
-        microphone.finish()
-
-        # Indicate that we've finished
-        await dg_connection.finish()
-
-    except Exception as e:
-        print(f"Could not open socket: {e}")
-        return
+    async def finish(self):
+        if self.microphone is not None:
+            self.microphone.finish()
+        if self.connection is not None:
+            await self.connection.finish()
 
 
 class ConversationManager:
-    def __init__(self):
-        self.transcription_response = ""
+    def __init__(self, max_in_flight: int = 3, barge_in: bool = True, speculative: bool = False):
         self.llm = LanguageModelProcessor("meta-llama/Llama-3-8b-chat-hf")
+        self.tts = TextToSpeech()
+        self.player = Player()
+        self.listener = Listener()
+        self.max_in_flight = max_in_flight
+        # Barge-in needs headphones or echo cancellation, or the assistant interrupts itself
+        self.barge_in = barge_in
+        self.reply_task: Optional[asyncio.Task] = None
+        self.sentences: List[tuple] = []   # (sentence, time it starts playing) for the current reply
+        # Start the LLM on stable interim transcripts, during Deepgram's endpointing silence
+        self.speculator = Speculator(self.speculate) if speculative else None
+
+    def speculate(self, text: str, trace=None):
+        scratch = ScratchConversation(self.llm)
+        return self.llm.process(text, scratch), scratch
+
+    def on_partial(self, text: str, segment_final: bool):
+        if self.speculator is not None and not self.is_speaking():
+            self.speculator.observe(text, segment_final)
+
+    async def speak_reply(self, text: str, speculation=None):
+        """Synthesize sentences concurrently as the LLM produces them and play them in order."""
+        self.sentences = []
+        order = asyncio.Queue()
+        slots = asyncio.Semaphore(self.max_in_flight)
+
+        async def synthesize(sentence, chunks):
+            try:
+                async for chunk in self.tts.stream(sentence):
+                    chunks.put_nowait(chunk)
+            finally:
+                chunks.put_nowait(None)
+                slots.release()
+
+        async def produce():
+            if speculation is not None:
+                speculation.commit()
+                print("(speculative reply reused)")
+            replies = speculation.replay() if speculation is not None else self.llm.process(text)
+            try:
+                async for sentence in replies:
+                    await slots.acquire()
+                    chunks = asyncio.Queue()
+                    order.put_nowait((sentence, asyncio.create_task(synthesize(sentence, chunks)), chunks))
+            finally:
+                order.put_nowait(None)
+
+        producer = asyncio.create_task(produce())
+        tasks = []
+        try:
+            while (item := await order.get()) is not None:
+                sentence, task, chunks = item
+                tasks.append(task)
+                started = False
+                while (chunk := await chunks.get()) is not None:
+                    starts_at = await self.player.write(chunk)
+                    if not started:
+                        started = True
+                        self.sentences.append((sentence, starts_at))
+                await task
+            await producer
+        except Exception as e:
+            print(f"Exception in speak_reply: {e}")
+        finally:
+            self.llm.context.schedule(self.llm, self.llm.summarize)
+            producer.cancel()
+            if speculation is not None:
+                speculation.task.cancel()
+            for task in tasks:
+                task.cancel()
+            while not order.empty():
+                item = order.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+
+    def is_speaking(self) -> bool:
+        return (self.reply_task is not None and not self.reply_task.done()) or self.player.is_playing()
+
+    async def interrupt(self):
+        """Stop talking now and keep only the sentences the user heard."""
+        interrupted_at = time.monotonic()
+        self.player.stop()
+        if self.reply_task is not None and not self.reply_task.done():
+            self.reply_task.cancel()
+            await asyncio.wait([self.reply_task])
+        heard = [sentence for sentence, starts_at in self.sentences if starts_at <= interrupted_at]
+        self.llm.record_interrupted_reply(" ".join(heard))
+        self.sentences = []
+        print("(interrupted)")
+
+    async def on_speech(self, _):
+        if self.barge_in and self.is_speaking():
+            await self.interrupt()
 
     async def main(self):
-        def handle_full_sentence(full_sentence):
-            self.transcription_response = full_sentence
-        
-        # Loop indefinitely until "goodbye" is detected
-        while True:
-            await get_transcript(handle_full_sentence)
-            
-            # Check for "goodbye" to exit the loop
-            if "goodbye" in self.transcription_response.lower():
-                break
-            
-            llm_response = self.llm.process(self.transcription_response)
-            
-            tts = TextToSpeech()
-            tts.speak(llm_response)
-            
-            # Reset transcription_response for the next loop iteration
-            self.transcription_response = ""
+        await self.listener.start(on_speech=self.on_speech, on_partial=self.on_partial)
+        try:
+            # Loop indefinitely until "goodbye" is detected
+            while True:
+                transcription_response = await self.listener.utterances.get()
+                print(f"Human: {transcription_response}")
+
+                # Check for "goodbye" to exit the loop
+                if "goodbye" in transcription_response.lower():
+                    break
+
+                if self.reply_task is not None and not self.reply_task.done():
+                    await self.interrupt()
+                speculation = self.speculator.take(transcription_response) if self.speculator is not None else None
+                self.reply_task = asyncio.create_task(self.speak_reply(transcription_response, speculation))
+        finally:
+            if self.reply_task is not None:
+                self.reply_task.cancel()
+            if self.speculator is not None:
+                self.speculator.cancel()
+            await self.listener.finish()
+            await self.player.close()
+            await http_clients.aclose()
 
 if __name__ == "__main__":
-    manager = ConversationManager()
+    manager = ConversationManager(speculative=os.getenv("SPECULATIVE_LLM", "false").lower() in ("1", "true", "yes"))
     asyncio.run(manager.main())
\ No newline at end of file
@@ -0,0 +1,191 @@
+import time, asyncio, email.utils
+
+import httpx
+import pytest
+
+from scheduler import (ProviderScheduler, CircuitBreaker, UpstreamError, Overloaded, CircuitOpen,
+                       retry_after_seconds)
+
+
+def response(status: int, **headers) -> httpx.Response:
+    return httpx.Response(status, headers=headers, request=httpx.Request("POST", "http://upstream.test/"))
+
+
+def scheduler(name: str, **options) -> ProviderScheduler:
+    options = {"backoff_base": 0.001, "backoff_max": 0.001, **options}
+    return ProviderScheduler(f"test-{name}", **options)
+
+
+def replies(*statuses, calls=None):
+    statuses = list(statuses)
+
+    async def send():
+        if calls is not None:
+            calls.append(time.monotonic())
+        status = statuses.pop(0)
+        return status if isinstance(status, httpx.Response) else response(status)
+    return send
+
+
+def test_retry_after_in_seconds_and_as_a_date():
+    assert retry_after_seconds(response(429, **{"retry-after": "2.5"})) == 2.5
+    when = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= retry_after_seconds(response(503, **{"retry-after": when})) <= 30
+    assert retry_after_seconds(response(503, **{"retry-after": "soon"})) is None
+    assert retry_after_seconds(response(503)) is None
+
+
+def test_retries_5xx_honouring_retry_after():
+    calls = []
+    upstream = scheduler("retry", max_retries=2)
+    result = asyncio.run(upstream.call(replies(response(503, **{"retry-after": "0.05"}), 200, calls=calls)))
+    assert result.status_code == 200
+    assert len(calls) == 2 and calls[1] - calls[0] >= 0.05
+
+
+def test_retry_after_beyond_the_deadline_fails_at_once():
+    calls = []
+    upstream = scheduler("retry-deadline", max_retries=3)
+    with pytest.raises(UpstreamError) as error:
+        asyncio.run(upstream.call(replies(response(429, **{"retry-after": "10"}), calls=calls), deadline=1.0))
+    assert len(calls) == 1
+    assert error.value.retry_after == 10 and error.value.status_code == 429
+
+
+def test_client_errors_are_not_retried():
+    calls = []
+    with pytest.raises(UpstreamError) as error:
+        asyncio.run(scheduler("4xx").call(replies(400, 200, calls=calls)))
+    assert len(calls) == 1 and error.value.status_code == 400
+
+
+def test_breaker_opens_then_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()  # only one trial at a time
+    breaker.record_failure()
+    assert breaker.state == "open"  # a failed trial reopens at once
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_open_circuit_rejects_calls_until_a_trial_succeeds():
+    upstream = scheduler("breaker", max_retries=0, failure_threshold=2, reset_timeout=0.05)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                await upstream.call(replies(502))
+        with pytest.raises(CircuitOpen) as error:
+            await upstream.call(replies(200))
+        assert 0 < error.value.retry_after <= 0.05
+        await asyncio.sleep(0.06)
+        assert (await upstream.call(replies(200))).status_code == 200
+        assert upstream.breaker.state == "closed"
+
+    asyncio.run(run())
+
+
+def test_rate_limits_do_not_open_the_circuit():
+    upstream = scheduler("429", max_retries=0, failure_threshold=1)
+    with pytest.raises(UpstreamError):
+        asyncio.run(upstream.call(replies(429)))
+    assert upstream.breaker.state == "closed"
+
+
+def test_overload_is_rejected_when_the_queue_is_full():
+    upstream = scheduler("overload", max_concurrency=1, max_queue=0)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def slow():
+            await release.wait()
+            return response(200)
+
+        first = asyncio.create_task(upstream.call(slow))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded):
+            await upstream.call(replies(200))
+        release.set()
+        assert (await first).status_code == 200
+
+    asyncio.run(run())
+
+
+def test_queued_call_times_out_as_overloaded():
+    upstream = scheduler("queue-timeout", max_concurrency=1, max_queue=1, queue_timeout=0.05)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def slow():
+            await release.wait()
+            return response(200)
+
+        first = asyncio.create_task(upstream.call(slow))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded):
+            await upstream.call(replies(200))
+        assert upstream.waiting == 0
+        release.set()
+        await first
+
+    asyncio.run(run())
+
+
+def test_hedge_keeps_the_copy_that_starts_first():
+    upstream = scheduler("hedge")
+    started, cancelled = [], []
+
+    async def attempt(first_byte):
+        copy = len(started)
+        started.append(copy)
+        try:
+            await asyncio.sleep(0.5 if copy == 0 else 0.01)
+            first_byte.set()
+            return copy
+        except asyncio.CancelledError:
+            cancelled.append(copy)
+            raise
+
+    assert asyncio.run(upstream.hedged(attempt, hedge_after=0.02)) == 1
+    assert started == [0, 1] and cancelled == [0]
+
+
+def test_hedge_is_not_fired_when_the_primary_is_fast():
+    upstream = scheduler("no-hedge")
+    started = []
+
+    async def attempt(first_byte):
+        started.append(len(started))
+        first_byte.set()
+        await asyncio.sleep(0.05)
+        return "primary"
+
+    assert asyncio.run(upstream.hedged(attempt, hedge_after=0.02)) == "primary"
+    assert started == [0]
+
+
+def test_hedge_falls_back_to_the_other_copy_when_one_fails():
+    upstream = scheduler("hedge-failure")
+
+    async def attempt(first_byte):
+        if not first_byte_seen:
+            first_byte_seen.append(True)
+            await asyncio.sleep(0.05)
+            raise UpstreamError("primary failed")
+        await asyncio.sleep(0.1)
+        first_byte.set()
+        return "backup"
+
+    first_byte_seen = []
+    assert asyncio.run(upstream.hedged(attempt, hedge_after=0.01)) == "backup"
@@ -0,0 +1,201 @@
+import time
+
+import pytest
+
+from sessions import Conversation, SessionStore, SqliteSessionStore
+
+
+@pytest.fixture
+def stores(tmp_path):
+    """Two stores on one database, standing in for two worker processes."""
+    path = str(tmp_path / "sessions.db")
+    return SqliteSessionStore(path), SqliteSessionStore(path)
+
+
+def history(conversation):
+    return [(message['role'], message['content']) for message in conversation.messages[1:]]
+
+
+def test_conflicting_appends_are_rebased(stores):
+    a, b = stores
+    first = a.get("s1")
+    first.add_user_message("hi")
+    a.touch(first)
+
+    stale = b.get("s1")
+    mine = a.get("s1")
+    mine.add_assistant_message("hello")
+    a.touch(mine)
+
+    stale.add_user_message("are you there?")
+    b.touch(stale)
+
+    assert b.conflicts == 1
+    expected = [("user", "hi"), ("assistant", "hello"), ("user", "are you there?")]
+    assert history(stale) == expected and stale.journal == []
+    latest = a.get("s1")
+    assert history(latest) == expected and latest.version == 3
+
+
+def test_stale_interruption_is_dropped(stores):
+    a, b = stores
+    conversation = a.get("s1")
+    conversation.add_user_message("tell me a story")
+    conversation.add_assistant_message("Once upon a time. The end.")
+    a.touch(conversation)
+
+    stale = b.get("s1")
+    newer = a.get("s1")
+    newer.add_user_message("another")
+    newer.add_assistant_message("Sure.")
+    a.touch(newer)
+
+    # This process cuts short a reply the other one has already moved past
+    stale.record_interrupted_reply("Once upon a time.")
+    b.touch(stale)
+    assert history(b.get("s1"))[-2:] == [("user", "another"), ("assistant", "Sure.")]
+    assert history(b.get("s1"))[1] == ("assistant", "Once upon a time. The end.")
+
+
+def test_stale_fold_is_dropped(stores):
+    a, b = stores
+    conversation = a.get("s1")
+    for i in range(3):
+        conversation.add_user_message(f"question {i}")
+        conversation.add_assistant_message(f"answer {i}")
+    a.touch(conversation)
+
+    stale = b.get("s1")
+    mine = a.get("s1")
+    mine.fold(mine.messages[1:3], "asked question 0")
+    a.touch(mine)
+
+    stale.fold(stale.messages[1:5], "asked questions 0 and 1")
+    stale.add_user_message("question 3")
+    b.touch(stale)
+
+    latest = a.get("s1")
+    assert latest.summary == "asked question 0"
+    assert history(latest)[0] == ("user", "question 1") and history(latest)[-1] == ("user", "question 3")
+    assert latest.nbytes == Conversation.loads("s1", latest.dumps()).nbytes
+
+
+def test_fold_of_messages_already_gone_changes_nothing():
+    conversation = Conversation("s1", max_turns=2)
+    conversation.journal = []
+    conversation.add_user_message("question 0")
+    conversation.add_assistant_message("answer 0")
+    older = conversation.messages[1:3]
+    for i in (1, 2):
+        conversation.add_user_message(f"question {i}")
+        conversation.add_assistant_message(f"answer {i}")
+    assert older[0] not in conversation.messages  # trimmed while the summary was being written
+
+    before = (history(conversation), conversation.nbytes, len(conversation.journal))
+    conversation.fold(older, "asked question 0")
+    assert conversation.summary == ""
+    assert (history(conversation), conversation.nbytes, len(conversation.journal)) == before
+
+
+def test_expired_session_is_saved_again(stores):
+    a, b = stores
+    conversation = a.get("s1")
+    conversation.add_user_message("hi")
+    a.touch(conversation)
+    b.drop("s1")
+
+    conversation.add_assistant_message("hello")
+    a.touch(conversation)
+    assert "s1" in b and history(b.get("s1")) == [("user", "hi"), ("assistant", "hello")]
+
+
+def test_dumps_round_trip():
+    conversation = Conversation("s1", "You are terse.")
+    conversation.add_user_message("héllo")
+    conversation.add_assistant_message("One. Two.")
+    conversation.set_reply_timeline(["One.", "Two."], [0.0, 1.23456])
+    conversation.fold([], "greetings")
+
+    for copy in (conversation, Conversation("s2")):
+        data = copy.dumps()
+        loaded = Conversation.loads(copy.session_id, data)
+        assert loaded.messages == copy.messages
+        assert loaded.summary == copy.summary and loaded.nbytes == copy.nbytes
+        assert loaded.reply_timeline == copy.reply_timeline
+    assert Conversation.loads("s1", conversation.dumps()).reply_timeline == (["One.", "Two."], [0.0, 1.235])
+
+    conversation.add_user_message("x" * 1000)
+    data = conversation.dumps()
+    assert data[:1] != b"["  # compressed
+    assert Conversation.loads("s1", data).messages == conversation.messages
+
+
+def test_record_played_keeps_the_sentences_heard():
+    conversation = Conversation("s1")
+    conversation.add_user_message("hi")
+    conversation.add_assistant_message("One. Two. Three.")
+    conversation.set_reply_timeline(["One.", "Two.", "Three."], [0.0, 1.0, 2.0])
+
+    assert conversation.record_played(1.5)
+    assert history(conversation)[-1] == ("assistant", "One. Two.")
+    assert conversation.reply_timeline is None
+    assert not conversation.record_played(0.5)  # the timeline is used once
+
+
+def test_record_played_after_the_whole_reply_or_a_new_turn():
+    conversation = Conversation("s1")
+    conversation.add_user_message("hi")
+    conversation.add_assistant_message("One. Two.")
+    conversation.set_reply_timeline(["One.", "Two."], [0.0, 1.0])
+    assert not conversation.record_played(5.0)
+    assert history(conversation)[-1] == ("assistant", "One. Two.")
+
+    conversation.set_reply_timeline(["One.", "Two."], [0.0, 1.0])
+    conversation.add_user_message("next")
+    assert conversation.reply_timeline is None and not conversation.record_played(0.5)
+
+
+def test_timeline_survives_a_rebase(stores):
+    a, b = stores
+    conversation = a.get("s1")
+    conversation.add_user_message("hi")
+    a.touch(conversation)
+
+    stale = b.get("s1")
+    other = a.get("s1")
+    other.summary = "changed elsewhere"
+    a.touch(other)
+
+    stale.add_assistant_message("One. Two.")
+    stale.set_reply_timeline(["One.", "Two."], [0.0, 1.0])
+    b.touch(stale)
+    latest = a.get("s1")
+    assert latest.reply_timeline == (["One.", "Two."], [0.0, 1.0])
+    assert latest.record_played(0.5) and history(latest)[-1] == ("assistant", "One.")
+
+
+def test_idle_sessions_expire(tmp_path):
+    store = SqliteSessionStore(str(tmp_path / "sessions.db"), ttl=0.05, expire_interval=0)
+    conversation = store.get("s1")
+    conversation.add_user_message("hi")
+    store.touch(conversation)
+    time.sleep(0.06)
+    store.get("s2")
+    assert "s1" not in store and store.expired == 1
+
+    memory = SessionStore(ttl=0.05)
+    memory.get("s1")
+    time.sleep(0.06)
+    memory.get("s2")
+    assert "s1" not in memory and memory.expired == 1
+
+
+def test_sqlite_store_evicts_the_least_recently_used(tmp_path):
+    store = SqliteSessionStore(str(tmp_path / "sessions.db"), max_sessions=2, expire_interval=0)
+    for session_id in ("s1", "s2", "s3"):
+        conversation = store.get(session_id)
+        conversation.add_user_message(session_id)
+        store.touch(conversation)
+        time.sleep(0.01)
+    store.expire()
+    assert len(store) == 2 and "s1" not in store and store.evicted == 1
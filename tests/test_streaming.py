@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from streaming import SSEParser, SSEEvent, SentenceSegmenter, StreamError, aiter_sse
+from voice import LanguageModel
+from prompt import FILLER_PHRASES
+
+
+def segment(tokens, **options):
+    segmenter = SentenceSegmenter(**options)
+    chunks = []
+    for token in tokens:
+        chunks += segmenter.feed(token)
+    tail = segmenter.flush()
+    return chunks + ([tail] if tail else [])
+
+
+def words(text):
+    return [word if i == 0 else f" {word}" for i, word in enumerate(text.split(" "))]
+
+
+def test_first_chunk_is_cut_at_the_first_sentence():
+    chunks = segment(words("Oh wow! The ocean covers most of the planet. Most of it is unexplored, even today."))
+    assert chunks[0] == "Oh wow!"
+    assert "".join(chunks).replace(" ", "") == "Ohwow!Theoceancoversmostoftheplanet.Mostofitisunexplored,eventoday."
+
+
+@pytest.mark.parametrize("phrase", FILLER_PHRASES)
+def test_filler_phrases_are_sent_to_tts_whole(phrase):
+    # Otherwise their pre-synthesized audio in the TTS cache can never be hit
+    chunks = segment(words(f"{phrase} That is a fine question about the weather today."))
+    assert chunks[0] == phrase
+
+
+def test_abbreviations_and_decimals_do_not_end_a_sentence():
+    text = "Hi. Dr. Smith measured 3.5 meters, e.g. in the lab at 5 p.m. today. That was it."
+    chunks = segment(words(text), min_chars=10)
+    assert chunks == ["Hi.", "Dr. Smith measured 3.5 meters, e.g. in the lab at 5 p.m. today.", "That was it."]
+
+
+def test_later_sentences_are_merged_up_to_min_chars():
+    chunks = segment(words("Okay. Yes. No. Maybe so. Fine then, here is a longer sentence to finish."), min_chars=20)
+    assert chunks[0] == "Okay."
+    assert chunks[1] == "Yes. No. Maybe so. Fine then, here is a longer sentence to finish."
+
+
+def test_first_chunk_is_capped_at_first_max_chars():
+    text = "well " * 30 + "done."
+    chunks = segment(words(text), first_max_chars=60)
+    assert len(chunks[0]) <= 60
+    assert chunks[0].endswith("well")
+
+
+def test_long_sentence_is_force_split_at_a_clause_break():
+    clause = "this clause goes on for quite a while, "
+    chunks = segment(words("Start. " + clause * 10 + "end."), max_chars=100)
+    assert chunks[0] == "Start."
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert chunks[1].endswith(",")
+
+
+def test_force_split_falls_back_to_a_word_boundary():
+    chunks = segment(words("Go. " + "word " * 60 + "end."), max_chars=50)
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    assert all(not chunk.endswith("wor") for chunk in chunks)
+
+
+def test_sse_multiline_data_comments_and_events():
+    parser = SSEParser()
+    lines = [": keep-alive", "event: message", "data: first", "data:second", "", "id: 7", "retry: 10", ""]
+    events = [event for event in map(parser.feed_line, lines) if event is not None]
+    assert events == [SSEEvent("message", "first\nsecond")]
+    assert parser.finish() is None
+
+
+def test_sse_last_event_without_blank_line_and_done():
+    async def lines():
+        for line in ["data: {\"choices\": [{\"text\": \"Hi\"}]}\r\n", "\n", "data: [DONE]"]:
+            yield line
+
+    async def collect():
+        return [event async for event in aiter_sse(lines())]
+
+    events = asyncio.run(collect())
+    assert [event.done for event in events] == [False, True]
+    assert LanguageModel._parse_event(events[0]) == "Hi"
+
+
+@pytest.mark.parametrize("event", [
+    SSEEvent("error", '{"message": "overloaded"}'),
+    SSEEvent(None, '{"error": {"message": "overloaded"}}'),
+    SSEEvent(None, "not json"),
+    SSEEvent(None, "[1, 2]"),
+])
+def test_sse_error_events_raise_stream_error(event):
+    with pytest.raises(StreamError):
+        LanguageModel._parse_event(event)
@@ -0,0 +1,120 @@
+import io, wave, asyncio
+
+import numpy as np
+import pytest
+
+from vad import VoiceActivityDetector, trim_wav_stream, wait_for_speech, parse_wav_header
+
+RATE = 16000
+
+
+def noise(seconds: float, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(0, 30, int(seconds * RATE))
+
+
+def tone(seconds: float, frequency: float = 220.0) -> np.ndarray:
+    t = np.arange(int(seconds * RATE)) / RATE
+    return 3000 * np.sin(2 * np.pi * frequency * t)
+
+
+def pcm(*parts) -> bytes:
+    return np.concatenate(parts).astype("<i2").tobytes()
+
+
+def wav(data: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(RATE)
+        out.writeframes(data)
+    return buffer.getvalue()
+
+
+async def chunked(data: bytes, size: int = 1000):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def collect(stream) -> bytes:
+    return b"".join([chunk async for chunk in stream])
+
+
+def test_one_utterance_between_pauses():
+    vad = VoiceActivityDetector(RATE)
+    audio, events = vad.process(pcm(noise(1.0), tone(0.5), noise(1.0)))
+
+    assert [event.kind for event in events] == ["speech_start", "speech_end"]
+    (start, end), = vad.segments
+    assert start == pytest.approx(0.8, abs=0.03)  # onset less the 200 ms pre-roll
+    assert end == pytest.approx(1.7, abs=0.03)     # offset plus the 200 ms hangover
+    # Leading silence is dropped; pre-roll, speech, hangover and 500 ms of the pause are kept
+    assert len(audio) == pytest.approx(1.4 * RATE * 2, abs=2 * 640)
+
+
+def test_chunk_boundaries_do_not_change_the_result():
+    data = pcm(noise(0.5), tone(0.4), noise(0.6), tone(0.3), noise(0.8))
+    whole = VoiceActivityDetector(RATE)
+    expected, _ = whole.process(data)
+    split = VoiceActivityDetector(RATE)
+    audio = b"".join(split.process(data[i:i + 333])[0] for i in range(0, len(data), 333))
+    assert audio == expected
+    assert split.segments == whole.segments and len(split.segments) == 2
+
+
+def test_silence_yields_nothing():
+    vad = VoiceActivityDetector(RATE)
+    audio, events = vad.process(pcm(noise(2.0)))
+    assert audio == b"" and events == [] and vad.segments == []
+    assert vad.finish() == []
+
+
+def test_endpoint_after_a_long_enough_pause():
+    vad = VoiceActivityDetector(RATE, endpoint_ms=600)
+    _, events = vad.process(pcm(noise(0.5), tone(0.5), noise(1.0)))
+    kinds = [event.kind for event in events]
+    assert kinds == ["speech_start", "speech_end", "endpoint"]
+    assert events[2].time == pytest.approx(1.0 + 0.6, abs=0.03)  # 600 ms after the last loud frame
+
+
+def test_finish_closes_an_open_segment():
+    vad = VoiceActivityDetector(RATE)
+    vad.process(pcm(noise(0.5), tone(0.5)))
+    assert vad.in_speech and vad.segments == []
+    assert [event.kind for event in vad.finish()] == ["speech_end"]
+    (_, end), = vad.segments
+    assert end == pytest.approx(1.0, abs=0.03)
+
+
+def test_trim_wav_stream_strips_header_and_silence():
+    data = wav(pcm(noise(1.0), tone(0.5), noise(1.0)))
+
+    async def run():
+        stream, params, vad = await trim_wav_stream(chunked(data), make_vad=VoiceActivityDetector)
+        return await collect(stream), params, vad
+
+    audio, params, vad = asyncio.run(run())
+    assert params == {"encoding": "linear16", "sample_rate": RATE, "channels": 1}
+    assert not audio.startswith(b"RIFF")
+    assert len(vad.segments) == 1 and len(audio) < vad.bytes_in
+
+
+def test_wait_for_speech_on_a_silent_upload():
+    async def run(data):
+        stream, _, _ = await trim_wav_stream(chunked(data), make_vad=VoiceActivityDetector)
+        return await wait_for_speech(stream)
+
+    assert asyncio.run(run(wav(pcm(noise(2.0))))) is None
+    assert asyncio.run(run(wav(pcm(noise(0.5), tone(0.5))))) is not None
+
+
+def test_other_formats_pass_through():
+    data = b"ID3" + bytes(5000)
+
+    async def run():
+        stream, params, vad = await trim_wav_stream(chunked(data))
+        return await collect(stream), params, vad
+
+    assert asyncio.run(run()) == (data, None, None)
+    assert parse_wav_header(data) is None
+    assert parse_wav_header(wav(b"\0\0" * 10)).data_offset == 44
@@ -0,0 +1,250 @@
+import os, struct
+from collections import deque
+from typing import Optional, List, Tuple, NamedTuple
+
+import numpy as np
+from metrics import REGISTRY
+
+VAD_BYTES = REGISTRY.counter(
+    "voice_vad_bytes_total", "Linear16 bytes seen by the VAD and forwarded to STT.", labelnames=("direction",),
+)
+
+
+class VADEvent(NamedTuple):
+    kind: str      # "speech_start", "speech_end" or "endpoint"
+    time: float    # seconds since the start of the stream
+
+
+class VoiceActivityDetector:
+    """Energy / zero-crossing voice activity detector for linear16 mono audio.
+
+    Audio is cut into `frame_ms` frames and per-frame RMS energy and
+    zero-crossing rate are computed with NumPy for a whole chunk at once.
+    A frame is speech when its energy is `threshold_db` above an adaptive
+    noise floor and it is not a low-energy, noise-like (high ZCR) frame.
+
+    `process` returns the audio worth sending to STT: speech frames, a short
+    pre-roll before each onset, a hangover after it, and at most
+    `max_silence_ms` of every pause (enough for server-side endpointing).
+    Leading silence is dropped entirely. It also reports speech start/end
+    and, when `endpoint_ms` is set, an "endpoint" once a pause after speech
+    has lasted that long.
+    """
+
+    def __init__(self, sample_rate: int = 16000, frame_ms: int = 20, threshold_db: float = 12.0,
+                 min_energy_db: float = -55.0, initial_floor_db: float = -50.0, zcr_max: float = 0.4, hangover_ms: int = 200,
+                 preroll_ms: int = 200, max_silence_ms: int = 500, endpoint_ms: Optional[int] = None) -> None:
+        self.sample_rate = sample_rate
+        self.frame_size = sample_rate * frame_ms // 1000
+        self.frame_bytes = self.frame_size * 2
+        self.frame_seconds = frame_ms / 1000
+        self.threshold_db = threshold_db
+        self.min_energy_db = min_energy_db
+        self.initial_floor_db = initial_floor_db
+        self.zcr_max = zcr_max
+        self.hangover_frames = max(0, hangover_ms // frame_ms)
+        self.max_silence_frames = max(0, max_silence_ms // frame_ms)
+        self.endpoint_frames = endpoint_ms // frame_ms if endpoint_ms else None
+
+        self.noise_floor_db: Optional[float] = None
+        self.in_speech = False
+        self.frames_seen = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.segments: List[Tuple[float, float]] = []
+
+        self._remainder = b""
+        self._preroll = deque(maxlen=max(0, preroll_ms // frame_ms))
+        self._hangover = 0
+        self._silence_run = 0
+        self._heard_speech = False
+        self._endpoint_sent = False
+        self._speech_started_at = 0.0
+
+    @classmethod
+    def from_env(cls, sample_rate: int = 16000) -> "VoiceActivityDetector":
+        endpoint_ms = int(os.getenv("VAD_ENDPOINT_MS", 0))
+        return cls(
+            sample_rate=sample_rate,
+            threshold_db=float(os.getenv("VAD_THRESHOLD_DB", 12.0)),
+            min_energy_db=float(os.getenv("VAD_MIN_ENERGY_DB", -55.0)),
+            zcr_max=float(os.getenv("VAD_ZCR_MAX", 0.4)),
+            hangover_ms=int(os.getenv("VAD_HANGOVER_MS", 200)),
+            preroll_ms=int(os.getenv("VAD_PREROLL_MS", 200)),
+            max_silence_ms=int(os.getenv("VAD_MAX_SILENCE_MS", 500)),
+            endpoint_ms=endpoint_ms or None,
+        )
+
+    def features(self, samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Per-frame energy (dBFS) and zero-crossing rate for whole frames of `samples`."""
+        frames = samples[: len(samples) // self.frame_size * self.frame_size]
+        frames = frames.reshape(-1, self.frame_size).astype(np.float32) / 32768.0
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        energy_db = 20.0 * np.log10(rms + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (self.frame_size - 1)
+        return energy_db, zcr
+
+    def _update_floor(self, energy_db: float):
+        if energy_db < self.noise_floor_db:
+            self.noise_floor_db = energy_db  # drop quickly to the quietest level seen
+        else:
+            self.noise_floor_db += 0.02 * (energy_db - self.noise_floor_db)
+
+    def process(self, pcm: bytes) -> Tuple[bytes, List[VADEvent]]:
+        data = self._remainder + pcm
+        whole = len(data) // self.frame_bytes * self.frame_bytes
+        self._remainder = data[whole:]
+        self.bytes_in += len(pcm)
+        VAD_BYTES.inc("in", amount=len(pcm))
+        if not whole:
+            return b"", []
+
+        samples = np.frombuffer(data[:whole], dtype="<i2")
+        energy_db, zcr = self.features(samples)
+        if self.noise_floor_db is None:
+            # Capped so a recording that opens mid-word is not taken for background noise
+            self.noise_floor_db = min(float(energy_db.min()), self.initial_floor_db)
+
+        loud = energy_db > self.min_energy_db
+        noisy = (zcr > self.zcr_max) & (energy_db < self.noise_floor_db + 2 * self.threshold_db)
+
+        out = []
+        events = []
+        for i in range(len(energy_db)):
+            frame = data[i * self.frame_bytes:(i + 1) * self.frame_bytes]
+            now = self.frames_seen * self.frame_seconds
+            self.frames_seen += 1
+            is_speech = bool(loud[i] and not noisy[i] and energy_db[i] > self.noise_floor_db + self.threshold_db)
+
+            if is_speech:
+                if not self.in_speech:
+                    self.in_speech = True
+                    self._heard_speech = True
+                    self._endpoint_sent = False
+                    self._speech_started_at = max(0.0, now - len(self._preroll) * self.frame_seconds)
+                    events.append(VADEvent("speech_start", self._speech_started_at))
+                    out.extend(self._preroll)
+                    self._preroll.clear()
+                self._hangover = self.hangover_frames
+                self._silence_run = 0
+                out.append(frame)
+                continue
+
+            self._update_floor(float(energy_db[i]))
+            if self.in_speech and self._hangover > 0:
+                self._hangover -= 1
+                out.append(frame)
+                continue
+            if self.in_speech:
+                self.in_speech = False
+                events.append(VADEvent("speech_end", now))
+                self.segments.append((self._speech_started_at, now))
+
+            self._silence_run += 1
+            if self._heard_speech and self._silence_run <= self.max_silence_frames:
+                out.append(frame)  # keep the start of a pause so STT can still endpoint
+            else:
+                self._preroll.append(frame)
+            if (self.endpoint_frames is not None and self._heard_speech and not self._endpoint_sent
+                    and self._silence_run + self.hangover_frames >= self.endpoint_frames):
+                self._endpoint_sent = True
+                events.append(VADEvent("endpoint", now))
+
+        audio = b"".join(out)
+        self.bytes_out += len(audio)
+        VAD_BYTES.inc("out", amount=len(audio))
+        return audio, events
+
+    def finish(self) -> List[VADEvent]:
+        """Close an open speech segment at the end of the stream."""
+        if not self.in_speech:
+            return []
+        self.in_speech = False
+        now = self.frames_seen * self.frame_seconds
+        self.segments.append((self._speech_started_at, now))
+        return [VADEvent("speech_end", now)]
+
+
+class WavFormat(NamedTuple):
+    sample_rate: int
+    channels: int
+    bits_per_sample: int
+    data_offset: int
+
+
+def parse_wav_header(data: bytes) -> Optional[WavFormat]:
+    """Find the PCM format and where the samples start in a RIFF/WAVE header."""
+    if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(data):
+        chunk_id, size = data[offset:offset + 4], struct.unpack("<I", data[offset + 4:offset + 8])[0]
+        if chunk_id == b"fmt " and offset + 24 <= len(data):
+            audio_format, channels, sample_rate = struct.unpack("<HHI", data[offset + 8:offset + 16])
+            bits = struct.unpack("<H", data[offset + 22:offset + 24])[0]
+            fmt = (audio_format, channels, sample_rate, bits)
+        elif chunk_id == b"data":
+            if fmt is None or fmt[0] not in (1, 0xFFFE):
+                return None
+            return WavFormat(fmt[2], fmt[1], fmt[3], offset + 8)
+        offset += 8 + size + (size & 1)
+    return None
+
+
+async def _prepend(head: bytes, chunks):
+    if head:
+        yield head
+    async for chunk in chunks:
+        yield chunk
+
+
+async def wait_for_speech(stream):
+    """Wait for the first chunk of a `trim_wav_stream` stream; None if the upload held no speech."""
+    stream = stream.__aiter__()
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+    return _prepend(first, stream)
+
+
+async def trim_wav_stream(chunks, make_vad=VoiceActivityDetector.from_env, max_header_bytes: int = 65536):
+    """Run the VAD over a streamed mono 16-bit WAV upload.
+
+    Returns `(stream, params, vad)`. For a mono linear16 WAV, `stream` yields
+    headerless, silence-trimmed PCM and `params` holds the Deepgram query
+    parameters that describe it. Anything else (compressed audio, stereo,
+    other sample widths) is passed through unchanged with `params` and
+    `vad` set to None. `make_vad` is called with the WAV sample rate.
+    """
+    chunks = chunks.__aiter__()
+    head = b""
+    header = None
+    while len(head) < max_header_bytes:
+        try:
+            head += await chunks.__anext__()
+        except StopAsyncIteration:
+            break
+        header = parse_wav_header(head)
+        if header is not None or not head.startswith(b"RIFF"):
+            break
+
+    if header is None or header.channels != 1 or header.bits_per_sample != 16:
+        return _prepend(head, chunks), None, None
+
+    vad = make_vad(header.sample_rate)
+
+    async def stream():
+        audio, _ = vad.process(head[header.data_offset:])
+        if audio:
+            yield audio
+        async for chunk in chunks:
+            audio, _ = vad.process(chunk)
+            if audio:
+                yield audio
+        vad.finish()
+
+    params = {"encoding": "linear16", "sample_rate": header.sample_rate, "channels": 1}
+    return stream(), params, vad
@@ -1,13 +1,20 @@
 from dotenv import load_dotenv
-from sseclient import SSEClient
-from prompt import SYSTEM_PROMPT
-import shutil, wave, httpx, aiohttp, json
-import asyncio, requests, os, time, subprocess
-from typing import Optional, Dict, List, BinaryIO
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from prompt import SYSTEM_PROMPT, SUMMARY_PROMPT
+from streaming import SSEEvent, SentenceSegmenter, StreamError, aiter_sse
+from scheduler import ProviderScheduler, UpstreamError
+from metrics import Histogram, LLM_PROMPT_TOKENS
+from context import message_tokens
+from routing import Router
+import struct, httpx, json
+import asyncio, os, time
+from typing import Optional, Dict, List, BinaryIO, NamedTuple
 
 load_dotenv()
 
+# Overridable so the benchmark can point everything at local stand-ins
+DEEPGRAM_URL = os.getenv("DEEPGRAM_URL", "https://api.deepgram.com").rstrip("/")
+TOGETHER_URL = os.getenv("TOGETHER_URL", "https://api.together.xyz").rstrip("/")
+
 VALID_STT_MODELS = [
     "nova-2"
 ]
@@ -35,77 +42,651 @@ VALID_LANGUAGE_MODELS = [
     "NousResearch/Nous-Hermes-2-Mixtral-8X7B-DPO"
 ]
 
+# Interchangeable choices a Router may move traffic between
+LANGUAGE_MODEL_TIERS = {
+    "small": ["meta-llama/Llama-3-8b-chat-hf", "mistralai/Mistral-7B-Instruct-v0.2"],
+    "large": [
+        "meta-llama/Llama-3-70b-chat-hf",
+        "mistralai/Mixtral-8X7B-Instruct-V0.1",
+        "NousResearch/Nous-Hermes-2-Mixtral-8X7B-DPO",
+        "microsoft/WizardLM-2-8x22B",
+    ],
+}
+
+TTS_VOICE_TIERS = {
+    "female": ["aura-asteria-en", "aura-luna-en", "aura-stella-en", "aura-athena-en", "aura-hera-en"],
+    "male": ["aura-orion-en", "aura-arcas-en", "aura-perseus-en", "aura-angus-en", "aura-helios-en"],
+}
+
+
+class HTTPClients:
+    """Long-lived `httpx.AsyncClient` per upstream origin.
+
+    Connections are kept alive between calls so each turn (and each sentence
+    sent to TTS) reuses an open TLS connection instead of handshaking again.
+    """
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 30.0, http2: bool = False, timeout: float = 30.0) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 5.0))
+        self.http2 = http2 and self._h2_available()
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    @classmethod
+    def from_env(cls) -> "HTTPClients":
+        return cls(
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30)),
+            http2=os.getenv("HTTP_HTTP2", "false").lower() in ("1", "true", "yes"),
+            timeout=float(os.getenv("HTTP_TIMEOUT", 30)),
+        )
+
+    @staticmethod
+    def _h2_available() -> bool:
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            print("HTTP/2 requested but the `h2` package is not installed, falling back to HTTP/1.1")
+            return False
+
+    @staticmethod
+    def origin(url: str) -> str:
+        parsed = httpx.URL(url)
+        return f"{parsed.scheme}://{parsed.netloc.decode()}"
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        origin = self.origin(url)
+        client = self._clients.get(origin)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=origin, limits=self.limits, timeout=self.timeout, http2=self.http2,
+            )
+            self._clients[origin] = client
+        return client
+
+    async def resolve(self, urls: List[str]):
+        """Look up each upstream host ahead of the first request.
+
+        Raises ConnectionError naming the hosts that could not be resolved,
+        after trying all of them.
+        """
+        loop = asyncio.get_running_loop()
+        failures = []
+
+        async def _resolve(url):
+            parsed = httpx.URL(url)
+            try:
+                await loop.getaddrinfo(parsed.host, parsed.port or (443 if parsed.scheme == "https" else 80))
+            except OSError as e:
+                failures.append(f"{parsed.host}: {e}")
+
+        await asyncio.gather(*(_resolve(url) for url in {self.origin(url): url for url in urls}.values()))
+        if failures:
+            raise ConnectionError(f"Could not resolve {', '.join(failures)}")
+
+    async def warm(self, urls: List[str], connections: int = 1):
+        """Open `connections` pooled connections to each upstream ahead of the first request.
+
+        Raises ConnectionError naming the upstreams that could not be
+        reached, after trying all of them.
+        """
+        failures = {}
+
+        async def _warm(url):
+            try:
+                await self.get(url).head("/")
+            except httpx.HTTPError as e:
+                failures[self.origin(url)] = f"{self.origin(url)}: {e}"
+
+        # Concurrent requests each need their own connection, so this fills the pool
+        origins = {self.origin(url): url for url in urls}
+        await asyncio.gather(*(_warm(url) for url in origins.values() for _ in range(max(1, connections))))
+        if failures:
+            raise ConnectionError(f"Could not pre-warm {', '.join(failures.values())}")
+
+    async def aclose(self):
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(client.aclose() for client in clients))
+
+
+http_clients = HTTPClients.from_env()
+
+# One admission queue, retry policy and circuit breaker per upstream provider
+deepgram_scheduler = ProviderScheduler.from_env("deepgram")
+together_scheduler = ProviderScheduler.from_env("together")
+
+
+class AudioTooLarge(ValueError):
+    pass
+
+
+class UnsupportedAudio(ValueError):
+    pass
+
+
+# Leading bytes of the containers browsers and recorders produce
+AUDIO_SIGNATURES = (
+    b"RIFF",              # wav
+    b"\x1a\x45\xdf\xa3",  # webm / matroska
+    b"OggS",              # ogg / opus
+    b"fLaC",              # flac
+    b"ID3",               # mp3 with tags
+    b"#!AMR",             # amr
+)
+
+
+def looks_like_audio(head: bytes) -> bool:
+    if head.startswith(AUDIO_SIGNATURES):
+        return True
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return True  # bare mp3 / aac frame sync
+    return len(head) >= 8 and head[4:8] == b"ftyp"  # mp4 / m4a
+
+
+async def iter_file(audio: BinaryIO, chunk_size: int = 64 * 1024):
+    while chunk := audio.read(chunk_size):
+        yield chunk
+
+
+async def checked_audio_stream(chunks, max_bytes: Optional[int] = None):
+    """Validate an async byte stream before it is forwarded upstream.
+
+    The first chunk is awaited and sniffed here, so non-audio payloads are
+    rejected before any upstream request is made. The returned iterator
+    raises `AudioTooLarge` as soon as more than `max_bytes` have passed.
+    """
+    chunks = chunks.__aiter__()
+    head = b""
+    async for head in chunks:
+        if head:
+            break
+    if not looks_like_audio(head):
+        raise UnsupportedAudio("Payload does not look like an audio file")
+
+    async def stream():
+        total = 0
+        chunk = head
+        while True:
+            total += len(chunk)
+            if max_bytes is not None and total > max_bytes:
+                raise AudioTooLarge(f"Audio is larger than {max_bytes} bytes")
+            yield chunk
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+
+    return stream()
+
 
 class SpeechToText:
-    def __init__(self, model_name:str = "nova-2") -> None:
+    def __init__(self, model_name:str = "nova-2", clients: Optional[HTTPClients] = None,
+                 scheduler: Optional[ProviderScheduler] = None) -> None:
         self.model_name = model_name
+        self.clients = clients or http_clients
+        self.scheduler = scheduler or deepgram_scheduler
         self.api_key = os.getenv("DEEPGRAM_API_KEY")
-        self.base_url = "https://api.deepgram.com/v1/listen"
+        self.base_url = f"{DEEPGRAM_URL}/v1/listen"
         
         if model_name not in VALID_STT_MODELS:
-            raise ValueError(f'Invalid Speech to text model for deepgram')
+            raise ValueError('Invalid Speech to text model for deepgram')
+
+    async def warm(self):
+        """A free authenticated request, so a bad key or an unreachable API shows up at startup."""
+        client = self.clients.get(self.base_url)
+        await self.scheduler.call(
+            lambda: client.get(f"{DEEPGRAM_URL}/v1/projects", headers={"Authorization": f"Token {self.api_key}"}),
+            retries=0,
+        )
     
-    async def listen(self, audio: BinaryIO):
+    async def listen(self, audio, content_type: str = "audio/*", params: Optional[dict] = None):
+        """Transcribe a file object or an async iterator of audio chunks.
+
+        Chunks are streamed to Deepgram as they are produced, so the upload
+        can start before the whole recording is available. `params` adds
+        query parameters, e.g. the encoding and sample rate of raw PCM.
+
+        Upstream failures raise `UpstreamError`. Only seekable file objects
+        are retried; a streamed upload cannot be replayed.
+        """
         try:
-            async with httpx.AsyncClient() as client:
-
-                response = await client.post(
-                    self.base_url,
-                    content=audio.read(),
-                    params={"model": self.model_name, "smart_format": "false"},
-                    headers={"Content-Type": "audio/*", "Authorization": f"Token {self.api_key}"},
-                )
-                response.raise_for_status()
-                transcript = response.json()
-                return transcript['results']['channels'][0]['alternatives'][0]['transcript']
-
-        except httpx.HTTPError as e:
-            print(f"HTTP Error in transcribe_audio: {e}")
-            return ""
+            transcript = await self.transcribe(audio, content_type, params)
+            return transcript['results']['channels'][0]['alternatives'][0]['transcript']
+
+        except (AudioTooLarge, UnsupportedAudio, UpstreamError):
+            raise
         except Exception as e:
             print(f"Exception in transcribe_audio: {e}")
             return ""
 
+    async def transcribe(self, audio, content_type: str = "audio/*", params: Optional[dict] = None,
+                         deadline: Optional[float] = None) -> dict:
+        """Like `listen`, but return Deepgram's whole response (metadata included) and raise on any error."""
+        replayable = hasattr(audio, "read") and getattr(audio, "seekable", lambda: False)()
+        offset = audio.tell() if replayable else 0
+
+        def body():
+            if replayable:
+                audio.seek(offset)
+            return iter_file(audio) if hasattr(audio, "read") else audio
+
+        client = self.clients.get(self.base_url)
+        response = await self.scheduler.call(
+            lambda: client.post(
+                self.base_url,
+                content=body(),
+                params={"model": self.model_name, "smart_format": "false", **(params or {})},
+                headers={"Content-Type": content_type, "Authorization": f"Token {self.api_key}"},
+            ),
+            deadline=deadline,
+            retries=None if replayable else 0,
+        )
+        return response.json()
+
+
+class LiveSpeechToText:
+    """Streaming transcription over a Deepgram live connection.
+
+    PCM frames passed to `send` are forwarded as they arrive; finalized
+    segments are collected and `on_utterance` is awaited with the full
+    utterance once Deepgram reports `speech_final`. `on_speech` is awaited
+    with every non-empty interim or final result, and `on_partial` with the
+    utterance heard so far and whether Deepgram just finalized a segment.
+
+    With a `vad`, frames are trimmed locally before they are sent and
+    `on_vad` is awaited with its speech start/end events. If the VAD has
+    `endpoint_ms` set, an utterance is also closed as soon as the VAD sees
+    that much silence and Deepgram has finalized what was said, instead of
+    waiting for Deepgram's own endpointing.
+    """
+    def __init__(self, model_name: str = "nova-2", sample_rate: int = 16000, endpointing: int = 300, vad=None) -> None:
+        self.model_name = model_name
+        self.sample_rate = sample_rate
+        self.endpointing = endpointing
+        self.vad = vad
+        self.api_key = os.getenv("DEEPGRAM_API_KEY")
+        self.connection = None
+        self._parts: List[str] = []
+        self._interim = ""
+        self._endpoint_pending = False
+        self._on_utterance = None
+        self._on_vad = None
+
+        if model_name not in VALID_STT_MODELS:
+            raise ValueError('Invalid Speech to text model for deepgram')
+
+    async def start(self, on_utterance, on_speech=None, on_vad=None, on_partial=None) -> bool:
+        # The SDK (and aiohttp under it) is slow to import and only needed for live sessions
+        from deepgram import DeepgramClient, DeepgramClientOptions, LiveTranscriptionEvents, LiveOptions
+
+        config = DeepgramClientOptions(options={"keepalive": "true"})
+        deepgram = DeepgramClient(self.api_key or "", config)
+        self.connection = deepgram.listen.asynclive.v("1")
+        self._on_utterance = on_utterance
+        self._on_vad = on_vad
+
+        async def on_message(_, result, **kwargs):
+            sentence = result.channel.alternatives[0].transcript
+            # Any recognized speech, interim or final, lets the caller barge in
+            if on_speech is not None and sentence.strip():
+                await on_speech(sentence)
+            if result.is_final:
+                self._interim = ""
+                if sentence:
+                    self._parts.append(sentence)
+            else:
+                self._interim = sentence.strip()
+            if result.speech_final or (result.is_final and self._endpoint_pending):
+                await self._emit()
+            elif on_partial is not None and (self._parts or self._interim):
+                await on_partial(" ".join(self._parts + [self._interim]).strip(), result.is_final)
+
+        self.connection.on(LiveTranscriptionEvents.Transcript, on_message)
+
+        options = LiveOptions(
+            model=self.model_name,
+            punctuate=True,
+            language="en-US",
+            encoding="linear16",
+            channels=1,
+            sample_rate=self.sample_rate,
+            endpointing=self.endpointing,
+            interim_results=True,
+            smart_format=True,
+        )
+        return await self.connection.start(options)
+
+    async def _emit(self):
+        self._endpoint_pending = False
+        utterance = " ".join(self._parts).strip()
+        self._parts = []
+        if utterance:
+            await self._on_utterance(utterance)
+
+    async def send(self, pcm: bytes):
+        if self.connection is None:
+            return
+        if self.vad is not None:
+            pcm, events = self.vad.process(pcm)
+            for event in events:
+                if event.kind == "endpoint":
+                    # Close now if Deepgram already finalized everything, else on its next final
+                    if self._parts and not self._interim:
+                        await self._emit()
+                    else:
+                        self._endpoint_pending = True
+                elif event.kind == "speech_start":
+                    self._endpoint_pending = False
+                if self._on_vad is not None:
+                    await self._on_vad(event)
+            if not pcm:
+                return
+        await self.connection.send(pcm)
+
+    async def finish(self):
+        if self.connection is not None:
+            await self.connection.finish()
+            self.connection = None
+
+
+class AudioFormat(NamedTuple):
+    """Encoding of the synthesized speech sent to one client."""
+    encoding: str       # "linear16", "mp3" or "opus"
+    sample_rate: int
+    container: str      # "wav" or "none" for linear16, "ogg" for opus, "" for mp3
+
+    @property
+    def media_type(self) -> str:
+        if self.encoding == "linear16":
+            return "audio/wav" if self.container == "wav" else f"audio/L16;rate={self.sample_rate};channels=1"
+        return "audio/ogg" if self.encoding == "opus" else "audio/mpeg"
+
+    @property
+    def key(self) -> str:
+        # What Deepgram returns for this format; the WAV header is added by `header`
+        if self.sample_rate == TTS_SAMPLE_RATES[self.encoding][0]:
+            return self.encoding
+        return f"{self.encoding}_{self.sample_rate}"
+
+    def params(self) -> Dict[str, object]:
+        params = {"encoding": self.encoding}
+        if self.encoding == "linear16":
+            params.update(sample_rate=self.sample_rate, container="none")
+        return params
+
+    def header(self) -> bytes:
+        """A WAV header for a linear16 stream of unknown length, else nothing."""
+        if self.container != "wav":
+            return b""
+        byte_rate = self.sample_rate * 2
+        return (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt "
+                + struct.pack("<IHHIIHH", 16, 1, 1, self.sample_rate, byte_rate, 2, 16)
+                + b"data" + struct.pack("<I", 0xFFFFFFFF))
+
+
+# Supported output sample rates per encoding, the default first
+TTS_SAMPLE_RATES = {
+    "linear16": (24000, 8000, 16000, 32000, 48000),
+    "mp3": (22050,),
+    "opus": (48000,),
+}
+
+TTS_MEDIA_TYPES = {
+    "audio/mpeg": "mp3", "audio/mp3": "mp3",
+    "audio/ogg": "opus", "audio/opus": "opus",
+    "audio/wav": "linear16", "audio/x-wav": "linear16", "audio/l16": "linear16",
+}
+
+
+def negotiate_audio_format(encoding: Optional[str] = None, sample_rate=None, container: Optional[str] = None,
+                           accept: Optional[str] = None, default: str = "mp3") -> AudioFormat:
+    """Pick the TTS output format for a client.
+
+    An explicit `encoding` (with optional `sample_rate` and, for linear16,
+    `container`) wins; otherwise the first audio type in the `accept` header
+    that we can produce, otherwise `default`. Raises ValueError for formats
+    Deepgram cannot produce.
+    """
+    if not encoding and accept:
+        ranked = []
+        for i, part in enumerate(accept.split(",")):
+            media_type, *options = [item.strip() for item in part.split(";")]
+            quality = 1.0
+            for option in options:
+                if option.lower().startswith("q="):
+                    try:
+                        quality = float(option[2:])
+                    except ValueError:
+                        pass  # a malformed q-value is read as the default rather than failing the turn
+                    break
+            if media_type.lower() in TTS_MEDIA_TYPES and quality > 0:
+                ranked.append((-quality, i, TTS_MEDIA_TYPES[media_type.lower()]))
+        if ranked:
+            encoding = min(ranked)[2]
+    encoding = (encoding or default).lower()
+    if encoding not in TTS_SAMPLE_RATES:
+        raise ValueError(f"Unsupported output encoding {encoding}, expected one of {', '.join(TTS_SAMPLE_RATES)}")
+    rates = TTS_SAMPLE_RATES[encoding]
+    sample_rate = int(sample_rate) if sample_rate else rates[0]
+    if sample_rate not in rates:
+        raise ValueError(f"Unsupported sample rate {sample_rate} for {encoding}, expected one of {', '.join(map(str, rates))}")
+    if encoding == "linear16":
+        container = (container or "wav").lower()
+        if container not in ("wav", "none"):
+            raise ValueError(f"Unsupported container {container} for linear16, expected wav or none")
+    else:
+        container = "ogg" if encoding == "opus" else ""
+    return AudioFormat(encoding, sample_rate, container)
+
+
+def mp3_duration(data: bytes) -> Optional[float]:
+    """Duration of MPEG audio layer III data, by walking its frame headers."""
+    bitrates = {
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),   # MPEG-1
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),      # MPEG-2 and 2.5
+    }
+    sample_rates = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+    offset, seconds = 0, 0.0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = data[6] << 21 | data[7] << 14 | data[8] << 7 | data[9]
+        offset = 10 + size
+    while offset + 4 <= len(data):
+        b1, b2 = data[offset + 1], data[offset + 2]
+        version, layer = (b1 >> 3) & 3, (b1 >> 1) & 3
+        bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+        if data[offset] != 0xFF or b1 & 0xE0 != 0xE0 or version == 1 or layer != 1 \
+                or bitrate_index in (0, 15) or rate_index == 3:
+            offset += 1  # not a frame header, resynchronize
+            continue
+        bitrate = bitrates[3 if version == 3 else 2][bitrate_index] * 1000
+        sample_rate = sample_rates[version][rate_index]
+        samples = 1152 if version == 3 else 576
+        offset += samples // 8 * bitrate // sample_rate + ((b2 >> 1) & 1)
+        seconds += samples / sample_rate
+    return seconds or None
+
+
+def ogg_opus_duration(data: bytes) -> Optional[float]:
+    """Duration of an Ogg Opus stream from the granule position of its last page."""
+    last = data.rfind(b"OggS")
+    head = data.find(b"OpusHead")
+    if last < 0 or last + 14 > len(data):
+        return None
+    granule = struct.unpack_from("<q", data, last + 6)[0]
+    pre_skip = struct.unpack_from("<H", data, head + 10)[0] if 0 <= head <= len(data) - 12 else 0
+    return max(0, granule - pre_skip) / 48000 if granule > 0 else None
+
+
+def audio_duration(data: bytes, format: AudioFormat) -> Optional[float]:
+    if format.encoding == "linear16":
+        # vad imports NumPy, which only the VAD itself needs at startup
+        from vad import parse_wav_header
+        header = parse_wav_header(data) if format.container == "wav" else None
+        offset = header.data_offset if header is not None else 0
+        return (len(data) - offset) / (format.sample_rate * 2)
+    if format.encoding == "opus":
+        return ogg_opus_duration(data)
+    return mp3_duration(data)
+
 
 class TextToSpeech:
-    def __init__(self, model_name: str="aura-asteria-en") -> None:
+    """Deepgram text to speech.
+
+    `stream` yields the audio of a sentence as Deepgram sends it, in the
+    `AudioFormat` the client asked for (by default `format`). The voice comes
+    from `router` (by default just `model_name`); if synthesis fails before
+    the first byte, the next healthy voice is tried. Calls go through the
+    Deepgram scheduler. Sentences of up to `hedge_max_chars` are hedged: once
+    `hedge_min_samples` syntheses have been timed, a second request is fired
+    if the first has not produced a byte within the observed p95 time to
+    first byte. Only short, cacheable sentences are buffered, for the cache.
+    """
+    def __init__(self, model_name: str="aura-asteria-en", clients: Optional[HTTPClients] = None, cache=None,
+                 scheduler: Optional[ProviderScheduler] = None, deadline: float = 10.0, hedge: bool = True,
+                 hedge_max_chars: int = 80, hedge_min_samples: int = 20, router: Optional[Router] = None,
+                 format: Optional[AudioFormat] = None) -> None:
         self.model_name = model_name
+        self.router = router or Router("tts", [model_name], explore=0)
+        self.format = format or negotiate_audio_format()
+        self.clients = clients or http_clients
+        self.cache = cache
+        self.scheduler = scheduler or deepgram_scheduler
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_max_chars = hedge_max_chars
+        self.hedge_min_samples = hedge_min_samples
+        self.first_byte = Histogram()
         self.api_key = os.getenv("DEEPGRAM_API_KEY")
-        self.base_url = "https://api.deepgram.com/v1/speak"
+        self.base_url = f"{DEEPGRAM_URL}/v1/speak"
         
         if model_name not in VALID_TTS_MODELS:
             raise (f"The provided model name `{model_name}` is an invalid model for deepgram.")
     
-    async def speak(self, text: str):
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.base_url,
-                    json={"text": text,},
-                    params={"model": self.model_name},
-                    headers={"Content-Type": "application/json", "Authorization": f"Token {self.api_key}"}
-                )
-                response.raise_for_status()
-                return response.content
-
-        except httpx.HTTPError as e:
-            print(f"HTTP Error in generate_speech_from_text: {e}")
-            return None
-        except Exception as e:
-            print(f"Exception in generate_speech_from_text: {e}")
+    async def speak(self, text: str, format: Optional[AudioFormat] = None) -> Optional[bytes]:
+        """The whole audio for `text` (without any container header), or None if no audio came back.
+
+        Raises `UpstreamError` when every voice in the tier failed, like `stream`.
+        """
+        audio = b"".join([chunk async for chunk in self.stream(text, format)])
+        return audio or None
+
+    async def stream(self, text: str, format: Optional[AudioFormat] = None):
+        format = format or self.format
+        voice = self.router.choose()
+        if self.cache is not None:
+            audio = await self.cache.get(text, voice, format.key)
+            if audio is not None:
+                yield audio
+                return
+
+        keep = [] if self.cache is not None and self.cache.cacheable(text) else None
+        tried = []
+        while True:
+            sent = False
+            chunks = self._stream_voice(text, voice, format)
+            try:
+                async for chunk in chunks:
+                    sent = True
+                    if keep is not None:
+                        keep.append(chunk)
+                    yield chunk
+                break
+            except UpstreamError as e:
+                self.router.observe(voice, error=True)
+                tried.append(voice)
+                if sent or len(tried) >= len(self.router.candidates):
+                    raise
+                failed, voice = voice, self.router.choose(exclude=tried)
+                print(f"TTS voice {failed} failed ({e}), trying {voice}")
+            except Exception as e:
+                print(f"Exception in generate_speech_from_text: {e}")
+                return
+            finally:
+                # Stops the upstream request if the reader stopped early (barge-in)
+                await chunks.aclose()
+
+        if keep:
+            await self.cache.put(text, voice, format.key, b"".join(keep))
+
+    def hedge_delay(self, text: str) -> Optional[float]:
+        if not self.hedge or len(text) > self.hedge_max_chars or self.first_byte.count < self.hedge_min_samples:
             return None
+        return self.first_byte.quantile(0.95)
+
+    async def _stream_voice(self, text: str, voice: str, format: AudioFormat):
+        """Yield Deepgram's response body for `text` as it arrives, hedging the request if it is slow to start."""
+        chunks = asyncio.Queue()
+        owner = []
+
+        async def attempt(first_byte: asyncio.Event):
+            client = self.clients.get(self.base_url)
+            start = time.perf_counter()
+            request = lambda: client.stream(
+                "POST",
+                self.base_url,
+                json={"text": text,},
+                params={"model": voice, **format.params()},
+                headers={"Content-Type": "application/json", "Authorization": f"Token {self.api_key}"}
+            )
+            async with self.scheduler.stream(request, deadline=self.deadline) as response:
+                async for chunk in response.aiter_bytes():
+                    if not owner:
+                        owner.append(first_byte)
+                        elapsed = time.perf_counter() - start
+                        self.first_byte.observe(elapsed)
+                        self.router.observe(voice, ttft=elapsed)
+                        first_byte.set()
+                    elif owner[0] is not first_byte:
+                        # The other copy is already streaming; wait for `hedged` to cancel this one
+                        await asyncio.Event().wait()
+                    chunks.put_nowait(chunk)
+
+        task = asyncio.create_task(self.scheduler.hedged(attempt, self.hedge_delay(text)))
+        task.add_done_callback(lambda _: chunks.put_nowait(None))
+        # Raw PCM is re-chunked so no chunk ends in the middle of a sample
+        width = 2 if format.encoding == "linear16" else 1
+        carry = b""
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                data = carry + chunk
+                whole = len(data) // width * width
+                data, carry = data[:whole], data[whole:]
+                if data:
+                    yield data
+            await task
+        finally:
+            task.cancel()
 
 
 class LanguageModel:
     
-    def __init__(self, model_name: str="meta-llama/Llama-3-8b-chat-hf", **kwargs) -> None:
+    def __init__(self, model_name: str="meta-llama/Llama-3-8b-chat-hf", clients: Optional[HTTPClients] = None,
+                 scheduler: Optional[ProviderScheduler] = None, **kwargs) -> None:
         self.model_name = model_name
+        self.clients = clients or http_clients
+        self.scheduler = scheduler or together_scheduler
+        # Optional routing.Router over a tier of models; by default only `model_name` is used
+        self.router = kwargs.get('router') or Router("llm", [model_name], explore=0)
         self.api_key = os.getenv("TOGETHER_API_KEY")
         self.temperature=kwargs.get('temperature', 1)
         self.max_tokens = kwargs.get('max_tokens', 1024)
-        self.base_url = "https://api.together.xyz/v1/chat/completions"
+        self.segmenter_options = kwargs.get('segmenter_options', {})
+        # Optional context.ContextBudget; without one the full history is sent
+        self.context = kwargs.get('context')
+        self.summary_max_tokens = kwargs.get('summary_max_tokens', 256)
+        self.base_url = f"{TOGETHER_URL}/v1/chat/completions"
         
         self.messages = [dict(role='system', content=SYSTEM_PROMPT)]
+        self.summary = ""
         
         if model_name not in VALID_LANGUAGE_MODELS:
             raise (f"The provided model name `{model_name}` is an invalid language model for together ai.")
@@ -115,18 +696,45 @@ class LanguageModel:
     
     def add_assistant_message(self, text:str) -> str:
         self.messages.append(dict(role='assistant', content=text))
+
+    def record_interrupted_reply(self, text:str):
+        if self.messages[-1]['role'] == 'assistant':
+            self.messages.pop()
+        if text:
+            self.add_assistant_message(text)
+
+    def fold(self, messages, summary: str):
+        folded = {id(message) for message in messages}
+        kept = [message for message in self.messages[1:] if id(message) not in folded]
+        if len(kept) == len(self.messages) - 1:
+            return  # none of them are left to fold
+        self.messages[1:] = kept
+        self.summary = summary
     
-    async def respond(self, text:str):
-        self.add_user_message(text)
+    async def respond(self, text:str, conversation=None, trace=None):
+        # `conversation` is any object with `messages` and the add_*_message
+        # helpers (e.g. sessions.Conversation); defaults to this instance's own history
+        conversation = conversation or self
+        conversation.add_user_message(text)
+
+        if self.context is not None:
+            messages, prompt_tokens = self.context.prompt(conversation)
+            max_tokens = self.context.completion_tokens(prompt_tokens, self.max_tokens)
+        else:
+            messages, max_tokens = conversation.messages, self.max_tokens
+            prompt_tokens = sum(message_tokens(message) for message in messages)
+        if trace is not None:
+            trace.observe_prompt(prompt_tokens)
+        else:
+            LLM_PROMPT_TOKENS.labels("direct").observe(prompt_tokens)
         
         payload = {
             "top_k": 75,
             "top_p": 0.90,
-            "max_tokens": self.max_tokens,
+            "max_tokens": max_tokens,
             "temperature": self.temperature,
             "repetition_penalty": 1,
-            "model": self.model_name,
-            "messages": self.messages,
+            "messages": messages,
             "stop": ["<|eot_id|>", "[/INST]", "</s>", "<|im_end|>"],
             "stream": True
         }
@@ -136,22 +744,166 @@ class LanguageModel:
             "Content-Type": "application/json",
         }
         
-        response = ""
-        full_response = ""
-        async with httpx.AsyncClient() as client:
-            async with client.stream("POST", self.base_url, json=payload, headers=headers) as partial_response:
-                partial_response.raise_for_status()
-                async for line in partial_response.aiter_lines():
-                    try:
-                        json_str = line.split("data:")[1].strip()
-                        data_dict = json.loads(json_str)
-                        text = data_dict['choices'][0]['text']
-                        full_response += text
-                        response += text
-                        if "." in response or "?" in response or "!" in response:
-                            yield response
-                            response = ""
-                    except:
-                        pass
-        
-        self.add_assistant_message(full_response)
\ No newline at end of file
+        segmenter = self.new_segmenter()
+        full_response = []
+        client = self.clients.get(self.base_url)
+        request = lambda: client.stream("POST", self.base_url, json=payload, headers=headers)
+        tried = []
+        while True:
+            model = payload["model"] = self.router.choose(exclude=tried)
+            start = time.perf_counter()
+            first_token = None
+            try:
+                async with self.scheduler.stream(request) as partial_response:
+                    async for event in aiter_sse(partial_response.aiter_lines()):
+                        if event.done:
+                            break
+                        text = self._parse_event(event)
+                        if text and first_token is None:
+                            first_token = time.perf_counter() - start
+                            self.router.observe(model, ttft=first_token)
+                            if trace is not None:
+                                trace.mark("llm_first_token")
+                        full_response.append(text)
+                        for chunk in segmenter.feed(text):
+                            yield chunk
+            except (UpstreamError, StreamError, httpx.HTTPError) as e:
+                self.router.observe(model, error=True)
+                tried.append(model)
+                # Once words have been spoken another model cannot take over
+                if first_token is not None or len(tried) >= len(self.router.candidates):
+                    if isinstance(e, UpstreamError):
+                        raise
+                    # Callers that already sent part of the reply only handle UpstreamError
+                    raise UpstreamError(f"LLM {model} failed mid-reply: {e}") from e
+                print(f"LLM {model} failed before its first token ({e}), failing over")
+                continue
+            if first_token is None:
+                self.router.observe(model, ttft=time.perf_counter() - start)
+            break
+
+        chunk = segmenter.flush()
+        if chunk:
+            yield chunk
+        conversation.add_assistant_message("".join(full_response))
+
+    async def summarize(self, summary: str, messages) -> str:
+        """Fold `messages` into the running `summary` with a short, non-streaming completion."""
+        turns = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        payload = {
+            "model": self.router.current,
+            "max_tokens": self.summary_max_tokens,
+            "temperature": 0.2,
+            "messages": [
+                dict(role='system', content=SUMMARY_PROMPT),
+                dict(role='user', content=f"Summary so far:\n{summary or '(empty)'}\n\nNew turns:\n{turns}"),
+            ],
+            "stop": ["<|eot_id|>", "[/INST]", "</s>", "<|im_end|>"],
+        }
+        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+        client = self.clients.get(self.base_url)
+        response = await self.scheduler.call(lambda: client.post(self.base_url, json=payload, headers=headers), retries=0)
+        choice = (response.json().get("choices") or [{}])[0]
+        return (choice.get("message") or {}).get("content") or choice.get("text") or ""
+
+    async def warm(self):
+        """A one-token completion on the current model, so the first reply does not pay for a cold route."""
+        payload = {"model": self.router.current, "max_tokens": 1, "messages": [dict(role='user', content="Hi")]}
+        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+        client = self.clients.get(self.base_url)
+        await self.scheduler.call(lambda: client.post(self.base_url, json=payload, headers=headers), retries=0)
+
+    def new_segmenter(self) -> SentenceSegmenter:
+        return SentenceSegmenter(**self.segmenter_options)
+
+    @staticmethod
+    def _parse_event(event: SSEEvent) -> str:
+        try:
+            data = json.loads(event.data)
+        except json.JSONDecodeError as e:
+            raise StreamError(f"Malformed event in completion stream: {event.data[:200]!r}") from e
+        if not isinstance(data, dict):
+            raise StreamError(f"Unexpected event in completion stream: {event.data[:200]!r}")
+
+        if event.event == "error" or "error" in data:
+            error = data.get("error", data)
+            message = error.get("message", error) if isinstance(error, dict) else error
+            raise StreamError(f"Completion stream error: {message}")
+
+        choices = data.get("choices") or [{}]
+        choice = choices[0]
+        return choice.get("text") or (choice.get("delta") or {}).get("content") or ""
+
+
+async def pipeline_speech(sentences, tts: TextToSpeech, max_in_flight: int = 3, spoken: Optional[List[str]] = None, trace=None,
+                          format: Optional[AudioFormat] = None):
+    """Synthesize sentences as they arrive and yield their audio, in order, as it streams in.
+
+    Each sentence is handed to `tts.stream` as soon as it is produced, so the
+    audio for sentence N is passed on chunk by chunk while N+1 is already
+    being synthesized (and buffered). At most `max_in_flight` sentences are
+    being synthesized or waiting to be sent at the same time. If `spoken` is
+    given, each sentence is appended to it when its first chunk is handed
+    out. If `trace` is given, each sentence's time to first byte is recorded
+    on it. `format` is the client's `AudioFormat` (default: the TTS's own).
+
+    Closing the generator early (e.g. on barge-in) cancels pending TTS
+    requests and closes `sentences`, which stops the upstream LLM stream.
+    """
+    slots = asyncio.Semaphore(max(1, max_in_flight))
+    pending = asyncio.Queue()
+
+    async def speak(sentence, chunks: asyncio.Queue):
+        start = time.perf_counter()
+        first = True
+        try:
+            async for chunk in tts.stream(sentence, format):
+                if first and trace is not None:
+                    trace.observe_tts(time.perf_counter() - start)
+                first = False
+                chunks.put_nowait(chunk)
+        finally:
+            chunks.put_nowait(None)
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                if not sentence.strip():
+                    continue
+                await slots.acquire()
+                chunks = asyncio.Queue()
+                pending.put_nowait((sentence, chunks, asyncio.create_task(speak(sentence, chunks))))
+        finally:
+            pending.put_nowait(None)
+            if hasattr(sentences, "aclose"):
+                await sentences.aclose()
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            sentence, chunks, task = item
+            try:
+                started = False
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    if not started:
+                        started = True
+                        if spoken is not None:
+                            spoken.append(sentence)
+                    yield chunk
+                await task
+            finally:
+                task.cancel()
+                slots.release()
+        await producer
+    finally:
+        producer.cancel()
+        while not pending.empty():
+            item = pending.get_nowait()
+            if item is not None:
+                item[2].cancel()